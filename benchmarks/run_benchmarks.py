@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import json5
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+from worker_pool import SimulationPool, build_simulator
+
+# Batches per worker process in bench_parallel
+BATCHES_PER_PROCESS = 4
+
+def best_time(function, repeat=3):
+    """
+    Time a function, keeping the fastest of several runs.
+
+    Parameters:
+    function (callable): The function to time, called without arguments.
+    repeat (int): The number of runs.
+
+    Returns:
+    tuple: The fastest wall time in seconds and the value returned by that run.
+    """
+    best, value = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - start
+        if elapsed < best:
+            best = elapsed
+    return best, value
+
+def result(name, parameters, seconds, **counts):
+    """
+    Build one benchmark record.
+
+    Parameters:
+    name (str): The benchmarked function.
+    parameters (dict): The parameters of the run, part of the key comparisons match on.
+    seconds (float): The wall time.
+    counts: The amounts of work done, each gives a <name>_per_second rate.
+
+    Returns:
+    dict: The record.
+    """
+    rates = {f'{unit}_per_second': count / seconds for unit, count in counts.items()}
+    return {'name': name, 'parameters': parameters, 'seconds': seconds, 'rates': rates}
+
+def bench_geometry(simulator, n_calls):
+    """
+    Benchmark the point and ray tests of the solids, one call per point.
+
+    Parameters:
+    simulator (MuonSimulator): The simulator whose pyramid, cavity and detectors are used.
+    n_calls (int): The number of calls per function.
+
+    Returns:
+    list: The records.
+    """
+    rng = np.random.default_rng(0)
+    lower, upper = simulator.pyramid.bounds()
+    points = lower + rng.random((n_calls, 3)) * (upper - lower)
+    directions = rng.normal(size=(n_calls, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    functions = {
+        'Pyramid.is_inside': lambda: [simulator.pyramid.is_inside(point) for point in points],
+        'Pyramid.path_length': lambda: [simulator.pyramid.path_length(point, direction) for point, direction in zip(points, directions)],
+        'Cavity.is_inside': lambda: [simulator.cavity.is_inside(point) for point in points],
+        'MuonDetector.is_inside': lambda: [simulator.detector_2.is_inside(point) for point in points],
+    }
+    return [result(name, {'n_calls': n_calls}, best_time(function)[0], calls=n_calls) for name, function in functions.items()]
+
+def bench_generation(simulator, n_muons_list):
+    """
+    Benchmark generate_muons.
+
+    Parameters:
+    simulator (MuonSimulator): The simulator.
+    n_muons_list (list): The numbers of muons.
+
+    Returns:
+    list: The records.
+    """
+    records = []
+    for n_muons in n_muons_list:
+        seconds, _ = best_time(lambda: simulator.generate_muons(n_muons, rng=np.random.default_rng(1)))
+        records.append(result('generate_muons', {'n_muons': n_muons}, seconds, muons=n_muons))
+    return records
+
+def bench_transport(simulator, n_muons_list):
+    """
+    Benchmark simulate_muon_trajectory on one core, and write_results_to_csv on its paths.
+
+    Parameters:
+    simulator (MuonSimulator): The simulator.
+    n_muons_list (list): The numbers of muons.
+
+    Returns:
+    list: The records.
+    """
+    records = []
+    for n_muons in n_muons_list:
+        muons = simulator.generate_muons(n_muons, rng=np.random.default_rng(2))
+        rng = np.random.default_rng(3)
+        # The transport moves the positions in place, every run starts from copies
+        run = lambda: [simulator.simulate_muon_trajectory((muon_id, (position.copy(), direction.copy(), energy)), rng)
+                       for muon_id, (position, direction, energy) in muons]
+        seconds, results = best_time(run, repeat=1)
+        results = [path for path in results if path is not None]
+        n_steps = sum(len(path) - 1 for _, path in results)
+        records.append(result('simulate_muon_trajectory', {'n_muons': n_muons, 'mode': 'step'}, seconds, muons=n_muons, steps=n_steps))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.csv')
+            seconds, _ = best_time(lambda: simulator.write_results_to_csv(results, path))
+        n_rows = sum(len(path) for _, path in results)
+        records.append(result('write_results_to_csv', {'n_muons': n_muons}, seconds, muons=n_muons, rows=n_rows))
+    return records
+
+def bench_parallel(settings, simulator, n_muons, n_processes_list):
+    """
+    Benchmark the batched transport of the configured mode over worker pools of increasing size.
+
+    Parameters:
+    settings (dict): The simulation settings.
+    simulator (MuonSimulator): The simulator built from them.
+    n_muons (int): The number of muons per run.
+    n_processes_list (list): The numbers of worker processes.
+
+    Returns:
+    list: The records.
+    """
+    records = []
+    for n_processes in n_processes_list:
+        # BATCHES_PER_PROCESS batches per worker, so every pool size gets the same share of the run
+        batch_size = max(1, -(-n_muons // (BATCHES_PER_PROCESS * n_processes)))
+        with SimulationPool(settings, n_processes) as pool:
+            # The first batches pay for the start of the workers
+            list(simulator.iter_muon_batches(n_processes * simulator.batch_size // 10 or 1, pool=pool, batch_size=simulator.batch_size // 10 or 1))
+            seconds, batches = best_time(lambda: list(simulator.iter_muon_batches(n_muons, pool=pool, batch_size=batch_size)), repeat=1)
+        n_steps = sum(int(batch.summaries['n_steps'].sum()) for batch in batches)
+        parameters = {'n_muons': n_muons, 'n_processes': n_processes, 'batch_size': batch_size, 'mode': simulator.transport_mode}
+        records.append(result('iter_muon_batches', parameters, seconds, muons=n_muons, steps=n_steps))
+    return records
+
+def environment():
+    """
+    Describe the code and machine a benchmark ran on.
+
+    Returns:
+    dict: The commit, versions, processor count and time.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(old, new, tolerance):
+    """
+    Compare the rates of two benchmark files.
+
+    Parameters:
+    old (dict): The baseline, as written by this script.
+    new (dict): The benchmark to check.
+    tolerance (float): The relative slowdown still accepted.
+
+    Returns:
+    tuple: The lines of the comparison table and the lines of the regressions.
+    """
+    key = lambda record: (record['name'], json.dumps(record['parameters'], sort_keys=True))
+    baseline = {key(record): record for record in old['results']}
+    lines, regressions = [], []
+    for record in new['results']:
+        previous = baseline.get(key(record))
+        if previous is None:
+            continue
+        for rate, value in record['rates'].items():
+            if rate not in previous['rates']:
+                continue
+            ratio = value / previous['rates'][rate]
+            line = f"{record['name']:28s} {json.dumps(record['parameters'], sort_keys=True):58s} {rate:20s} {ratio:6.2f}x"
+            lines.append(line)
+            if ratio < 1 - tolerance:
+                regressions.append(line)
+    return lines, regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the geometry, transport and output of the simulation.')
+    parser.add_argument('--settings', default=os.path.join(ROOT, 'config', 'settings.json'))
+    parser.add_argument('--output', default=None, help='JSON file of the results, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--n-muons', type=int, nargs='+', default=[10, 100], help='muons of the single-core curves')
+    parser.add_argument('--parallel-muons', type=int, default=2000, help='muons of the process curve')
+    parser.add_argument('--processes', type=int, nargs='+', default=None, help='pool sizes, defaults to powers of two up to the processor count')
+    parser.add_argument('--n-calls', type=int, default=10000, help='calls of the geometry benchmarks')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'NEW'), help='compare two result files instead of running')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        with open(arguments.compare[0]) as old_file, open(arguments.compare[1]) as new_file:
+            lines, regressions = compare(json.load(old_file), json.load(new_file), arguments.tolerance)
+        print('\n'.join(lines))
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) beyond {arguments.tolerance:.0%}:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        sys.exit(0)
+
+    with open(arguments.settings, 'r') as settings_file:
+        settings = json5.load(settings_file)
+    with tempfile.TemporaryDirectory() as output_path:
+        settings = dict(settings, output_path=output_path)
+        simulator = build_simulator(settings)
+        processes = arguments.processes or [2 ** power for power in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+        results = (bench_geometry(simulator, arguments.n_calls) + bench_generation(simulator, arguments.n_muons)
+                   + bench_transport(simulator, arguments.n_muons) + bench_parallel(settings, simulator, arguments.parallel_muons, processes))
+    report = {'environment': environment(), 'results': results}
+    output = arguments.output or os.path.join(ROOT, 'benchmarks', 'results', f"{report['environment']['commit'] or 'benchmark'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    for record in results:
+        rates = ', '.join(f'{rate} {value:.4g}' for rate, value in record['rates'].items())
+        print(f"{record['name']:28s} {json.dumps(record['parameters'], sort_keys=True):58s} {rates}")
+    print(f'Results written to {output}')
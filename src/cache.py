@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Settings that describe the geometry and materials, see geometry_settings
+GEOMETRY_PREFIXES = ('pyramid_', 'cavity_', 'queen_chamber_', 'king_chamber_', 'grand_gallery_', 'scene_', 'void_')
+
+def settings_digest(*parts):
+    """
+    Hash JSON-serializable values into a short stable key.
+
+    Parameters:
+    parts: Settings dictionaries or any other JSON-serializable values.
+
+    Returns:
+    str: A 16 character hexadecimal digest, independent of dictionary ordering.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def geometry_settings(settings):
+    """
+    Select the settings that describe the geometry and materials.
+
+    Parameters:
+    settings (dict): The simulation settings.
+
+    Returns:
+    dict: The subset of the settings whose keys start with one of GEOMETRY_PREFIXES.
+    """
+    return {key: value for key, value in settings.items() if key.startswith(GEOMETRY_PREFIXES)}
+
+def cache_directory(settings):
+    """
+    Get the directory of the on-disk caches, creating it if needed.
+
+    Parameters:
+    settings (dict): The simulation settings, 'cache_dir' defaults to 'cache'.
+
+    Returns:
+    str: The path of the cache directory.
+    """
+    directory = settings.get('cache_dir', 'cache')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def atomic_write(path, write):
+    """
+    Write a file so that readers never see it half written.
+
+    The content goes to a temporary file in the same directory which then replaces path.
+
+    Parameters:
+    path (str): The path of the file to write.
+    write (callable): Called with an open binary file object to write the content.
+
+    Returns:
+    None
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
@@ -0,0 +1,103 @@
+import json
+import os
+import pickle
+
+from cache import atomic_write, settings_digest
+
+class RunCheckpoint:
+    def __init__(self, output_path, run, completed=(), state_file=None):
+        """
+        Initialize the RunCheckpoint class: the manifest of a streaming run, listing its finished batches.
+
+        After every batch the accumulators are pickled to a new state file, then the manifest is
+        replaced to point at it, both atomically. A run killed at any moment leaves a manifest whose
+        batches all have their output chunks on disk and whose state includes exactly those batches.
+
+        Parameters:
+        output_path (str): The output directory of the run.
+        run (dict): What identifies the run: the settings digest, seed, number of muons and batch size.
+        completed (iterable): The indices of the finished batches.
+        state_file (str, optional): The name of the current accumulator state file.
+
+        Returns:
+        None
+        """
+        self.output_path = output_path
+        self.run = run
+        self.completed = set(completed)
+        self.state_file = state_file
+
+    @classmethod
+    def start(cls, output_path, settings, seed, n_muons, batch_size, accumulators=(), resume=False):
+        """
+        Begin a run, or pick up the one recorded in output_path.
+
+        Parameters:
+        output_path (str): The output directory of the run.
+        settings (dict): The simulation settings.
+        seed (int): The seed of a new run.
+        n_muons (int): The number of muons of the run.
+        batch_size (int): The number of muons per batch.
+        accumulators (list): Objects whose state is restored from the checkpoint when resuming.
+        resume (bool): Continue the recorded run instead of starting over.
+
+        Returns:
+        RunCheckpoint: The checkpoint, whose run['seed'] is the seed to simulate with.
+        """
+        # A run without 'random_seed' resumes with the entropy it started with
+        run = {'settings': settings_digest(dict(settings, random_seed=None)), 'seed': seed, 'n_muons': n_muons, 'batch_size': batch_size}
+        manifest_path = os.path.join(output_path, 'manifest.json')
+        previous = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                previous = json.load(manifest_file)
+        if not resume or previous is None:
+            if previous is not None and previous['state_file'] is not None:
+                _remove(os.path.join(output_path, previous['state_file']))
+            checkpoint = cls(output_path, run)
+            checkpoint.write_manifest()
+            return checkpoint
+
+        keys = ('settings', 'n_muons', 'batch_size') if settings.get('random_seed') is None else ('settings', 'seed', 'n_muons', 'batch_size')
+        differing = [key for key in keys if previous['run'][key] != run[key]]
+        if differing:
+            raise ValueError(f'Cannot resume the run in {output_path}, it differs in {differing}')
+        checkpoint = cls(output_path, previous['run'], previous['completed'], previous['state_file'])
+        if checkpoint.state_file is not None:
+            with open(os.path.join(output_path, checkpoint.state_file), 'rb') as state:
+                for accumulator, saved in zip(accumulators, pickle.load(state)):
+                    vars(accumulator).update(vars(saved))
+        return checkpoint
+
+    def write_manifest(self):
+        """
+        Replace the manifest with the current state of the run.
+
+        Returns:
+        None
+        """
+        manifest = {'run': self.run, 'completed': sorted(self.completed), 'state_file': self.state_file}
+        atomic_write(os.path.join(self.output_path, 'manifest.json'), lambda file: file.write(json.dumps(manifest, indent=2).encode()))
+
+    def save(self, batch_index, accumulators=()):
+        """
+        Record a finished batch, whose output chunks must already be written.
+
+        Parameters:
+        batch_index (int): The index of the batch.
+        accumulators (list): The accumulators, updated with the batch.
+
+        Returns:
+        None
+        """
+        previous = self.state_file
+        self.completed.add(batch_index)
+        self.state_file = f'state-{len(self.completed):06d}.pkl'
+        atomic_write(os.path.join(self.output_path, self.state_file), lambda file: pickle.dump(list(accumulators), file))
+        self.write_manifest()
+        if previous is not None:
+            _remove(os.path.join(self.output_path, previous))
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+from scipy import sparse
+from cache import atomic_write, cache_directory, geometry_settings, settings_digest
+from range_table import RangeTable
+
+class MuonDataAnalysis:
+    def __init__(self, settings, pyramid, detectors):
+        """
+        Initialize the MuonDataAnalysis class: the tomographic reconstruction of the density of the pyramid
+        from the transmission maps of the detectors.
+
+        Every (detector, theta, phi) bin of a TransmissionMap is a ray leaving the center of the detector
+        towards the direction the muons come from. The system matrix holds the length of each ray in each
+        voxel of the pyramid, so the opacity seen by a bin is 100 * A @ density. It only depends on the
+        geometry and is cached on disk, solving again with new counts only costs the iterations.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'reconstruction_resolution' (float): The edge length of the voxels in m. Defaults to 5.
+            - 'reconstruction_method' (str): 'sirt', 'art' or 'cgls'. Defaults to 'sirt'.
+            - 'reconstruction_iterations' (int): The number of iterations. Defaults to 50.
+            - 'transmission_theta_bins', 'transmission_phi_bins' (int): The binning of the maps.
+            - 'muon_spectral_index' (float): The index of the spectrum used to turn counts into opacities.
+        pyramid (Pyramid): The pyramid model.
+        detectors (list): The MuonDetector objects, in the order of the maps.
+
+        Returns:
+        None
+        """
+        self.settings = settings
+        self.pyramid = pyramid
+        self.detectors = list(detectors)
+        self.resolution = float(settings.get('reconstruction_resolution', 5))
+        self.method = settings.get('reconstruction_method', 'sirt')
+        self.n_iterations = settings.get('reconstruction_iterations', 50)
+        self.n_theta = settings.get('transmission_theta_bins', 36)
+        self.n_phi = settings.get('transmission_phi_bins', 72)
+        self.spectral_index = settings.get('muon_spectral_index', 2.7)
+        self.reference_density = float(np.mean(settings['pyramid_material_density']))
+        self.range_table = RangeTable.from_settings(settings)
+        self.lower, upper = pyramid.bounds()
+        self.shape = np.ceil((upper - self.lower) / self.resolution).astype(int)
+        # Rays start at the center of the acceptance volume of each detector
+        self.origins = np.array([detector.vertices.mean(axis=0) for detector in self.detectors])
+        self._system_matrix = None
+
+    def ray_directions(self):
+        """
+        Get the directions of the bin centers of a transmission map.
+
+        Returns:
+        np.array: The (n_theta * n_phi, 3) unit vectors pointing where the muons of each bin come from.
+        """
+        theta = (np.arange(self.n_theta) + 0.5) * np.pi / self.n_theta
+        phi = -np.pi + (np.arange(self.n_phi) + 0.5) * 2 * np.pi / self.n_phi
+        theta, phi = np.meshgrid(theta, phi, indexing='ij')
+        return np.column_stack([(np.sin(theta) * np.cos(phi)).ravel(), (np.sin(theta) * np.sin(phi)).ravel(), np.cos(theta).ravel()])
+
+    def trace_ray(self, origin, direction):
+        """
+        Find the voxels a ray crosses inside the pyramid.
+
+        Parameters:
+        origin (np.array): The starting point of the ray.
+        direction (np.array): The unit direction of the ray.
+
+        Returns:
+        tuple: The flat indices of the voxels and the lengths of the ray in them, in m.
+        """
+        t_enter, t_exit = self.pyramid.intersection_distances_many(origin[np.newaxis], direction[np.newaxis])
+        start, stop = max(t_enter[0], 0), t_exit[0]
+        if not stop > start:
+            return np.empty(0, dtype=int), np.empty(0)
+        # Every crossing of a voxel plane splits the ray
+        crossings = [np.array([start, stop])]
+        for axis in range(3):
+            if direction[axis] != 0:
+                planes = self.lower[axis] + self.resolution * np.arange(self.shape[axis] + 1)
+                t = (planes - origin[axis]) / direction[axis]
+                crossings.append(t[(t > start) & (t < stop)])
+        t = np.unique(np.concatenate(crossings))
+        middles = origin + direction * ((t[:-1] + t[1:]) / 2)[:, np.newaxis]
+        indices = np.clip(((middles - self.lower) // self.resolution).astype(int), 0, self.shape - 1)
+        return np.ravel_multi_index(indices.T, self.shape), np.diff(t)
+
+    def build_system_matrix(self):
+        """
+        Trace the ray of every bin of every detector.
+
+        Returns:
+        sparse.csr_matrix: The (detectors * n_theta * n_phi, voxels) lengths in m, rows in the flat
+        bin order of TransmissionMap.
+        """
+        directions = self.ray_directions()
+        rows, columns, lengths = [], [], []
+        for detector, origin in enumerate(self.origins):
+            for index, direction in enumerate(directions):
+                voxels, voxel_lengths = self.trace_ray(origin, direction)
+                rows.append(np.full(len(voxels), detector * len(directions) + index))
+                columns.append(voxels)
+                lengths.append(voxel_lengths)
+        shape = (len(self.origins) * len(directions), int(np.prod(self.shape)))
+        return sparse.csr_matrix((np.concatenate(lengths), (np.concatenate(rows), np.concatenate(columns))), shape=shape)
+
+    @property
+    def system_matrix(self):
+        """
+        The system matrix, from the on-disk cache, built and cached on first use.
+
+        The cache file is keyed by a hash of the geometry, the detectors, the binning and the resolution.
+
+        Returns:
+        sparse.csr_matrix: The system matrix.
+        """
+        if self._system_matrix is None:
+            digest = settings_digest(geometry_settings(self.settings), self.origins, self.resolution, self.n_theta, self.n_phi)
+            path = os.path.join(cache_directory(self.settings), f'system-{digest}.npz')
+            if not os.path.exists(path):
+                matrix = self.build_system_matrix()
+                atomic_write(path, lambda file: sparse.save_npz(file, matrix))
+            self._system_matrix = sparse.load_npz(path).tocsr()
+        return self._system_matrix
+
+    def opacity_from_transmission(self, ratio):
+        """
+        Turn relative transmissions into opacities.
+
+        The integral flux above E falls as E^-(index - 1), so a transmission T means the cut-off energy
+        of the reference opacity scaled by T^(-1 / (index - 1)), whose range is the opacity.
+
+        Parameters:
+        ratio (np.array): The transmissions, flat in the row order of the system matrix.
+
+        Returns:
+        np.array: The opacities in g/cm^2, NaN where the ratio is not positive.
+        """
+        reference_opacity = 100 * self.reference_density * np.asarray(self.system_matrix.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            energy = self.range_table.energy(reference_opacity) * ratio ** (-1 / (self.spectral_index - 1))
+        return np.where(ratio > 0, self.range_table.range(energy), np.nan)
+
+    def solve(self, opacity, method=None, n_iterations=None):
+        """
+        Solve the system matrix for the density.
+
+        Parameters:
+        opacity (np.array): The opacities in g/cm^2, flat in the row order of the system matrix. Rows
+            that are NaN or whose ray misses the pyramid are left out.
+        method (str, optional): 'sirt', 'art' or 'cgls', defaults to the configured method.
+        n_iterations (int, optional): The number of iterations (sweeps for 'art'), defaults to the configured number.
+
+        Returns:
+        np.array: The density of every voxel in g/cm^3, shaped like the voxel grid, NaN for voxels no ray crosses.
+        """
+        method = method or self.method
+        n_iterations = n_iterations or self.n_iterations
+        matrix = self.system_matrix
+        used = np.isfinite(opacity) & (np.diff(matrix.indptr) > 0)
+        matrix = matrix[used]
+        # Lengths are in m and densities in g/cm^3
+        measured = opacity[used] / 100
+        start = np.full(matrix.shape[1], self.reference_density)
+        if method == 'sirt':
+            density = sirt(matrix, measured, start, n_iterations)
+        elif method == 'art':
+            density = art(matrix, measured, start, n_iterations)
+        elif method == 'cgls':
+            density = cgls(matrix, measured, start, n_iterations)
+        else:
+            raise ValueError(f'Unknown reconstruction method: {method}')
+        density[np.asarray(matrix.sum(axis=0)).ravel() == 0] = np.nan
+        return density.reshape(self.shape)
+
+    def reconstruct(self, transmission_map, method=None, n_iterations=None):
+        """
+        Reconstruct the density of the pyramid from a transmission map.
+
+        Parameters:
+        transmission_map (TransmissionMap): The map, with its reference filled and the binning of the settings.
+        method (str, optional): 'sirt', 'art' or 'cgls', defaults to the configured method.
+        n_iterations (int, optional): The number of iterations, defaults to the configured number.
+
+        Returns:
+        np.array: The density of every voxel in g/cm^3, NaN for voxels no ray crosses.
+        """
+        ratio, _ = transmission_map.transmission()
+        return self.solve(self.opacity_from_transmission(ratio.ravel()), method, n_iterations)
+
+def sirt(matrix, measured, start, n_iterations):
+    """
+    Solve matrix @ x = measured with the simultaneous iterative reconstruction technique.
+
+    Parameters:
+    matrix (sparse.csr_matrix): The system matrix.
+    measured (np.array): The right-hand side.
+    start (np.array): The initial guess.
+    n_iterations (int): The number of iterations.
+
+    Returns:
+    np.array: The non-negative solution.
+    """
+    with np.errstate(divide='ignore'):
+        inverse_rows = np.nan_to_num(1 / np.asarray(matrix.sum(axis=1)).ravel(), posinf=0)
+        inverse_columns = np.nan_to_num(1 / np.asarray(matrix.sum(axis=0)).ravel(), posinf=0)
+    transposed = matrix.T.tocsr()
+    x = start.astype(float)
+    for _ in range(n_iterations):
+        x = np.maximum(x + inverse_columns * (transposed @ (inverse_rows * (measured - matrix @ x))), 0)
+    return x
+
+def art(matrix, measured, start, n_iterations, relaxation=0.5):
+    """
+    Solve matrix @ x = measured with the algebraic reconstruction technique (Kaczmarz sweeps over the rows).
+
+    Parameters:
+    matrix (sparse.csr_matrix): The system matrix.
+    measured (np.array): The right-hand side.
+    start (np.array): The initial guess.
+    n_iterations (int): The number of sweeps.
+    relaxation (float): The fraction of each row correction applied.
+
+    Returns:
+    np.array: The non-negative solution.
+    """
+    row_norms = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+    x = start.astype(float)
+    for _ in range(n_iterations):
+        for row in np.flatnonzero(row_norms > 0):
+            columns = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+            lengths = matrix.data[matrix.indptr[row]:matrix.indptr[row + 1]]
+            x[columns] += relaxation * (measured[row] - lengths @ x[columns]) / row_norms[row] * lengths
+        np.maximum(x, 0, out=x)
+    return x
+
+def cgls(matrix, measured, start, n_iterations):
+    """
+    Solve matrix @ x = measured in the least-squares sense with conjugate gradients on the normal equations.
+
+    Parameters:
+    matrix (sparse.csr_matrix): The system matrix.
+    measured (np.array): The right-hand side.
+    start (np.array): The initial guess.
+    n_iterations (int): The number of iterations.
+
+    Returns:
+    np.array: The solution, not constrained to be non-negative.
+    """
+    x = start.astype(float)
+    residual = measured - matrix @ x
+    gradient = matrix.T @ residual
+    direction = gradient.copy()
+    norm = gradient @ gradient
+    for _ in range(n_iterations):
+        if norm == 0:
+            break
+        projected = matrix @ direction
+        step = norm / (projected @ projected)
+        x += step * direction
+        residual -= step * projected
+        gradient = matrix.T @ residual
+        new_norm = gradient @ gradient
+        direction = gradient + new_norm / norm * direction
+        norm = new_norm
+    return x
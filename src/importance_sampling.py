@@ -0,0 +1,81 @@
+import numpy as np
+
+def subdivide_triangles(vertices, n_divisions):
+    """
+    Split triangles into equal-area sub-triangles.
+
+    Parameters:
+    vertices (np.array): The (T, 3, 3) vertices of the triangles.
+    n_divisions (int): The number of divisions of each edge, every triangle gives n_divisions^2 cells.
+
+    Returns:
+    np.array: The (T * n_divisions^2, 3, 3) vertices of the cells, grouped by triangle.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    # Barycentric (i, j) corners of the upward cells, then of the downward ones
+    up = [((i, j), (i + 1, j), (i, j + 1)) for i in range(n_divisions) for j in range(n_divisions - i)]
+    down = [((i + 1, j), (i + 1, j + 1), (i, j + 1)) for i in range(n_divisions) for j in range(n_divisions - i - 1)]
+    corners = np.array(up + down, dtype=float) / n_divisions
+    # Point = a * v0 + b * v1 + (1 - a - b) * v2
+    weights = np.stack([corners[..., 0], corners[..., 1], 1 - corners[..., 0] - corners[..., 1]], axis=-1)
+    return np.einsum('ckv,tvx->tckx', weights, vertices).reshape(-1, 3, 3)
+
+def sample_triangles(vertices, n_points, rng):
+    """
+    Draw one uniform point in each of the given triangles.
+
+    Parameters:
+    vertices (np.array): The (N, 3, 3) vertices of the triangles.
+    n_points (int): N.
+    rng (np.random.Generator): The generator to draw from.
+
+    Returns:
+    np.array: The (N, 3) points.
+    """
+    r = rng.random((n_points, 2))
+    folded = r.sum(axis=1) > 1
+    r[folded] = 1 - r[folded]
+    r1, r2 = r[:, :1], r[:, 1:]
+    return r1 * vertices[:, 0] + r2 * vertices[:, 1] + (1 - r1 - r2) * vertices[:, 2]
+
+class StartPointSampler:
+    def __init__(self, cells, importance, biased_fraction):
+        """
+        Initialize the StartPointSampler class: start points drawn over equal-area cells of the
+        pyramid sides with a bias towards important cells, and the weight that undoes the bias.
+
+        A cell is chosen with probability (1 - f) / n + f * importance / sum(importance), then the
+        point is uniform in it. The uniform share keeps every weight below 1 / (1 - f).
+
+        Parameters:
+        cells (np.array): The (n, 3, 3) vertices of the cells, all of the same area.
+        importance (np.array): The (n,) non-negative importance of the cells.
+        biased_fraction (float): f, the share of the draws that follows the importance.
+
+        Returns:
+        None
+        """
+        self.cells = cells
+        importance = np.asarray(importance, dtype=float)
+        n_cells = len(cells)
+        if importance.sum() > 0:
+            self.probabilities = (1 - biased_fraction) / n_cells + biased_fraction * importance / importance.sum()
+        else:
+            self.probabilities = np.full(n_cells, 1 / n_cells)
+        # Uniform density on the sides over the proposal density
+        self.weights = 1 / (n_cells * self.probabilities)
+        self.cumulative = np.cumsum(self.probabilities)
+
+    def sample(self, n_points, rng):
+        """
+        Draw start points.
+
+        Parameters:
+        n_points (int): The number of points.
+        rng (np.random.Generator): The generator to draw from.
+
+        Returns:
+        tuple: The (n_points, 3) points and their (n_points,) weights.
+        """
+        chosen = np.minimum(np.searchsorted(self.cumulative, rng.random(n_points) * self.cumulative[-1], side='right'), len(self.cells) - 1)
+        return sample_triangles(self.cells[chosen], n_points, rng), self.weights[chosen]
@@ -0,0 +1,95 @@
+import json
+import os
+import time
+from contextlib import nullcontext
+
+# Handed out by every disabled Instrumentation, entering it does nothing
+_DISABLED_STAGE = nullcontext()
+
+class _Stage:
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+class Instrumentation:
+    def __init__(self, enabled=False, log_path=None):
+        """
+        Initialize the Instrumentation class: wall time per stage and structured run events.
+
+        Stages are timed per batch around whole calls, never inside the step loops, and a disabled
+        instance hands out one shared no-op context, so turning it off costs nothing.
+
+        Parameters:
+        enabled (bool): Time the stages and write the events.
+        log_path (str, optional): The file the events are appended to as JSON lines.
+
+        Returns:
+        None
+        """
+        self.enabled = enabled
+        self.log_path = log_path
+        self.timings = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create the configured instrumentation.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'instrumentation' (bool): Defaults to False.
+            - 'log_path' (str): Defaults to 'logs/simulation.log'.
+
+        Returns:
+        Instrumentation: The instrumentation.
+        """
+        return cls(settings.get('instrumentation', False), settings.get('log_path', os.path.join('logs', 'simulation.log')))
+
+    def stage(self, name):
+        """
+        Get a context manager adding the wall time of its block to a stage.
+
+        Parameters:
+        name (str): The stage, e.g. 'generation', 'transport', 'detection' or 'output'.
+
+        Returns:
+        A context manager, a shared no-op one when disabled.
+        """
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return _Stage(self.timings, name)
+
+    def take_timings(self):
+        """
+        Get the stage timings gathered since the last call and start over.
+
+        Returns:
+        dict: The seconds spent per stage.
+        """
+        timings, self.timings = self.timings, {}
+        return timings
+
+    def emit(self, event, **fields):
+        """
+        Append an event to the log as one JSON line.
+
+        Parameters:
+        event (str): The kind of event.
+        fields: JSON-serializable values of the event.
+
+        Returns:
+        None
+        """
+        if not self.enabled:
+            return
+        directory = os.path.dirname(self.log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(json.dumps({'time': time.time(), 'event': event, **fields}) + '\n')
@@ -1,3 +1,6 @@
+import argparse
+import cProfile
+import pstats
 import visualization;
 import numpy as np
 import os
@@ -6,8 +9,10 @@ import pyramid_model
 from muon_detector import MuonDetector
 from muon_simulation import MuonSimulator
 from data_processing import MuonDataAnalysis
+from stopping import stopping_criterion
+from transmission_map import TransmissionMap
 
-def run_simulation():
+def run_simulation(resume=False, instrument=False):
   base_dir = os.path.dirname(os.path.abspath(__file__))
 
   settings_path = os.path.join(base_dir, '..', 'config', 'settings.json')
@@ -15,6 +20,8 @@ def run_simulation():
   n_detectors = [1, 2]
   with open(settings_path, 'r') as settings_file:
       settings = json5.load(settings_file)  
+  if instrument:
+    settings['instrumentation'] = True
 
 
   #visualization.visualize_pyramid(settings)
@@ -26,10 +33,33 @@ def run_simulation():
   muon_detector_2 = MuonDetector(settings, n_detectors[1])
   muon_detectors = [muon_detector_1, muon_detector_2]
   muon_simulation = MuonSimulator(settings, pyramid, cavity, muon_detectors)
-  res = muon_simulation.simulate_muons_parallel(1600)
+  transmission_map = TransmissionMap.from_settings(settings, n_detectors)
+  stop = stopping_criterion(settings, transmission_map)
+  n_muons = settings.get('stopping_max_muons', settings['n_muons']) if stop is not None else 1600
+  n_processes = 8
+  muon_simulation.simulate_muons_streaming(n_muons, n_processes, accumulators=[transmission_map], resume=resume, stop=stop, report=print,
+                                           batch_size=muon_simulation.default_batch_size(n_muons, n_processes))
+  transmission_map.save(os.path.join(muon_simulation.output_path, 'transmission_map.npz'))
+  if settings.get('transmission_reference', False):
+    analysis = MuonDataAnalysis(settings, pyramid, muon_detectors)
+    density = analysis.reconstruct(transmission_map)
+    np.save(os.path.join(muon_simulation.output_path, 'density.npy'), density)
   #return res
 if __name__ == '__main__':
-  run_simulation()
+  parser = argparse.ArgumentParser(description='Simulate the muon imaging of the pyramid.')
+  parser.add_argument('--resume', action='store_true', help='continue the run recorded in the output directory, skipping its finished batches')
+  parser.add_argument('--instrument', action='store_true', help="write stage timings and counters to the log, as the 'instrumentation' setting")
+  parser.add_argument('--profile', nargs='?', const=os.path.join('logs', 'profile.prof'), default=None, metavar='PATH',
+                      help='run the main process under cProfile and save the statistics, the workers are covered by --instrument')
+  arguments = parser.parse_args()
+  if arguments.profile:
+    profiler = cProfile.Profile()
+    profiler.runcall(run_simulation, arguments.resume, arguments.instrument)
+    os.makedirs(os.path.dirname(arguments.profile) or '.', exist_ok=True)
+    profiler.dump_stats(arguments.profile)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+  else:
+    run_simulation(arguments.resume, arguments.instrument)
   #res = run_simulation()
   #print(res)
 
@@ -1,68 +1,104 @@
 
 import numpy as np
-class MuonDetector:
+from pyramid_model import ConvexPolyhedron
+
+# One row per muon and detector it reached, see detect_hits
+HIT_DTYPE = np.dtype([('detector', np.int8), ('muon_id', np.int64), ('position', float, 3), ('direction', float, 3), ('energy', float), ('weight', float)])
+
+class MuonDetector(ConvexPolyhedron):
     def __init__(self, settings, nth_detector):
-        self.position = settings[f'detector_position_{nth_detector}']
-        self.base_vectors = settings[f'detector_base_vectors_{nth_detector}']
-        self.apex = np.array(self.position)
-        self.detected_muons = []  
-        if nth_detector == 1:
-            
-            self.base_area = 120 * 125
-            self.height = 247 - 175
-        else:
-            self.base_area = 120 * 120
-            self.height = 125 - 32
-    def is_inside(self, point):
         """
-        Check if a given point is inside the pyramid.
+        Initialize the MuonDetector class, whose acceptance volume is the pyramid spanned by the apex
+        'detector_position_N' and the four corners 'detector_base_vectors_N'.
 
         Parameters:
-        point (np.array): The coordinates of the point to check.
+        settings (dict): The simulation settings.
+            - 'detector_efficiency' (float): The probability of recording a muon in the volume. Defaults to 0.95.
+        nth_detector (int): The number of the detector, N.
 
         Returns:
-        bool: True if the point is inside the pyramid, False otherwise.
+        None
         """
+        self.number = nth_detector
+        self.position = settings[f'detector_position_{nth_detector}']
+        self.base_vectors = settings[f'detector_base_vectors_{nth_detector}']
+        self.apex = np.array(self.position)
+        self.efficiency = settings.get('detector_efficiency', 0.95)
+        # Own stream per detector, independent of the batch streams of the simulator
+        self.rng = np.random.default_rng(np.random.SeedSequence(settings.get('random_seed'), spawn_key=(nth_detector,)))
 
-        base_corners = [
-            np.array(self.base_vectors[0]),
-            np.array(self.base_vectors[1]),
-            np.array(self.base_vectors[2]),
-            np.array(self.base_vectors[3])
-        ]
-
-        # Calculate the volume of the pyramid
-        pyramid_volume = self.base_area * self.height / 3
-
-        # Calculate the volume of the tetrahedra formed by the point and the faces of the pyramid
-        total_volume = 0
-        for i in range(4):
-            tetra_volume = np.abs(np.dot(np.cross(base_corners[i] - point, base_corners[(i + 1) % 4] - point), self.apex - point)) / 6
-            total_volume += tetra_volume
-
-        # Calculate the volume of the tetrahedra formed by the point and the base
-        base_triangle_1 = [base_corners[0], base_corners[1], base_corners[2]]
-        base_triangle_2 = [base_corners[2], base_corners[3], base_corners[0]]
-        for base_triangle in [base_triangle_1, base_triangle_2]:
-            base_tetra_volume = np.abs(np.dot(np.cross(base_triangle[1] - point, base_triangle[2] - point), base_triangle[0] - point)) / 6
-            total_volume += base_tetra_volume
+        # The four sides, then the base, turned outwards
+        corners = np.asarray(self.base_vectors, dtype=float)
+        apex = self.apex.astype(float)
+        centroid = np.vstack([corners, apex]).mean(axis=0)
+        normals = [np.cross(corners[(i + 1) % 4] - corners[i], apex - corners[i]) for i in range(4)]
+        normals.append(np.cross(corners[1] - corners[0], corners[2] - corners[0]))
+        face_points = np.vstack([corners, corners[:1]])
+        normals = [normal if np.dot(normal, point - centroid) > 0 else -normal for normal, point in zip(normals, face_points)]
+        self._set_faces(normals, face_points, np.vstack([corners, apex]))
 
-        # The point is inside if the total volume of tetrahedra is approximately equal to the pyramid volume
-        return np.isclose(total_volume, pyramid_volume, atol=1e-5)
-    def detect_muon(self, muon):
+    def detect_muon(self, muon, rng=None):
         """
-        Detect a muon and record its information if it passes through the detector.
+        Detect a muon at its position, keeping it with probability equal to the efficiency of the detector.
 
         Parameters:
         muon (Muon): The muon object to detect.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the detector.
 
         Returns:
         bool: True if the muon is detected, False otherwise.
         """
         position, _ , _ = muon
         if self.is_inside(position):
-            detection_probability = 0.95  
-            if np.random.random() < detection_probability:
-                self.detected_muons.append(muon)
-                return True
+            return bool((rng or self.rng).random() < self.efficiency)
         return False
+
+def detect_hits(detectors, records, rng, muon_ids=None):
+    """
+    Find where the simulated paths first enter each detector.
+
+    Every segment between two consecutive rows of a path is clipped against the planes of every
+    detector, so long event-mode segments crossing a detector are found too. Each detector then
+    keeps a hit with probability equal to its efficiency.
+
+    Parameters:
+    detectors (list): The MuonDetector objects.
+    records (np.ndarray): The paths as stacked by paths_to_records, sorted by muon and step.
+    rng (np.random.Generator): The generator of the efficiency draws.
+    muon_ids (np.array, optional): The sorted ids of all muons of the batch. When given, one uniform per
+        muon and detector is drawn up front, so a muon gets the same draw whichever segments it has.
+
+    Returns:
+    np.ndarray: A HIT_DTYPE array sorted by detector and muon, holding the entry point, the direction
+    along the entering segment and the energy interpolated at the entry point. Weights are set to 1,
+    the caller knows the weights of the muons.
+    """
+    uniforms = None if muon_ids is None else rng.random((len(muon_ids), len(detectors)))
+    if len(records) == 0:
+        return np.zeros(0, dtype=HIT_DTYPE)
+    segment_ends = np.flatnonzero(records['step'] > 0)
+    start, end = records[segment_ends - 1], records[segment_ends]
+    displacement = end['position'] - start['position']
+    tables = []
+    for index, detector in enumerate(detectors):
+        t_enter, t_exit = detector.intersection_distances_many(start['position'], displacement)
+        crossed = np.flatnonzero((t_enter <= 1) & (t_exit >= 0))
+        # Segments are in path order, the first crossing of each muon is its entry
+        _, first = np.unique(start['muon_id'][crossed], return_index=True)
+        crossed = crossed[first]
+        if uniforms is None:
+            draws = rng.random(len(crossed))
+        else:
+            draws = uniforms[np.searchsorted(muon_ids, start['muon_id'][crossed]), index]
+        crossed = crossed[draws < detector.efficiency]
+
+        t = np.clip(t_enter[crossed], 0, None)[:, np.newaxis]
+        hits = np.empty(len(crossed), dtype=HIT_DTYPE)
+        hits['detector'] = detector.number
+        hits['muon_id'] = start['muon_id'][crossed]
+        hits['position'] = start['position'][crossed] + t * displacement[crossed]
+        hits['direction'] = start['direction'][crossed]
+        hits['energy'] = start['energy'][crossed] + t[:, 0] * (end['energy'][crossed] - start['energy'][crossed])
+        hits['weight'] = 1
+        tables.append(hits)
+    return np.concatenate(tables) if tables else np.zeros(0, dtype=HIT_DTYPE)
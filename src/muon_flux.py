@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+from cache import atomic_write, cache_directory, settings_digest
+
+EARTH_RADIUS = 6371000 # m
+
+def corrected_cos_zenith(cos_zenith, altitude):
+    """
+    Correct the zenith angle for the curvature of the Earth.
+
+    A muon produced at the given altitude crosses the atmosphere at a smaller angle than the one
+    seen at the ground, sin(theta*) = sin(theta) * R / (R + altitude).
+
+    Parameters:
+    cos_zenith (np.array): The cosines of the zenith angles at the ground.
+    altitude (float): The production altitude in m.
+
+    Returns:
+    np.array: The cosines of the zenith angles at the production altitude.
+    """
+    sin_zenith = np.sqrt(1 - np.asarray(cos_zenith, dtype=float) ** 2)
+    return np.sqrt(1 - (sin_zenith * EARTH_RADIUS / (EARTH_RADIUS + altitude)) ** 2)
+
+def gaisser_flux(energy, cos_zenith):
+    """
+    Calculate the Gaisser parametrisation of the sea-level muon intensity.
+
+    Parameters:
+    energy (np.array): The muon energies in GeV.
+    cos_zenith (np.array): The cosines of the (curvature corrected) zenith angles.
+
+    Returns:
+    np.array: The intensity in 1/(cm^2 s sr GeV).
+    """
+    energy_cos = 1.1 * energy * cos_zenith
+    return 0.14 * energy ** -2.7 * (1 / (1 + energy_cos / 115) + 0.054 / (1 + energy_cos / 850))
+
+def power_law_flux(energy, cos_zenith, spectral_index):
+    """
+    Calculate a factorised intensity E^-index cos^2(zenith).
+
+    Parameters:
+    energy (np.array): The muon energies in GeV.
+    cos_zenith (np.array): The cosines of the zenith angles.
+    spectral_index (float): The spectral index.
+
+    Returns:
+    np.array: The intensity, up to a constant.
+    """
+    return energy ** -spectral_index * cos_zenith ** 2
+
+class MuonFlux:
+    def __init__(self, cos_edges, inverse_cos, inverse_log_energy):
+        """
+        Initialize the MuonFlux class: inverse-CDF tables of the muon flux through a horizontal plane.
+
+        The zenith cosine is drawn from its marginal distribution, then the energy from its
+        distribution within the zenith bin. Both inverse CDFs are tabulated on a regular grid of
+        probabilities, so sampling is linear interpolation in the tables.
+
+        Parameters:
+        cos_edges (np.array): The (n_cos + 1,) edges of the zenith cosine bins.
+        inverse_cos (np.array): The (n_u,) zenith cosines at probabilities linspace(0, 1, n_u).
+        inverse_log_energy (np.array): The (n_cos, n_u) log energies at the same probabilities, per zenith bin.
+
+        Returns:
+        None
+        """
+        self.cos_edges = cos_edges
+        self.inverse_cos = inverse_cos
+        self.inverse_log_energy = inverse_log_energy
+
+    @classmethod
+    def build(cls, intensity, energy_range, cos_range, n_energy=256, n_cos=128, n_u=1024):
+        """
+        Tabulate the inverse CDFs of an intensity.
+
+        Parameters:
+        intensity (callable): The intensity as a function of energy and zenith cosine arrays.
+        energy_range (list): The lowest and highest energy in GeV.
+        cos_range (list): The lowest and highest zenith cosine.
+        n_energy (int): The number of logarithmic energy bins.
+        n_cos (int): The number of zenith cosine bins.
+        n_u (int): The number of probabilities of the inverse tables.
+
+        Returns:
+        MuonFlux: The tables.
+        """
+        log_energy_edges = np.linspace(np.log(energy_range[0]), np.log(energy_range[1]), n_energy + 1)
+        cos_edges = np.linspace(cos_range[0], cos_range[1], n_cos + 1)
+        log_energy = (log_energy_edges[1:] + log_energy_edges[:-1]) / 2
+        cos_zenith = (cos_edges[1:] + cos_edges[:-1]) / 2
+        # Rate through a horizontal plane per bin of (cos, log E): I * cos * E
+        rate = intensity(np.exp(log_energy)[np.newaxis, :], cos_zenith[:, np.newaxis]) * cos_zenith[:, np.newaxis] * np.exp(log_energy)
+
+        probabilities = np.linspace(0, 1, n_u)
+        cos_cdf = np.r_[0, np.cumsum(rate.sum(axis=1))]
+        inverse_cos = np.interp(probabilities, cos_cdf / cos_cdf[-1], cos_edges)
+        energy_cdf = np.hstack([np.zeros((n_cos, 1)), np.cumsum(rate, axis=1)])
+        energy_cdf /= energy_cdf[:, -1:]
+        inverse_log_energy = np.array([np.interp(probabilities, cdf, log_energy_edges) for cdf in energy_cdf])
+        return cls(cos_edges, inverse_cos, inverse_log_energy)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Get the tables of the configured flux from the on-disk cache, building and caching them on first use.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'muon_spectrum' (str): 'gaisser' or 'power_law'. Defaults to 'gaisser'.
+            - 'muon_spectral_index' (float): The index of the power law. Defaults to 2.7.
+            - 'muon_energy_range' (list): The energy range in GeV.
+            - 'muon_zenith_max' (float): The largest zenith angle in degrees. Defaults to 85.
+            - 'muon_altitude' (float): The production altitude of the Gaisser curvature correction in m.
+            - 'cache_dir' (str): The directory of the cache files. Defaults to 'cache'.
+
+        Returns:
+        MuonFlux: The tables.
+        """
+        spectrum = settings.get('muon_spectrum', 'gaisser')
+        spectral_index = settings.get('muon_spectral_index', 2.7)
+        altitude = settings['muon_altitude']
+        energy_range = settings['muon_energy_range']
+        cos_range = [np.cos(np.radians(settings.get('muon_zenith_max', 85))), 1]
+        if spectrum == 'gaisser':
+            intensity = lambda energy, cos_zenith: gaisser_flux(energy, corrected_cos_zenith(cos_zenith, altitude))
+        elif spectrum == 'power_law':
+            intensity = lambda energy, cos_zenith: power_law_flux(energy, cos_zenith, spectral_index)
+        else:
+            raise ValueError(f'Unknown muon spectrum: {spectrum}')
+
+        digest = settings_digest(spectrum, spectral_index, altitude, energy_range, cos_range)
+        path = os.path.join(cache_directory(settings), f'flux-{digest}.npz')
+        if not os.path.exists(path):
+            flux = cls.build(intensity, energy_range, cos_range)
+            atomic_write(path, lambda file: np.savez(file, cos_edges=flux.cos_edges, inverse_cos=flux.inverse_cos,
+                                                     inverse_log_energy=flux.inverse_log_energy))
+        with np.load(path) as tables:
+            return cls(tables['cos_edges'], tables['inverse_cos'], tables['inverse_log_energy'])
+
+    def _lookup(self, table, row, u):
+        # Linear interpolation of inverse CDF rows tabulated at linspace(0, 1, n_u)
+        n_u = table.shape[-1]
+        position = u * (n_u - 1)
+        lower = np.minimum(position.astype(int), n_u - 2)
+        fraction = position - lower
+        table = table.reshape(-1, n_u)
+        return (1 - fraction) * table[row, lower] + fraction * table[row, lower + 1]
+
+    def sample(self, n_muons, rng):
+        """
+        Draw muon energies and directions.
+
+        Parameters:
+        n_muons (int): The number of muons.
+        rng (np.random.Generator): The generator to draw from.
+
+        Returns:
+        tuple: The (n_muons,) energies in GeV and the (n_muons, 3) unit directions of motion, pointing down.
+        """
+        u = rng.random((n_muons, 3))
+        cos_zenith = self._lookup(self.inverse_cos, 0, u[:, 0])
+        # The cosine bins are regular
+        cos_bin = ((cos_zenith - self.cos_edges[0]) * ((len(self.cos_edges) - 1) / (self.cos_edges[-1] - self.cos_edges[0]))).astype(int)
+        log_energy = self._lookup(self.inverse_log_energy, np.clip(cos_bin, 0, len(self.cos_edges) - 2), u[:, 1])
+
+        azimuth = 2 * np.pi * u[:, 2]
+        sin_zenith = np.sqrt(1 - cos_zenith ** 2)
+        directions = np.column_stack([sin_zenith * np.cos(azimuth), sin_zenith * np.sin(azimuth), -cos_zenith])
+        return np.exp(log_energy), directions
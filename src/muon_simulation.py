@@ -1,7 +1,339 @@
 
-from multiprocessing import Pool
+from contextlib import closing, nullcontext
+from cache import settings_digest
+from checkpoint import RunCheckpoint
+import os
+import time
+import warnings
 import numpy as np
 import pandas as pd
+from muon_detector import HIT_DTYPE, detect_hits
+from muon_flux import MuonFlux
+from range_table import RangeTable
+from instrumentation import Instrumentation
+from importance_sampling import StartPointSampler, sample_triangles, subdivide_triangles
+from result_writer import ColumnarWriter, paths_to_records, segments_to_records, to_columns
+from scene import OUTSIDE, ROCK, Scene
+from transport_numba import NUMBA_AVAILABLE, NumbaTransport
+from voxel_grid import VoxelGrid
+
+# One row per generated muon, see MuonSimulator.generate_muon_batch
+MUON_DTYPE = np.dtype([('id', np.int64), ('position', float, 3), ('direction', float, 3), ('energy', float), ('weight', float)])
+# One row per recorded step (or per boundary crossing in event mode) of a trajectory
+PATH_DTYPE = np.dtype([('position', float, 3), ('direction', float, 3), ('energy', float), ('energy_loss', float), ('is_absorbed', bool)])
+# One row per simulated muon, see MuonTrack and MuonSimulator.summarize_paths
+SUMMARY_DTYPE = np.dtype([('id', np.int64), ('entry_position', float, 3), ('exit_position', float, 3), ('exit_direction', float, 3),
+                          ('initial_energy', float), ('final_energy', float), ('is_absorbed', bool), ('is_stopped', bool),
+                          ('opacity', float), ('void_length', float), ('void_time', float), ('n_steps', np.int32), ('weight', float)])
+
+SPEED_OF_LIGHT = 0.299792458 # m/ns
+
+# Steps whose uniforms the fixed-step transport draws at once
+UNIFORM_BLOCK = 64
+
+# Random streams of a batch, see batch_rng
+GENERATION_STREAM = 0
+TRANSPORT_STREAM = 1
+DETECTION_STREAM = 2
+
+def batch_rng(seed, batch_index, stream):
+  """
+  Get the random generator of one stream of one batch.
+
+  The streams are spawned from the seed by batch index, so a batch draws the same numbers
+  whichever process simulates it and however many processes there are.
+
+  Parameters:
+  seed (int): The entropy of the run.
+  batch_index (int): The index of the batch.
+  stream (int): GENERATION_STREAM, TRANSPORT_STREAM or DETECTION_STREAM.
+
+  Returns:
+  np.random.Generator: An independent generator.
+  """
+  return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(batch_index, stream)))
+
+class BatchResult:
+  def __init__(self, batch_index, n_muons, summaries, paths, hits=None, reference_hits=None, metrics=None):
+    """
+    Initialize the BatchResult class, the output of one simulated batch.
+
+    Parameters:
+    batch_index (int): The index of the batch.
+    n_muons (int): The number of muons generated for the batch.
+    summaries (np.ndarray): One SUMMARY_DTYPE row per muon that started inside the pyramid.
+    paths (list): (muon_id, path) pairs, all of them in 'full' record mode, the sampled ones in 'summary' mode.
+    hits (np.ndarray, optional): The HIT_DTYPE detector hits of the batch.
+    reference_hits (np.ndarray, optional): The HIT_DTYPE hits of the same muons in the pyramid without
+        voids, None unless 'transmission_reference' is set.
+    metrics (dict, optional): The stage timings and process id of the worker, None unless 'instrumentation' is set.
+
+    Returns:
+    None
+    """
+    self.batch_index = batch_index
+    self.n_muons = n_muons
+    self.summaries = summaries
+    self.paths = paths
+    self.hits = np.zeros(0, dtype=HIT_DTYPE) if hits is None else hits
+    self.reference_hits = reference_hits
+    self.metrics = metrics
+
+class MuonTrack:
+  def __init__(self, muon_id, position, direction, energy, mean_densities, detectors=(), keep_path=False):
+    """
+    Initialize the MuonTrack class, the summary of one muon accumulated by the transport as it goes.
+
+    Only the last row of the path is kept, with the segment where the muon first enters each
+    detector, from which detect_hits finds the hits afterwards. Segments are only clipped against
+    a detector when they touch its bounding box. Every row is kept only when the path itself is
+    asked for.
+
+    Parameters:
+    muon_id (int): The id of the muon.
+    position (np.array): The start position.
+    direction (np.array): The start direction.
+    energy (float): The start energy.
+    mean_densities (np.array): The mean density of each material, indexable by Scene.locate results.
+    detectors (list): (detector, lower, upper) for each detector, the corners of its bounding box as tuples of floats.
+    keep_path (bool): Keep every row, see path.
+
+    Returns:
+    None
+    """
+    self.muon_id = muon_id
+    self.mean_densities = mean_densities
+    # Detectors the muon has not entered yet
+    self.pending = tuple(detectors)
+    self.entry_position = np.array(position, dtype=float)
+    self.initial_energy = energy
+    self.row = (self.entry_position.copy(), np.array(direction, dtype=float), energy, 0, False)
+    self.point = self.entry_position.tolist()
+    self.rows = [self.row] if keep_path else None
+    self.crossings = []
+    self.final_energy = energy
+    self.is_absorbed = False
+    self.opacity = 0.0
+    self.void_length = 0.0
+    self.n_steps = 0
+
+  def add(self, position, direction, energy, energy_loss, is_absorbed, length, material):
+    """
+    Add one step, or one segment in event mode, to the summary.
+
+    Parameters:
+    position (np.array): The position the step ends at.
+    direction (np.array): The direction after the step.
+    energy (float): The energy after the step.
+    energy_loss (float): The energy lost in the step.
+    is_absorbed (bool): Whether the muon was absorbed in the step.
+    length (float): The length of the step in m.
+    material (int): The material the step went through, as returned by Scene.locate.
+
+    Returns:
+    None
+    """
+    row = (position.copy(), direction.copy(), energy, energy_loss, is_absorbed)
+    if self.pending:
+      point = row[0].tolist()
+      x0, y0, z0 = start = self.point
+      x1, y1, z1 = point
+      entered = None
+      for entry in self.pending:
+        detector, (low_x, low_y, low_z), (high_x, high_y, high_z) = entry
+        # Bounding box first, the planes only for the segments touching it
+        if ((x0 <= high_x or x1 <= high_x) and (x0 >= low_x or x1 >= low_x) and (y0 <= high_y or y1 <= high_y)
+            and (y0 >= low_y or y1 >= low_y) and (z0 <= high_z or z1 <= high_z) and (z0 >= low_z or z1 >= low_z)
+            and detector.segment_intersects(start, point)):
+          entered = (entered or ()) + (entry,)
+      if entered:
+        self.pending = tuple(entry for entry in self.pending if entry not in entered)
+        self.crossings.append((self.row, row))
+      self.point = point
+    if self.rows is not None:
+      self.rows.append(row)
+    self.row = row
+    # m -> cm
+    self.opacity += length * self.mean_densities[material] * 100
+    if material >= 0:
+      self.void_length += length
+    self.n_steps += 1
+    self.final_energy = energy
+    self.is_absorbed = is_absorbed
+
+  def end(self, energy, is_absorbed):
+    """
+    Record how the muon ends in a step the path does not keep, like an absorption in the step model.
+
+    Parameters:
+    energy (float): The energy the muon is left with.
+    is_absorbed (bool): Whether the muon was absorbed.
+
+    Returns:
+    None
+    """
+    self.final_energy = energy
+    self.is_absorbed = is_absorbed
+
+  def summary(self):
+    """
+    Get the summary of the muon.
+
+    Returns:
+    tuple: The fields of a SUMMARY_DTYPE row, with a weight of 1.
+    """
+    is_stopped = self.final_energy <= 0 and not self.is_absorbed
+    return (self.muon_id, self.entry_position, self.row[0], self.row[1], self.initial_energy, self.final_energy, self.is_absorbed,
+            is_stopped, self.opacity, self.void_length, self.void_length / SPEED_OF_LIGHT, self.n_steps, 1)
+
+  def path(self):
+    """
+    Get the recorded path.
+
+    Returns:
+    np.ndarray: The PATH_DTYPE rows, None unless the track keeps its path.
+    """
+    return None if self.rows is None else np.array(self.rows, dtype=PATH_DTYPE)
+
+def collect_tracks(tracks):
+  """
+  Gather the output of the tracks of a batch.
+
+  Parameters:
+  tracks (list): The MuonTrack objects, None entries are skipped.
+
+  Returns:
+  tuple: The SUMMARY_DTYPE rows, the (muon_id, path) pairs of the tracks keeping their path, and
+  the segments entering a detector, stacked by segments_to_records.
+  """
+  tracks = [track for track in tracks if track is not None]
+  summaries = np.array([track.summary() for track in tracks], dtype=SUMMARY_DTYPE)
+  results = [(track.muon_id, track.path()) for track in tracks if track.rows is not None]
+  crossings = [(track.muon_id, start, end) for track in tracks for start, end in track.crossings]
+  crossings = segments_to_records(np.array([muon_id for muon_id, _, _ in crossings], dtype=np.int64),
+                                  np.array([start for _, start, _ in crossings], dtype=PATH_DTYPE),
+                                  np.array([end for _, _, end in crossings], dtype=PATH_DTYPE))
+  return summaries, results, crossings
+
+def in_input_order(muons, results):
+  """
+  Line up the paths of a batch with its muons.
+
+  Parameters:
+  muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+  results (list): (muon_id, path) pairs.
+
+  Returns:
+  list: (muon_id, path) for each muon in input order, None for muons without a path.
+  """
+  paths = dict(results)
+  return [(int(muon_id), paths[int(muon_id)]) if int(muon_id) in paths else None for muon_id in muons['id']]
+
+class TrajectoryStatistics:
+  def __init__(self):
+    """
+    Initialize the TrajectoryStatistics class, running counts over simulated batches.
+
+    Returns:
+    None
+    """
+    self.n_muons = 0
+    self.n_outside = 0
+    self.n_absorbed = 0
+    self.n_stopped = 0
+    self.n_steps = 0
+    self.n_hits = {}
+    self.weighted_hits = {}
+
+  def update(self, batch):
+    """
+    Add the results of one batch.
+
+    Parameters:
+    batch (BatchResult): The simulated batch.
+
+    Returns:
+    None
+    """
+    summaries = batch.summaries
+    self.n_muons += batch.n_muons
+    self.n_outside += batch.n_muons - len(summaries)
+    self.n_absorbed += int(summaries['is_absorbed'].sum())
+    self.n_stopped += int(summaries['is_stopped'].sum())
+    self.n_steps += int(summaries['n_steps'].sum())
+    for detector in np.unique(batch.hits['detector']):
+      hits = batch.hits[batch.hits['detector'] == detector]
+      self.n_hits[int(detector)] = self.n_hits.get(int(detector), 0) + len(hits)
+      self.weighted_hits[int(detector)] = self.weighted_hits.get(int(detector), 0) + float(hits['weight'].sum())
+
+class RunMetrics:
+  def __init__(self):
+    """
+    Initialize the RunMetrics class, the counters and stage timings of an instrumented run.
+
+    Returns:
+    None
+    """
+    self.statistics = TrajectoryStatistics()
+    self.n_detected = 0
+    self.stages = {}
+    self.workers = {}
+    self.start = time.perf_counter()
+
+  def update(self, batch, timings):
+    """
+    Add the results of one batch.
+
+    Parameters:
+    batch (BatchResult): The simulated batch, with the metrics of its worker.
+    timings (dict): The seconds spent per stage in this process since the previous batch.
+
+    Returns:
+    dict: The fields of the batch event.
+    """
+    summaries = batch.summaries
+    metrics = dict(batch.metrics or {})
+    worker = metrics.pop('worker', None)
+    stages = {**metrics, **timings}
+    n_detected = len(np.unique(batch.hits['muon_id']))
+    self.statistics.update(batch)
+    self.n_detected += n_detected
+    self.add_timings(stages)
+    counts = self.workers.setdefault(str(worker), {'batches': 0, 'muons': 0, 'seconds': 0.0})
+    counts['batches'] += 1
+    counts['muons'] += batch.n_muons
+    counts['seconds'] += sum(metrics.values())
+    return {'batch_index': batch.batch_index, 'worker': worker, 'n_muons': batch.n_muons, 'n_steps': int(summaries['n_steps'].sum()),
+            'n_outside': batch.n_muons - len(summaries), 'n_absorbed': int(summaries['is_absorbed'].sum()),
+            'n_stopped': int(summaries['is_stopped'].sum()), 'n_detected': n_detected, 'stages': stages}
+
+  def add_timings(self, timings):
+    """
+    Add stage timings that belong to no batch, like the output written once all batches are done.
+
+    Parameters:
+    timings (dict): The seconds spent per stage.
+
+    Returns:
+    None
+    """
+    for stage, seconds in timings.items():
+      self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+  def totals(self):
+    """
+    Summarize the run.
+
+    Returns:
+    dict: The fields of the run event: the counters, the seconds per stage summed over the processes,
+    the wall time and the muons per second of each worker.
+    """
+    statistics = self.statistics
+    throughput = {worker: dict(counts, muons_per_second=counts['muons'] / counts['seconds'] if counts['seconds'] else None)
+                  for worker, counts in self.workers.items()}
+    return {'n_muons': statistics.n_muons, 'n_steps': statistics.n_steps, 'n_outside': statistics.n_outside,
+            'n_absorbed': statistics.n_absorbed, 'n_stopped': statistics.n_stopped, 'n_detected': self.n_detected,
+            'stages': self.stages, 'wall_time': time.perf_counter() - self.start, 'workers': throughput}
 
 class MuonSimulator:
   def __init__(self, settings, pyramid, cavity, detectors):
@@ -17,6 +349,7 @@ class MuonSimulator:
     Returns:
     None
     """
+    self.settings = settings
     self.altitude = settings['muon_altitude']
     self.energy_range = settings['muon_energy_range']
     self.pyramid = pyramid
@@ -29,9 +362,44 @@ class MuonSimulator:
     self.step_size = settings['muon_step_size']
     self.detector_1 = detectors[0]
     self.detector_2 = detectors[1]
+    self.detectors = list(detectors)
+    # Segments outside these boxes cannot reach a detector, see MuonTrack
+    self.detector_boxes = []
+    for detector in self.detectors:
+      lower, upper = detector.bounds()
+      self.detector_boxes.append((detector, tuple((lower - detector.tolerance).tolist()), tuple((upper + detector.tolerance).tolist())))
     self.scattering_strength_in_cavity = settings['muon_scattering_strength_in_cavity']
     self.scattering_strength_in_other_material = settings['muon_scattering_strength_in_other_material']
-  def random_position_on_side(self, side):
+    self.scene = Scene.from_settings(settings, pyramid, cavity)
+    self.voxel_grid = VoxelGrid.from_settings(settings, self.scene) if settings.get('use_voxel_grid', False) else None
+    self.max_steps = 1500
+    self.transport_mode = settings.get('muon_transport_mode', 'step')
+    self.energy_loss_model = settings.get('energy_loss_model', 'step')
+    self.range_table = RangeTable.from_settings(settings)
+    if self.energy_loss_model == 'csda' and self.transport_mode != 'event':
+      warnings.warn(f"energy_loss_model 'csda' only applies to the 'event' transport mode, the '{self.transport_mode}' mode keeps the step model")
+    self.transport_backend = settings.get('transport_backend', 'numpy')
+    if self.transport_backend == 'numba' and not NUMBA_AVAILABLE:
+      warnings.warn("transport_backend 'numba' needs numba, falling back to 'numpy'")
+      self.transport_backend = 'numpy'
+    self.numba_transport = NumbaTransport(self) if self.transport_backend == 'numba' else None
+    self.output_path = settings.get('output_path', os.path.join('results', 'muon_simulation'))
+    self.output_format = settings.get('output_format', 'npz')
+    self.batch_size = settings.get('muon_batch_size', 1000)
+    self.record_mode = settings.get('record_mode', 'full')
+    self.path_sample_every = settings.get('path_sample_every', 0)
+    # Without a seed every run draws fresh entropy, which the workers then share through the batch streams
+    self.seed = settings.get('random_seed')
+    if self.seed is None:
+      self.seed = np.random.SeedSequence().entropy
+    self.rng = np.random.default_rng(self.seed)
+    self.sampling = settings.get('muon_sampling', 'nominal')
+    self.start_sampler = self.detector_start_sampler(settings) if self.sampling == 'detector' else None
+    self.flux = MuonFlux.from_settings(settings) if self.sampling == 'flux' else None
+    self.transmission_reference = settings.get('transmission_reference', False)
+    self._reference_simulator = None
+    self.instrumentation = Instrumentation.from_settings(settings)
+  def random_position_on_side(self, side, rng=None):
 
         base_corner1 = np.array([0, 0, 0])
         base_corner2 = np.array([self.pyramid.base_length, 0, 0])
@@ -49,117 +417,920 @@ class MuonSimulator:
             vertices = [base_corner4, base_corner1, apex]
 
 
-        r1, r2 = np.random.random(), np.random.random()
+        rng = rng or self.rng
+        r1, r2 = rng.random(2)
         if r1 + r2 > 1:
             r1 = 1 - r1
             r2 = 1 - r2
         position = r1 * vertices[0] + r2 * vertices[1] + (1 - r1 - r2) * vertices[2]
         return position
 
-  def generate_muons(self, n_muons):
-      muons = []
-      for _ in range(n_muons):
-          face_choice = np.random.choice(['side1', 'side2', 'side3', 'side4'])
-          position = self.random_position_on_side(face_choice)
-          direction = self.random_direction_towards_center(position)
-
-          energy = np.random.uniform(self.energy_range[0], self.energy_range[1])
-          muons.append((position, direction, energy))
-      return [(i, muon) for i, muon in enumerate(muons)]
-  def random_direction_towards_center(self, position):
+  def generate_muons(self, n_muons, rng=None):
+      muons = self.generate_muon_batch(n_muons, rng=rng)
+      return [(int(muon['id']), (muon['position'].copy(), muon['direction'].copy(), float(muon['energy']))) for muon in muons]
+
+  def generate_muon_batch(self, n_muons, start_id=0, rng=None):
+      """
+      Generate a batch of muons in one vectorized pass.
+
+      Parameters:
+      n_muons (int): The number of muons to generate.
+      start_id (int): The id given to the first muon of the batch.
+      rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+
+      Returns:
+      np.ndarray: A structured array of dtype MUON_DTYPE holding the id, position, direction, energy and weight
+      of each muon. The weights are 1 unless start points are biased towards the detectors or drawn from the flux.
+      """
+      rng = rng or self.rng
+      muons = np.zeros(n_muons, dtype=MUON_DTYPE)
+      muons['id'] = np.arange(start_id, start_id + n_muons)
+      if self.flux is not None:
+          muons['energy'], muons['direction'] = self.flux.sample(n_muons, rng)
+          muons['position'], muons['weight'] = self.flux_start_points(muons['direction'], rng)
+          return muons
+
+      if self.start_sampler is None:
+          # Uniform point on a randomly chosen side face (same folding trick as random_position_on_side)
+          vertices = self._side_vertices()[rng.integers(0, 4, n_muons)]
+          positions = sample_triangles(vertices, n_muons, rng)
+          muons['weight'] = 1
+      else:
+          positions, muons['weight'] = self.start_sampler.sample(n_muons, rng)
+
+      center = np.array([self.pyramid.base_length / 2, self.pyramid.base_length / 2, self.pyramid.height / 2])
+      directions = center - positions + rng.uniform(-1, 1, (n_muons, 3))
+      directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+      muons['position'] = positions
+      muons['direction'] = directions
+      muons['energy'] = rng.uniform(self.energy_range[0], self.energy_range[1], n_muons)
+      return muons
+
+  def flux_start_points(self, directions, rng):
+      """
+      Find where muons of the given directions, uniform over a horizontal plane, enter the pyramid.
+
+      Each muon crosses the ground plane z = 0 at a uniform point of the smallest rectangle holding
+      the shadow of the pyramid along its direction, and is traced back to its entry point. The
+      rectangle grows with the zenith angle, so the weight is its area over the base area. Muons
+      whose line misses the pyramid stay at their ground point, outside of it.
+
+      Parameters:
+      directions (np.array): The (N, 3) downward unit directions.
+      rng (np.random.Generator): The generator to draw from.
+
+      Returns:
+      tuple: The (N, 3) start points and their (N,) weights.
+      """
+      base_length, height = self.pyramid.base_length, self.pyramid.height
+      apex_shadow = self.pyramid.apex[:2] + directions[:, :2] * height / -directions[:, 2:]
+      lower = np.minimum(apex_shadow, 0)
+      upper = np.maximum(apex_shadow, base_length)
+      ground = np.column_stack([lower + rng.random((len(directions), 2)) * (upper - lower), np.zeros(len(directions))])
+
+      # Going back up the line, the far crossing is where the muon came in
+      _, t_exit = self.pyramid.intersection_distances_many(ground, -directions)
+      hit = np.nan_to_num(t_exit, nan=-1) >= 0
+      positions = ground.copy()
+      positions[hit] = ground[hit] - directions[hit] * t_exit[hit, np.newaxis]
+      return positions, np.prod(upper - lower, axis=1) / base_length ** 2
+
+  def detector_start_sampler(self, settings):
+      """
+      Build the sampler of start points biased towards the detectors.
+
+      Each side face is split into equal-area cells. The importance of a cell is the chance that a
+      muon from its centre, aimed at the pyramid centre like generate_muon_batch does, has enough
+      energy to cross the rock up to each detector it points through, summed over the detectors.
+      With the 'csda' energy loss model the energy needed comes from the range table and the
+      opacity up to the detector, see straight_line_fate.
+
+      Parameters:
+      settings (dict): The simulation settings.
+          - 'importance_grid_divisions' (int): The divisions of each side edge, giving divisions^2 cells per side. Defaults to 32.
+          - 'importance_biased_fraction' (float): The share of the start points that follows the importance. Defaults to 0.9.
+
+      Returns:
+      StartPointSampler: The sampler.
+      """
+      cells = subdivide_triangles(self._side_vertices(), settings.get('importance_grid_divisions', 32))
+      origins = cells.mean(axis=1)
+      center = np.array([self.pyramid.base_length / 2, self.pyramid.base_length / 2, self.pyramid.height / 2])
+      directions = center - origins
+      directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+      loss_per_metre = self.mean_energy_loss_per_metre(self.material_density)
+      low, high = self.energy_range
+      rays = np.zeros(len(cells), dtype=MUON_DTYPE)
+      rays['position'] = origins
+      rays['direction'] = directions
+      importance = np.zeros(len(cells))
+      for detector in self.detectors:
+          t_enter, t_exit = detector.intersection_distances_many(origins, directions)
+          distance = np.clip(np.nan_to_num(t_enter, nan=np.inf), 0, None)
+          if self.energy_loss_model == 'csda':
+              opacity, _, _ = self.straight_line_fate(rays, distance)
+              needed = self.range_table.energy(opacity)
+          else:
+              needed = loss_per_metre * distance
+          reach = np.clip((high - needed) / (high - low), 0, 1)
+          importance += np.where(np.nan_to_num(t_exit, nan=-1) >= 0, reach, 0)
+      return StartPointSampler(cells, importance, settings.get('importance_biased_fraction', 0.9))
+
+  def _side_vertices(self):
+      """
+      Get the vertices of the four side faces of the pyramid.
+
+      Returns:
+      np.ndarray: An array of shape (4, 3, 3), ordered like 'side1' to 'side4' in random_position_on_side.
+      """
+      base_length = self.pyramid.base_length
+      base_corners = np.array([[0, 0, 0], [base_length, 0, 0], [base_length, base_length, 0], [0, base_length, 0]], dtype=float)
+      apex = np.array([base_length / 2, base_length / 2, self.pyramid.height])
+      return np.array([[base_corners[i], base_corners[(i + 1) % 4], apex] for i in range(4)])
+  def random_direction_towards_center(self, position, rng=None):
       center = np.array([self.pyramid.base_length / 2, self.pyramid.base_length / 2, self.pyramid.height / 2])
 
       direction = center - position
 
-      random_perturbation = np.random.uniform(-1, 1, 3)  
+      random_perturbation = (rng or self.rng).uniform(-1, 1, 3)
       direction += random_perturbation 
 
       direction /= np.linalg.norm(direction)  
 
       return direction
-  def simulate_muon_trajectory(self, muon):
+  def simulate_muon_trajectory(self, muon, rng=None):
+        track = self.track_muon_steps(muon, rng, keep_path=True)
+        return None if track is None else (track.muon_id, track.path())
+
+  def track_muon_steps(self, muon, rng=None, keep_path=False):
+        """
+        Transport one muon with the fixed-step model, accumulating its summary step by step.
+
+        Parameters:
+        muon (tuple): (muon_id, (position, direction, energy)), the position and direction are integrated in place.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+        keep_path (bool): Record every step, see MuonTrack.path.
+
+        Returns:
+        MuonTrack: The track of the muon, None if it starts outside the pyramid.
+        """
         muon_id, (position, direction, energy) = muon
-        energy_loss = 0
-        is_absorbed = False
-        if not self.pyramid.is_inside(position):
+        material = self._locate(position)
+        if material == OUTSIDE:
             return None
 
-        max_steps = 1500
-        dtype = [('position', float, 3), ('direction', float, 3), ('energy', float), ('energy_loss', float), ('is_absorbed', bool)]
-        path = np.zeros(max_steps, dtype=dtype) 
-        path[0] = (position, direction, energy, energy_loss, is_absorbed)
+        rng = rng or self.rng
+        track = MuonTrack(muon_id, position, direction, energy, self.scene.mean_densities, self.detector_boxes, keep_path)
         step_count = 1
 
-        while self.pyramid.is_inside(position) and step_count < max_steps:
+        while material != OUTSIDE and step_count < self.max_steps:
+            block_row = (step_count - 1) % UNIFORM_BLOCK
+            if block_row == 0:
+                # One row of uniforms per step: absorption, density, thickness and the three scattering components
+                uniforms = rng.random((UNIFORM_BLOCK, 6))
+            step_uniforms = uniforms[block_row]
+            previous_position = position.copy()
             position += direction * self.step_size
-            path[step_count]['position'] = position
-            path[step_count]['is_absorbed'] = False
-            length = self.pyramid.calculate_length(path[step_count - 1]['position'], position)
+            length = self.pyramid.calculate_length(previous_position, position)
 
-            if np.random.random() < self.absorption_probability(length):
-                path[step_count]['is_absorbed'] = True
+            if step_uniforms[0] < self.absorption_probability(length):
+                track.end(energy, True)
                 break
-            if self.cavity.is_inside(position):
-                energy, energy_loss = self.calculate_energy_loss(energy, [0.00001, 0.0001])
-                random_perturbation = np.random.uniform(-self.scattering_strength_in_cavity, self.scattering_strength_in_cavity, direction.shape)
+            material = self._locate(position)
+            # The step leaving the pyramid still goes through rock, as in the single-material model
+            energy, energy_loss = self.calculate_energy_loss(energy, self.scene.density_ranges[max(material, ROCK)], step_uniforms[1:3])
+            if material >= 0:
+                random_perturbation = self.scattering_strength_in_cavity * (2 * step_uniforms[3:] - 1)
                 direction += random_perturbation
                 direction /= np.linalg.norm(direction)
             else:
-                energy, energy_loss = self.calculate_energy_loss(energy, self.material_density)
-                random_perturbation = np.random.uniform(-self.scattering_strength_in_other_material, self.scattering_strength_in_other_material, direction.shape)
+                random_perturbation = self.scattering_strength_in_other_material * (2 * step_uniforms[3:] - 1)
                 direction += random_perturbation
                 direction /= np.linalg.norm(direction)
 
-            path[step_count]['direction'] = direction
-            path[step_count]['energy'] = energy
-            path[step_count]['energy_loss'] = energy_loss
             if energy <= 0:
+                track.end(energy, False)
+                break
+            track.add(position, direction, energy, energy_loss, False, length, material)
+            step_count += 1
+
+        return track
+
+  def simulate_muon_trajectory_event(self, muon, rng=None):
+        """
+        Simulate the trajectory of a muon by jumping from one material boundary to the next, see track_muon_events.
+
+        Parameters:
+        muon (tuple): (muon_id, (position, direction, energy)), as for simulate_muon_trajectory.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+
+        Returns:
+        tuple: (muon_id, path) with one PATH_DTYPE row per segment, or None if the muon starts outside the pyramid.
+        """
+        track = self.track_muon_events(muon, rng, keep_path=True)
+        return None if track is None else (track.muon_id, track.path())
+
+  def track_muon_events(self, muon, rng=None, keep_path=False):
+        """
+        Transport one muon by jumping from one material boundary to the next, accumulating its summary segment by segment.
+
+        Inside a homogeneous segment the muon goes straight, loses the mean energy of the
+        step model integrated over the segment length (or, with the 'csda' energy loss model,
+        the energy given by the range table), and is absorbed at an exponentially
+        distributed distance. The scattering of the skipped steps is applied as one Gaussian
+        kick with the same variance when the segment ends.
+
+        Parameters:
+        muon (tuple): (muon_id, (position, direction, energy)), as for simulate_muon_trajectory.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+        keep_path (bool): Record every segment, see MuonTrack.path.
+
+        Returns:
+        MuonTrack: The track of the muon, None if it starts outside the pyramid.
+        """
+        muon_id, (position, direction, energy) = muon
+        if not self.pyramid.is_inside(position):
+            return None
+
+        rng = rng or self.rng
+        position = np.array(position, dtype=float)
+        direction = np.array(direction, dtype=float)
+        track = MuonTrack(muon_id, position, direction, energy, self.scene.mean_densities, self.detector_boxes, keep_path)
+        remaining = (self.max_steps - 1) * self.step_size
+
+        while remaining > 0:
+            exit_distance = self.pyramid.exit_distance(position, direction)
+            segment = min(exit_distance, self.scene.next_boundary(position, direction), remaining)
+
+            material = self.scene.locate(position + direction * segment / 2)
+            density = self.scene.density_ranges[material]
+            scattering_strength = self.scattering_strength_in_cavity if material >= 0 else self.scattering_strength_in_other_material
+
+            if self.energy_loss_model == 'csda':
+                # g/cm^2 per m
+                opacity_per_metre = np.mean(density) * 100
+                exhaustion_distance = float(self.range_table.range(energy)) / opacity_per_metre
+            else:
+                loss_per_metre = self.mean_energy_loss_per_metre(density)
+                exhaustion_distance = energy / loss_per_metre if loss_per_metre > 0 else np.inf
+            absorption_distance = rng.exponential(self.mean_free_path)
+            length = min(segment, exhaustion_distance, absorption_distance)
+
+            position = position + direction * length
+            if self.energy_loss_model == 'csda':
+                energy_loss = energy - float(self.range_table.energy_after(energy, opacity_per_metre * length))
+            else:
+                energy_loss = min(loss_per_metre * length, energy)
+            energy -= energy_loss
+            remaining -= length
+            is_absorbed = length == absorption_distance
+            if length == exhaustion_distance:
+                energy = 0
+
+            if not is_absorbed and energy > 0:
+                # Sum of length / step_size uniform kicks of half-width scattering_strength
+                sigma = scattering_strength * np.sqrt(length / self.step_size / 3)
+                direction = direction + rng.normal(0, sigma, 3)
+                direction /= np.linalg.norm(direction)
+
+            track.add(position, direction, energy, energy_loss, is_absorbed, length, material)
+            if is_absorbed or energy <= 0 or length >= exit_distance:
                 break
 
+        return track
+
+  def simulate_muons_lockstep(self, muons, rng=None):
+        """
+        Simulate a batch of muons in lock-step, see transport_lockstep.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+
+        Returns:
+        list: (muon_id, path) for each muon in input order, None for muons starting outside the pyramid.
+        """
+        _, results, _ = self.transport_lockstep(muons, rng)
+        return in_input_order(muons, results)
+
+  def transport_lockstep(self, muons, rng=None, keep=None):
+        """
+        Transport a batch of muons in lock-step, advancing every live muon by one step at a time.
+
+        Same step model as track_muon_steps, applied to (N, 3) position and direction arrays, the
+        summaries are accumulated in arrays step by step. Muons are dropped from the working arrays
+        as soon as they are absorbed, run out of energy or leave the pyramid, the first two without
+        a row for their last step.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+        keep (np.array, optional): (N,) booleans, the muons whose path is recorded. Defaults to all of them.
+
+        Returns:
+        tuple: As collect_tracks, the summaries and paths in input order.
+        """
+        rng = rng or self.rng
+        keep = np.ones(len(muons), dtype=bool) if keep is None else np.asarray(keep)
+        material = self._locate_many(muons['position'])
+        started = np.flatnonzero(material != OUTSIDE)
+        # From here on muons are numbered by their index in started
+        live = np.arange(started.size)
+        material = material[started]
+        position = muons['position'][started].copy()
+        direction = muons['direction'][started].copy()
+        energy = muons['energy'][started].copy()
+        energy_loss = np.zeros(started.size)
+
+        summaries = np.zeros(started.size, dtype=SUMMARY_DTYPE)
+        summaries['id'] = muons['id'][started]
+        summaries['entry_position'] = position
+        summaries['exit_position'] = position
+        summaries['exit_direction'] = direction
+        summaries['initial_energy'] = energy
+        summaries['final_energy'] = energy
+        summaries['weight'] = 1
+        opacity, void_length, n_steps = np.zeros(started.size), np.zeros(started.size), np.zeros(started.size, dtype=np.int32)
+
+        # Rows of the kept paths and of the segments entering a detector are collected per step and sorted by muon at the end
+        kept = keep[started]
+        steps, owners = [np.zeros(kept.sum(), dtype=int)], [np.flatnonzero(kept)]
+        records = [self._path_rows(position[kept], direction[kept], energy[kept], energy_loss[kept], np.zeros(kept.sum(), dtype=bool))]
+        segment_steps, segment_owners, segment_starts, segment_ends = [], [], [], []
+        mean_densities = self.scene.mean_densities
+        box_lower = np.array([lower for _, lower, _ in self.detector_boxes]).reshape(-1, 3)
+        box_upper = np.array([upper for _, _, upper in self.detector_boxes]).reshape(-1, 3)
+        pending = np.ones((started.size, len(self.detector_boxes)), dtype=bool)
+        absorption_probability = self.absorption_probability(self.step_size)
+        step_count = 1
+        while step_count < self.max_steps:
+            inside = material != OUTSIDE
+            live, position, direction, energy, energy_loss, material = (live[inside], position[inside], direction[inside], energy[inside],
+                                                                        energy_loss[inside], material[inside])
+            n_live = live.size
+            if n_live == 0:
+                break
+
+            start_position = position
+            position = position + direction * self.step_size
+            # Same six uniforms per muon and step as track_muon_steps, drawn for every started muon so
+            # that a muon gets the same numbers whichever other muons are still alive
+            uniforms = rng.random((started.size, 6))[live]
+            is_absorbed = uniforms[:, 0] < absorption_probability
+            step_material = self._locate_many(position)
+            in_void = step_material >= 0
+
+            # The step leaving the pyramid still goes through rock, as in track_muon_steps
+            step_loss = self.step_energy_loss(self.scene.density_ranges[np.maximum(step_material, ROCK)], uniforms[:, 1], uniforms[:, 2])
+            start_rows = self._path_rows(start_position, direction, energy, energy_loss, np.zeros(n_live, dtype=bool))
+            scattering_strength = np.where(in_void, self.scattering_strength_in_cavity, self.scattering_strength_in_other_material)
+            direction = direction + (2 * uniforms[:, 3:] - 1) * scattering_strength[:, np.newaxis]
+            direction /= np.linalg.norm(direction, axis=1)[:, np.newaxis]
+
+            summaries['final_energy'][live] = np.where(is_absorbed, energy, np.maximum(energy - step_loss, 0))
+            summaries['is_absorbed'][live] = is_absorbed
+            # Absorbed and stopped muons end without a row for this step
+            moved = ~is_absorbed & (energy > step_loss)
+            live, start_position, start_rows, position, direction, energy, step_loss, step_material, in_void = (
+                live[moved], start_position[moved], start_rows[moved], position[moved], direction[moved], energy[moved],
+                step_loss[moved], step_material[moved], in_void[moved])
+            energy = energy - step_loss
+            energy_loss = step_loss
+            end_rows = self._path_rows(position, direction, energy, energy_loss, np.zeros(live.size, dtype=bool))
+
+            opacity[live] += self.step_size * mean_densities[step_material] * 100
+            void_length[live] += self.step_size * in_void
+            n_steps[live] += 1
+            summaries['exit_position'][live] = position
+            summaries['exit_direction'][live] = direction
+
+            step_kept = kept[live]
+            if step_kept.any():
+                steps.append(np.full(step_kept.sum(), step_count))
+                owners.append(live[step_kept])
+                records.append(end_rows[step_kept])
+            near = pending[live] & np.all((np.minimum(start_position, position)[:, np.newaxis] <= box_upper)
+                                          & (np.maximum(start_position, position)[:, np.newaxis] >= box_lower), axis=2)
+            entering = np.zeros(live.size, dtype=bool)
+            for index, (detector, _, _) in enumerate(self.detector_boxes):
+                candidates = np.flatnonzero(near[:, index])
+                if candidates.size:
+                    t_enter, t_exit = detector.intersection_distances_many(start_position[candidates], (position - start_position)[candidates])
+                    crossed = candidates[(t_enter <= 1) & (t_exit >= 0)]
+                    pending[live[crossed], index] = False
+                    entering[crossed] = True
+            if entering.any():
+                segment_steps.append(np.full(entering.sum(), step_count))
+                segment_owners.append(live[entering])
+                segment_starts.append(start_rows[entering])
+                segment_ends.append(end_rows[entering])
             step_count += 1
+            material = step_material
+
+        summaries['opacity'] = opacity
+        summaries['void_length'] = void_length
+        summaries['void_time'] = void_length / SPEED_OF_LIGHT
+        summaries['n_steps'] = n_steps
+        summaries['is_stopped'] = (summaries['final_energy'] <= 0) & ~summaries['is_absorbed']
+
+        owners = np.concatenate(owners)
+        order = np.lexsort((np.concatenate(steps), owners))
+        owners = owners[order]
+        records = np.concatenate(records)[order]
+        first_rows = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if owners.size else np.array([], dtype=int)
+        results = [(int(summaries['id'][owner]), path) for owner, path in zip(owners[first_rows], np.split(records, first_rows[1:]))]
+
+        if segment_owners:
+            segment_owners = np.concatenate(segment_owners)
+            order = np.lexsort((np.concatenate(segment_steps), segment_owners))
+            crossings = segments_to_records(summaries['id'][segment_owners[order]], np.concatenate(segment_starts)[order],
+                                            np.concatenate(segment_ends)[order])
+        else:
+            crossings = segments_to_records(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=PATH_DTYPE), np.zeros(0, dtype=PATH_DTYPE))
+        return summaries, results, crossings
+
+  def _locate(self, position):
+        """
+        Find the material at a point, from the voxel grid when it is enabled.
+        """
+        if self.voxel_grid is None:
+            return self.scene.locate(position)
+        # Containment stays exact, voxels cut by the pyramid surface would lose the starting points
+        if not self.pyramid.is_inside(position):
+            return OUTSIDE
+        return max(self.voxel_grid.locate(position), ROCK)
+
+  def _locate_many(self, points):
+        """
+        Find the material at each point of an (N, 3) array, from the voxel grid when it is enabled.
+        """
+        if self.voxel_grid is None:
+            return self.scene.locate_many(points)
+        return np.where(self.pyramid.is_inside_many(points), np.maximum(self.voxel_grid.locate_many(points), ROCK), OUTSIDE)
+
+  def _path_rows(self, position, direction, energy, energy_loss, is_absorbed):
+        rows = np.empty(len(energy), dtype=PATH_DTYPE)
+        rows['position'] = position
+        rows['direction'] = direction
+        rows['energy'] = energy
+        rows['energy_loss'] = energy_loss
+        rows['is_absorbed'] = is_absorbed
+        return rows
+
+  def simulation_pool(self, pool=None, n_processes=8):
+        """
+        Get a context manager for the worker pool of a call.
+
+        Parameters:
+        pool (SimulationPool, optional): A pool kept by the caller, left open on exit.
+        n_processes (int): The number of worker processes of a new pool.
+
+        Returns:
+        A context manager giving pool, or a new SimulationPool for the settings that is closed on exit.
+        """
+        if pool is not None:
+            return nullcontext(pool)
+        # worker_pool imports this module
+        from worker_pool import SimulationPool
+        return SimulationPool(self.settings, n_processes)
 
-        return muon_id, path[:step_count]  
-  def simulate_muons_parallel(self, n_muons, n_processes=8):
-        muons = self.generate_muons(n_muons)
-        muon_splits = np.array_split(muons, n_processes)
+  def default_batch_size(self, n_muons, n_processes):
+        """
+        Get the batch size of a run, the 'muon_batch_size' setting unless it would leave workers idle.
 
-        with Pool(n_processes) as pool:
-            results = pool.map(self.simulate_muon_trajectories_batch, muon_splits)
+        Parameters:
+        n_muons (int): The number of muons of the run.
+        n_processes (int): The number of worker processes.
 
-        all_results = np.concatenate(results)
-        self.write_results_to_csv(all_results)
+        Returns:
+        int: The smaller of the setting and ceil(n_muons / n_processes), at least 1.
+        """
+        return max(1, min(self.batch_size, -(-n_muons // n_processes)))
+
+  def simulate_muons_parallel(self, n_muons, n_processes=8, pool=None):
+        """
+        Simulate muons over worker processes and write all their paths at once.
+
+        With 'instrumentation' set, a batch event is logged as each batch arrives and a run event
+        at the end, as in simulate_muons_streaming.
+
+        Parameters:
+        n_muons (int): The number of muons to simulate.
+        n_processes (int): The number of worker processes, ignored when a pool is given.
+        pool (SimulationPool, optional): A pool to reuse, built for the settings of this simulator.
+
+        Returns:
+        list: (muon_id, path) pairs of the recorded paths, in batch order.
+        """
+        n_processes = pool.n_processes if pool is not None else n_processes
+        instrumentation = self.instrumentation
+        run_metrics = RunMetrics() if instrumentation.enabled else None
+        batches = []
+        for batch in self.iter_muon_batches(n_muons, n_processes, self.default_batch_size(n_muons, n_processes), pool):
+            batches.append(batch)
+            if run_metrics is not None:
+                instrumentation.emit('batch', **run_metrics.update(batch, instrumentation.take_timings()))
+        batches.sort(key=lambda batch: batch.batch_index)
+
+        all_results = [result for batch in batches for result in batch.paths]
+        with instrumentation.stage('output'):
+            self.write_results(all_results)
+        if run_metrics is not None:
+            run_metrics.add_timings(instrumentation.take_timings())
+            instrumentation.emit('run', output_path=self.output_path, n_batches=len(batches), **run_metrics.totals())
 
         return all_results
 
-  def simulate_muon_trajectories_batch(self, muon_batch):
-      return [self.simulate_muon_trajectory(muon) for muon in muon_batch]
+  def simulate_batch(self, muons, batch_index=0, seed=None):
+        """
+        Simulate a batch of muons and reduce it to the configured record mode.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        batch_index (int): The index of the batch.
+        seed (int, optional): The entropy of the run, defaults to the seed of the simulator. The transport
+            draws from the TRANSPORT_STREAM of the batch and the detector efficiency from its DETECTION_STREAM.
+
+        Returns:
+        BatchResult: The summaries and detector hits of all muons, with every path in 'full' record mode
+        and only the paths of muons whose id is a multiple of 'path_sample_every' in 'summary' mode.
+        """
+        instrumentation = self.instrumentation
+        seed = self.seed if seed is None else seed
+        with instrumentation.stage('transport'):
+            summaries, results, crossings = self.transport(muons, batch_rng(seed, batch_index, TRANSPORT_STREAM), self.kept_paths(muons))
+        with instrumentation.stage('detection'):
+            hits = detect_hits(self.detectors, crossings, batch_rng(seed, batch_index, DETECTION_STREAM), muons['id'])
+        # Ids of a batch are sorted
+        summaries['weight'] = muons['weight'][np.searchsorted(muons['id'], summaries['id'])]
+        hits['weight'] = muons['weight'][np.searchsorted(muons['id'], hits['muon_id'])]
+        reference_hits = None
+        if self.transmission_reference:
+            with instrumentation.stage('reference'):
+                reference_hits = self.reference_hits(muons, batch_index, seed)
+        metrics = dict(instrumentation.take_timings(), worker=os.getpid()) if instrumentation.enabled else None
+        return BatchResult(batch_index, len(muons), summaries, results, hits, reference_hits, metrics)
+
+  def kept_paths(self, muons):
+        """
+        Select the muons whose path is recorded in the configured record mode.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+
+        Returns:
+        np.array: (N,) booleans, all True in 'full' mode, True for the ids that are multiples of
+        'path_sample_every' in 'summary' mode.
+        """
+        if self.record_mode != 'summary':
+            return np.ones(len(muons), dtype=bool)
+        if not self.path_sample_every:
+            return np.zeros(len(muons), dtype=bool)
+        return muons['id'] % self.path_sample_every == 0
+
+  @property
+  def reference_simulator(self):
+    """
+    The simulator of the same pyramid without voids, built on first use.
+
+    Returns:
+    MuonSimulator: The void-free simulator, sharing the detectors and the seed.
+    """
+    if self._reference_simulator is None:
+      settings = dict(self.settings, scene_voids=[], transmission_reference=False, random_seed=self.seed)
+      self._reference_simulator = MuonSimulator(settings, self.pyramid, self.cavity, self.detectors)
+    return self._reference_simulator
+
+  def reference_hits(self, muons, batch_index=0, seed=None):
+        """
+        Detect the hits of a batch transported through the pyramid without voids.
 
-  def write_results_to_csv(self, results):
-      
-      records = []
-      for muon_id, path in results:
-          for step in path:
-              position, direction, energy, energy_loss, is_absorbed = step['position'], step['direction'], step['energy'], step['energy_loss'], step['is_absorbed']
-              records.append([muon_id, position, direction, energy, energy_loss, is_absorbed])
+        The transport and detection restart the TRANSPORT_STREAM and DETECTION_STREAM of the batch, and
+        every kernel hands each muon its own numbers (see transport), so a muon draws the same numbers
+        in both runs whatever the other muons do. Its steps only differ from where it meets a void,
+        and most of the fluctuations cancel in the ratio of the two runs.
 
-      df = pd.DataFrame(records, columns=['Muon_ID', 'Position', 'Direction', 'Energy', 'Energy_Loss', 'Is_Absorbed'])
-      df.to_csv('muon_simulation_results.csv', index=False)
-  
-  def calculate_energy_loss(self, initial_energy, material_density):
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        batch_index (int): The index of the batch.
+        seed (int, optional): The entropy of the run, defaults to the seed of the simulator.
+
+        Returns:
+        np.ndarray: The HIT_DTYPE hits, weighted like those of simulate_batch.
+        """
+        reference = self.reference_simulator
+        seed = self.seed if seed is None else seed
+        # Only the hits are needed, no path is recorded
+        _, _, crossings = reference.transport(muons, batch_rng(seed, batch_index, TRANSPORT_STREAM), np.zeros(len(muons), dtype=bool))
+        hits = detect_hits(self.detectors, crossings, batch_rng(seed, batch_index, DETECTION_STREAM), muons['id'])
+        hits['weight'] = muons['weight'][np.searchsorted(muons['id'], hits['muon_id'])]
+        return hits
+
+  def summarize_paths(self, results, records=None):
+        """
+        Reduce recorded paths to one fixed-size record per muon.
+
+        The transport accumulates these records itself, see MuonTrack, this is for paths read back
+        from disk. It only differs in the opacity of the steps crossing a material boundary, and in
+        the fate of muons absorbed or stopped in the fixed-step modes, whose last step has no row.
+
+        Parameters:
+        results (list): (muon_id, path) pairs as returned by the transport, None entries are skipped.
+        records (np.ndarray, optional): paths_to_records(results), when the caller already has it.
+
+        Returns:
+        np.ndarray: A SUMMARY_DTYPE array. The opacity (g/cm^2) uses the mean density of the material
+        at the middle of each segment, void_length (m) and void_time (ns) cover the segments in a void.
+        """
+        results = [result for result in results if result is not None]
+        summaries = np.zeros(len(results), dtype=SUMMARY_DTYPE)
+        if not results:
+            return summaries
+        if records is None:
+            records = paths_to_records(results)
+        lengths = np.array([len(path) for _, path in results])
+        last = np.cumsum(lengths) - 1
+        first = last - lengths + 1
+
+        summaries['id'] = [muon_id for muon_id, _ in results]
+        summaries['entry_position'] = records['position'][first]
+        summaries['exit_position'] = records['position'][last]
+        summaries['exit_direction'] = records['direction'][last]
+        summaries['initial_energy'] = records['energy'][first]
+        summaries['final_energy'] = records['energy'][last]
+        summaries['is_absorbed'] = records['is_absorbed'][last]
+        summaries['is_stopped'] = (records['energy'][last] <= 0) & ~records['is_absorbed'][last]
+        summaries['n_steps'] = lengths - 1
+
+        segment_ends = np.flatnonzero(records['step'] > 0)
+        start, end = records['position'][segment_ends - 1], records['position'][segment_ends]
+        segment_lengths = np.linalg.norm(end - start, axis=1)
+        material = self._locate_many((start + end) / 2)
+        owners = np.repeat(np.arange(len(results)), lengths)[segment_ends]
+        # m -> cm
+        summaries['opacity'] = np.bincount(owners, segment_lengths * self.scene.mean_densities[material] * 100, minlength=len(results))
+        summaries['void_length'] = np.bincount(owners, segment_lengths * (material >= 0), minlength=len(results))
+        summaries['void_time'] = summaries['void_length'] / SPEED_OF_LIGHT
+        return summaries
+
+  def iter_muon_batches(self, n_muons, n_processes=8, batch_size=None, pool=None, completed=()):
+        """
+        Simulate muons batch by batch and yield each batch as soon as it is done.
+
+        Batches are generated only when a worker slot is free, so memory does not grow with n_muons.
+        Batch i holds the muons with ids from i * batch_size and draws from its own random streams,
+        so the results depend on the seed and batch size only, not on the number of processes.
+
+        Parameters:
+        n_muons (int): The number of muons to simulate.
+        n_processes (int): The number of worker processes of a new pool.
+        batch_size (int, optional): The number of muons per batch, defaults to the 'muon_batch_size' setting.
+        pool (SimulationPool, optional): A pool to reuse, built for the settings of this simulator.
+        completed (set): The indices of batches to skip, e.g. those finished before a resume.
+
+        Yields:
+        BatchResult: The simulated batches in completion order.
+        """
+        if pool is not None and settings_digest(pool.settings) != settings_digest(self.settings):
+            # The workers rebuild their simulator from the pool settings, see SimulationPool
+            raise ValueError('The pool was built for other settings than the ones of this simulator')
+        batch_size = batch_size or self.batch_size
+        batches = (self._generate_indexed_batch(start, min(batch_size, n_muons - start), batch_size)
+                   for start in range(0, n_muons, batch_size) if start // batch_size not in completed)
+        with self.simulation_pool(pool, n_processes) as pool:
+            yield from pool.map_batches(batches, seed=self.seed)
+
+  def _generate_indexed_batch(self, start, n_muons, batch_size):
+        with self.instrumentation.stage('generation'):
+            batch_index = start // batch_size
+            return batch_index, self.generate_muon_batch(n_muons, start_id=start, rng=batch_rng(self.seed, batch_index, GENERATION_STREAM))
+
+  def simulate_muons_streaming(self, n_muons, n_processes=8, output_path=None, accumulators=(), batch_size=None, pool=None, resume=False,
+                               stop=None, report=None):
+        """
+        Simulate muons in batches, writing each finished batch and handing it to accumulators before dropping it.
+
+        The summaries go to 'summaries' chunks, the detector hits to 'hits' chunks and the recorded
+        paths to 'trajectories' chunks of output_path, one chunk per batch index. After each batch
+        the accumulators are checkpointed with the run manifest, see RunCheckpoint. With a stopping
+        criterion n_muons is an upper bound, the run ends after the first batch that reaches it.
+
+        Parameters:
+        n_muons (int): The number of muons to simulate.
+        n_processes (int): The number of worker processes.
+        output_path (str, optional): The output directory, defaults to the 'output_path' setting.
+        accumulators (list): Objects whose update(batch) method is called with each BatchResult.
+        batch_size (int, optional): The number of muons per batch, defaults to the 'muon_batch_size' setting.
+        pool (SimulationPool, optional): A pool to reuse, built for the settings of this simulator.
+        resume (bool): Continue the run recorded in output_path: restore the accumulators, keep the
+            chunks of its finished batches and simulate the others with its seed.
+        stop (object, optional): A criterion with reached() and describe() methods, checked after every
+            batch, e.g. a RelativeErrorTarget on a TransmissionMap among the accumulators.
+        report (callable, optional): Called after every batch with a line giving the number of muons
+            done and the running estimate of stop.
+
+        Returns:
+        int: The number of batches simulated.
+        """
+        output_path = output_path or self.output_path
+        batch_size = batch_size or self.batch_size
+        os.makedirs(output_path, exist_ok=True)
+        checkpoint = RunCheckpoint.start(output_path, self.settings, self.seed, n_muons, batch_size, accumulators, resume)
+        self.seed = checkpoint.run['seed']
+        summary_writer = ColumnarWriter(output_path, 'summaries')
+        hit_writer = ColumnarWriter(output_path, 'hits')
+        path_writer = None
+        for batch_index in sorted(checkpoint.completed):
+            summary_writer.adopt(batch_index)
+            hit_writer.adopt(batch_index)
+            trajectory_writer = path_writer or ColumnarWriter(output_path, 'trajectories')
+            if trajectory_writer.adopt(batch_index):
+                path_writer = trajectory_writer
+        n_batches = 0
+        instrumentation = self.instrumentation
+        run_metrics = RunMetrics() if instrumentation.enabled else None
+        # Closing the batches at the criterion terminates a pool of our own, dropping the batches
+        # still running, while a pool passed in finishes them and reuses their slots
+        with closing(self.iter_muon_batches(n_muons, n_processes, batch_size, pool, checkpoint.completed)) as batches:
+            for batch in batches:
+                with instrumentation.stage('output'):
+                    summary_writer.write(batch.summaries, chunk=batch.batch_index)
+                    hit_writer.write(batch.hits, chunk=batch.batch_index)
+                    if batch.paths:
+                        path_writer = path_writer or ColumnarWriter(output_path, 'trajectories')
+                        path_writer.write(paths_to_records(batch.paths), chunk=batch.batch_index)
+                    for accumulator in accumulators:
+                        accumulator.update(batch)
+                    checkpoint.save(batch.batch_index, accumulators)
+                n_batches += 1
+                if run_metrics is not None:
+                    instrumentation.emit('batch', **run_metrics.update(batch, instrumentation.take_timings()))
+                if stop is not None:
+                    if report is not None:
+                        n_done = sum(min(batch_size, n_muons - index * batch_size) for index in checkpoint.completed)
+                        report(f'{n_done} muons: {stop.describe()}')
+                    if stop.reached():
+                        break
+        summary_writer.close()
+        hit_writer.close()
+        if path_writer is not None:
+            path_writer.close()
+        if run_metrics is not None:
+            instrumentation.emit('run', output_path=output_path, n_batches=n_batches, **run_metrics.totals())
+        return n_batches
+
+  def simulate_muon_trajectories_batch(self, muon_batch, rng=None):
+      """
+      Simulate the trajectories of a batch of muons.
+
+      Parameters:
+      muon_batch (np.ndarray): A structured array of dtype MUON_DTYPE.
+      rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+
+      Returns:
+      list: The result of simulate_muon_trajectory for each muon.
+      """
+      _, results, _ = self.transport(muon_batch, rng)
+      return in_input_order(muon_batch, results)
+
+  def transport(self, muons, rng=None, keep=None):
+      """
+      Transport a batch of muons with the configured mode and backend.
+
+      Every kernel accumulates the summary of each muon while it goes, and only the muons in keep
+      get a path buffer, so the memory of a batch does not grow with the number of steps.
+
+      The random numbers of a muon do not depend on the other muons: the step and event modes and
+      the compiled kernel draw one seed per muon up front, and the lock-step mode draws a block for
+      every started muon at each step. Two runs from the same generator state, like the reference
+      run of reference_hits, thus hand every muon the same numbers.
+
+      Parameters:
+      muons (np.ndarray): A structured array of dtype MUON_DTYPE, left unchanged.
+      rng (np.random.Generator, optional): The generator to draw from, defaults to the one of the simulator.
+      keep (np.array, optional): (N,) booleans, the muons whose path is recorded. Defaults to all of them.
+
+      Returns:
+      tuple: The SUMMARY_DTYPE rows of the muons starting inside the pyramid, in input order and with
+      weights of 1, their (muon_id, path) pairs for the kept ones, and the segments where they first
+      enter each detector, for detect_hits.
+      """
+      rng = rng or self.rng
+      keep = np.ones(len(muons), dtype=bool) if keep is None else np.asarray(keep, dtype=bool)
+      # The compiled kernel implements the fixed-step model of both 'step' and 'lockstep'
+      if self.numba_transport is not None and self.transport_mode != 'event':
+          return self.numba_transport.transport(muons, rng, keep)
+      if self.transport_mode == 'lockstep':
+          return self.transport_lockstep(muons, rng, keep)
+      track_muon = self.track_muon_events if self.transport_mode == 'event' else self.track_muon_steps
+      seeds = rng.integers(2 ** 32, size=len(muons))
+      # Copies, the trajectory is integrated in place
+      return collect_tracks([track_muon((int(muon['id']), (muon['position'].copy(), muon['direction'].copy(), float(muon['energy']))),
+                                        np.random.default_rng(muon_seed), bool(keep_path))
+                             for muon, keep_path, muon_seed in zip(muons, keep, seeds)])
+
+  def write_results(self, results, output_path=None):
+      """
+      Write the simulated paths in the configured output format.
+
+      Parameters:
+      results (list): (muon_id, path) pairs as returned by the transport.
+      output_path (str, optional): The output directory, defaults to the 'output_path' setting.
+
+      Returns:
+      None
+      """
+      output_path = output_path or self.output_path
+      if self.output_format == 'csv':
+          self.write_results_to_csv(results, os.path.join(output_path, 'trajectories.csv'))
+          return
+      with ColumnarWriter(output_path) as writer:
+          writer.write(paths_to_records(results))
+
+  def write_results_to_csv(self, results, path='muon_simulation_results.csv'):
+      """
+      Write the simulated paths to a CSV file, one row per step with one column per coordinate.
+
+      Parameters:
+      results (list): (muon_id, path) pairs as returned by the transport.
+      path (str): The path of the CSV file.
+
+      Returns:
+      None
+      """
+      directory = os.path.dirname(path)
+      if directory:
+          os.makedirs(directory, exist_ok=True)
+      pd.DataFrame(to_columns(paths_to_records(results))).to_csv(path, index=False)
+
+  def calculate_energy_loss(self, initial_energy, material_density, uniforms=None):
       """
       Calculate the energy loss of a muon in the material.
 
       Parameters:
       initial_energy (float): The initial energy of the muon in MeV.
       material_density (float): The density of the material in g/cm^3.
+      uniforms (np.array, optional): Two uniform numbers in [0, 1) for the density and the thickness, drawn from the simulator generator if not given.
       Returns:
       float: The final energy of the muon after passing through the material.
       """
-
-      energy_loss = self.energy_loss_per_g_cm2 * np.random.uniform(material_density[0], material_density[1]) * np.random.uniform(self.thickness_range[0], self.thickness_range[1]) * self.step_size * 100 * 0.001 # Convert to GeV convert to cm
+      if uniforms is None:
+          uniforms = self.rng.random(2)
+      energy_loss = self.step_energy_loss(material_density, uniforms[0], uniforms[1])
       #radiation_loss = initial_energy * (1 - np.exp(- self.step_size / (self.radiation_length / self.material_density)))
       total_loss = energy_loss #+ radiation_loss
       final_energy = max(initial_energy - total_loss, 0)  # Ensure energy does not go negative
       return final_energy, total_loss
+  def step_energy_loss(self, material_density, density_uniform, thickness_uniform):
+      """
+      Calculate the energy loss of one step from uniform numbers, the density and thickness being uniform in their ranges.
+
+      Parameters:
+      material_density (np.array): The density range of the material in g/cm^3, or an (N, 2) array of ranges.
+      density_uniform (float or np.array): Uniform numbers in [0, 1) for the density.
+      thickness_uniform (float or np.array): Uniform numbers in [0, 1) for the thickness.
+
+      Returns:
+      float or np.array: The energy loss in GeV.
+      """
+      material_density = np.asarray(material_density)
+      density = material_density[..., 0] + density_uniform * (material_density[..., 1] - material_density[..., 0])
+      thickness = self.thickness_range[0] + thickness_uniform * (self.thickness_range[1] - self.thickness_range[0])
+      return self.energy_loss_per_g_cm2 * density * thickness * self.step_size * 100 * 0.001 # Convert to GeV convert to cm
+  def straight_line_fate(self, muons, distances=None):
+      """
+      Decide in one lookup how far muons get along straight lines, with the range table.
+
+      Parameters:
+      muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+      distances (np.array, optional): (N,) distances in m to stop at, instead of the pyramid exit.
+
+      Returns:
+      tuple: The (N,) opacities in g/cm^2 between the start points and the pyramid exit, or the given
+      distances, the energies left there and booleans, True for the muons that get there.
+      """
+      void_lengths = self.scene.void_lengths_many(muons['position'], muons['direction'], distances)
+      entry, exit = self.pyramid.entry_exit_distances_many(muons['position'], muons['direction'])
+      if distances is not None:
+          exit = np.maximum(np.minimum(exit, distances), entry)
+      rock_lengths = np.nan_to_num(exit - entry) - void_lengths.sum(axis=1)
+      mean_densities = self.scene.mean_densities
+      # m -> cm
+      opacity = (rock_lengths * mean_densities[ROCK] + void_lengths @ mean_densities[:len(self.scene.objects)]) * 100
+      energy = self.range_table.energy_after(muons['energy'], opacity)
+      return opacity, energy, energy > 0
+  def mean_energy_loss_per_metre(self, material_density):
+      """
+      Calculate the mean energy loss per metre of the step model of calculate_energy_loss.
+
+      Parameters:
+      material_density (list): The density range of the material in g/cm^3.
+
+      Returns:
+      float: The mean energy loss in GeV per metre.
+      """
+      return self.energy_loss_per_g_cm2 * np.mean(material_density) * np.mean(self.thickness_range) * 100 * 0.001
   def absorption_probability(self, length):
     return 1 - np.exp(-length / self.mean_free_path)
\ No newline at end of file
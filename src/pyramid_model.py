@@ -3,176 +3,257 @@ from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 import matplotlib.pyplot as plt
 import numpy as np
 
-class Pyramid:
-  def __init__(self, base_length, height):
+def _halfspace_contains(normals, offsets, points, tolerance):
+  """
+  Check which points satisfy every half-space normal . x <= offset of a convex solid.
+
+  Parameters:
+  normals (np.array): The (M, 3) outward unit normals of the bounding planes.
+  offsets (np.array): The (M,) plane offsets.
+  points (np.array): The (N, 3) coordinates of the points to check.
+  tolerance (float): The distance outside a plane still counted as inside.
+
+  Returns:
+  np.array: (N,) booleans, True for the points inside the solid.
+  """
+  return np.all(np.asarray(points, dtype=float) @ normals.T - offsets <= tolerance, axis=1)
+
+def _halfspace_intersections(normals, offsets, origins, directions, tolerance):
+  """
+  Intersect rays with a convex solid given by half-spaces normal . x <= offset.
+
+  Parameters:
+  normals (np.array): The (M, 3) outward unit normals of the bounding planes.
+  offsets (np.array): The (M,) plane offsets.
+  origins (np.array): The (N, 3) starting positions of the rays.
+  directions (np.array): The (N, 3) directions of the rays.
+  tolerance (float): The distance outside a plane still counted as inside.
+
+  Returns:
+  tuple: (t_enter, t_exit) arrays of shape (N,), the ray parameters where each line enters and
+  leaves the solid. Parameters are negative for crossings behind the origin, NaN for lines that miss the solid.
+  """
+  origins = np.asarray(origins, dtype=float)
+  directions = np.asarray(directions, dtype=float)
+  denominators = directions @ normals.T
+  distances = offsets - origins @ normals.T
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = distances / denominators
+  t_enter = np.max(np.where(denominators < 0, t, -np.inf), axis=1)
+  t_exit = np.min(np.where(denominators > 0, t, np.inf), axis=1)
+
+  # Rays parallel to a plane and outside of it never get in
+  outside_parallel = np.any((denominators == 0) & (distances < -tolerance), axis=1)
+  missed = outside_parallel | (t_exit < t_enter)
+  t_enter[missed] = np.nan
+  t_exit[missed] = np.nan
+  return t_enter, t_exit
+
+class ConvexPolyhedron:
+  """
+  Base class of the solids bounded by planes: the pyramid, the chambers and the grand gallery.
+
+  Subclasses describe their faces with _set_faces and get the containment and ray tests from here.
+  """
+  def _set_faces(self, normals, face_points, vertices):
     """
-    Initialize the Pyramid class.
+    Precompute the bounding planes of the solid.
 
     Parameters:
-    base_length (float): The length of the base of the pyramid.
-    height (float): The height of the pyramid.
+    normals (list): The outward normals of the faces, not necessarily normalized.
+    face_points (list): One point on each face.
+    vertices (list): The vertices of the solid, used for its bounding box.
 
     Returns:
     None
     """
-    self.base_length = base_length
-    self.height = height
-    self.center = np.array([base_length / 2, base_length / 2, 0])  
+    normals = np.asarray(normals, dtype=float)
+    # Inside <=> normal . x <= offset for every face
+    self.face_normals = normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    self.face_offsets = np.einsum('ij,ij->i', self.face_normals, np.asarray(face_points, dtype=float))
+    self.vertices = np.asarray(vertices, dtype=float)
+    self.tolerance = 1e-9 * np.max(np.ptp(self.vertices, axis=0))
+    # Plain floats for the scalar segment test of the per-muon transport
+    self._planes = tuple(zip(map(tuple, self.face_normals.tolist()), self.face_offsets.tolist()))
 
   def is_inside(self, point):
     """
-    Check if a given point is inside the pyramid.
+    Check if a given point is inside the solid.
 
     Parameters:
     point (np.array): The coordinates of the point to check.
 
     Returns:
-    bool: True if the point is inside the pyramid, False otherwise.
+    bool: True if the point is inside the solid (surface included), False otherwise.
     """
-    apex = np.array([self.base_length / 2, self.base_length / 2, self.height])
-    base_corners = [
-        np.array([0, 0, 0]),
-        np.array([self.base_length, 0, 0]),
-        np.array([self.base_length, self.base_length, 0]),
-        np.array([0, self.base_length, 0])
-    ]
-
-    # Calculate the volume of the pyramid
-    pyramid_volume = self.base_length ** 2 * self.height / 3
-
-    # Calculate the volume of the tetrahedra formed by the point and the faces of the pyramid
-    total_volume = 0
-    for i in range(4):
-        tetra_volume = np.abs(np.dot(np.cross(base_corners[i] - point, base_corners[(i + 1) % 4] - point), apex - point)) / 6
-        total_volume += tetra_volume
-
-    # Calculate the volume of the tetrahedra formed by the point and the base
-    base_triangle_1 = [base_corners[0], base_corners[1], base_corners[2]]
-    base_triangle_2 = [base_corners[2], base_corners[3], base_corners[0]]
-    for base_triangle in [base_triangle_1, base_triangle_2]:
-        base_tetra_volume = np.abs(np.dot(np.cross(base_triangle[1] - point, base_triangle[2] - point), base_triangle[0] - point)) / 6
-        total_volume += base_tetra_volume
-
-    # The point is inside if the total volume of tetrahedra is approximately equal to the pyramid volume
-    return np.isclose(total_volume, pyramid_volume, atol=1e-5)
+    return bool(_halfspace_contains(self.face_normals, self.face_offsets, np.reshape(point, (1, 3)), self.tolerance)[0])
 
-  def calculate_length(self, position_1, position_2):
+  def is_inside_many(self, points):
     """
-    Calculate the length between two points.
+    Check which of the given points are inside the solid.
 
     Parameters:
-    position_1 (np.array): The coordinates of the first point.
-    position_2 (np.array): The coordinates of the second point.
+    points (np.array): The (N, 3) coordinates of the points to check.
 
     Returns:
-    float: The length between the two points.
+    np.array: (N,) booleans, True for the points inside the solid (surface included).
     """
-    return np.linalg.norm(np.array(position_1) - np.array(position_2))
-
-  def path_length(self, position, direction):
-      """
-      Calculate the path length of a ray inside the pyramid.
+    return _halfspace_contains(self.face_normals, self.face_offsets, points, self.tolerance)
 
-      Parameters:
-      position (np.array): The starting position of the ray.
-      direction (np.array): The direction of the ray.
+  def intersection_distances_many(self, origins, directions):
+    """
+    Calculate where rays enter and leave the solid.
 
-      Returns:
-      float: The path length of the ray inside the pyramid.
-      """
-      intersection_distances = []
-      for face in self._pyramid_faces():
-          distance = self._intersect_face(face, position, direction)
-          if distance is not None:
-              intersection_distances.append(distance)
+    Parameters:
+    origins (np.array): The (N, 3) starting positions of the rays.
+    directions (np.array): The (N, 3) directions of the rays.
 
-      if len(intersection_distances) >= 2:
-          # Get the smallest and largest distances which represent the entry and exit points
-          entry_distance = min(intersection_distances)
-          exit_distance = max(intersection_distances)
-          return exit_distance - entry_distance
-      else:
-          return 0  # Handle cases with fewer than 2 intersections appropriately
+    Returns:
+    tuple: (t_enter, t_exit) arrays of shape (N,) with t_enter <= t_exit, NaN for rays that miss the solid.
+    Parameters are negative for crossings behind the starting positions.
+    """
+    return _halfspace_intersections(self.face_normals, self.face_offsets, origins, directions, self.tolerance)
 
+  def segment_intersects(self, start, end):
+    """
+    Check if a segment touches the solid, the scalar form of intersection_distances_many.
 
+    Parameters:
+    start (list): The 3 coordinates where the segment starts, as floats.
+    end (list): The 3 coordinates where it ends, as floats.
 
-  def _pyramid_faces(self):
+    Returns:
+    bool: True if some point of the segment is inside the solid (surface included).
+    """
+    x, y, z = start
+    dx, dy, dz = end[0] - x, end[1] - y, end[2] - z
+    t_enter, t_exit = 0.0, 1.0
+    for (nx, ny, nz), offset in self._planes:
+      denominator = nx * dx + ny * dy + nz * dz
+      distance = offset - (nx * x + ny * y + nz * z)
+      if denominator < 0:
+        t = distance / denominator
+        if t > t_enter:
+          t_enter = t
+      elif denominator > 0:
+        t = distance / denominator
+        if t < t_exit:
+          t_exit = t
+      elif distance < -self.tolerance:
+        return False
+    return t_enter <= t_exit
+
+  def bounds(self):
     """
-    Get the faces of the pyramid.
+    Get the axis-aligned bounding box of the solid.
 
     Returns:
-    list: A list of tuples representing the faces of the pyramid.
-    Each tuple contains three points representing a face.
+    tuple: The (3,) lower and upper corners of the box.
     """
-    apex = np.array([self.base_length / 2, self.base_length / 2, self.height])
-    base_corners = [
-      np.array([0, 0, 0]),
-      np.array([self.base_length, 0, 0]),
-      np.array([self.base_length, self.base_length, 0]),
-      np.array([0, self.base_length, 0])
-    ]
-    base_faces = [(base_corners[0], base_corners[1], base_corners[2]),
-                  (base_corners[0], base_corners[2], base_corners[3])]
-    return [(apex, base_corners[i], base_corners[(i + 1) % 4]) for i in range(4)] + base_faces
-  
-
-  def _intersect_face(self, face, position, direction):
-      # Extract the points of the face (triangle)
-      apex, corner1, corner2 = face
+    return self.vertices.min(axis=0), self.vertices.max(axis=0)
 
-      # Compute the normal vector to the face
-      normal = np.cross(corner2 - corner1, apex - corner1)
-      normal = normal / np.linalg.norm(normal)  # Normalize the normal vector
-
-      # Check if the ray is parallel to the face
-      dot_product = np.dot(normal, direction)
-      if np.isclose(dot_product, 0, atol=1e-6):
-          return None  # Ray is parallel, no intersection
-
-      # Calculate the intersection parameter
-      t = np.dot(normal, corner1 - position) / dot_product
-      if t < 0:
-          return None  # Intersection behind the ray's start, ignore
+class Pyramid(ConvexPolyhedron):
+  def __init__(self, base_length, height):
+    """
+    Initialize the Pyramid class.
 
-      # Calculate the intersection point
-      intersect_point = position + [t * d for d in direction]
+    Parameters:
+    base_length (float): The length of the base of the pyramid.
+    height (float): The height of the pyramid.
 
-      # Check if the intersection point is within the triangle
-      if self._point_in_triangle(intersect_point, apex, corner1, corner2):
-          return t
+    Returns:
+    None
+    """
+    self.base_length = base_length
+    self.height = height
+    self.center = np.array([base_length / 2, base_length / 2, 0])
+    self.apex = np.array([base_length / 2, base_length / 2, height], dtype=float)
+    self.base_corners = np.array([[0, 0, 0], [base_length, 0, 0], [base_length, base_length, 0], [0, base_length, 0]], dtype=float)
 
-      return None
+    # The four sides, then the base
+    normals = [np.cross(self.base_corners[(i + 1) % 4] - self.base_corners[i], self.apex - self.base_corners[i]) for i in range(4)]
+    normals.append([0, 0, -1])
+    self._set_faces(normals, np.vstack([self.base_corners, self.base_corners[:1]]), np.vstack([self.base_corners, self.apex]))
 
-  def _point_in_triangle(self, point, vertex1, vertex2, vertex3):
+  def calculate_length(self, position_1, position_2):
     """
-    Check if a point is inside a triangle.
+    Calculate the length between two points.
 
     Parameters:
-    point (list): The coordinates of the point to check.
-    vertex1 (list): The coordinates of the first vertex of the triangle.
-    vertex2 (list): The coordinates of the second vertex of the triangle.
-    vertex3 (list): The coordinates of the third vertex of the triangle.
+    position_1 (np.array): The coordinates of the first point.
+    position_2 (np.array): The coordinates of the second point.
 
     Returns:
-    bool: True if the point is inside the triangle, False otherwise.
+    float: The length between the two points.
     """
-    def sign(p1, p2, p3):
-      return (p1[0] - p3[0]) * (p2[1] - p3[1]) - (p2[0] - p3[0]) * (p1[1] - p3[1])
+    return np.linalg.norm(np.array(position_1) - np.array(position_2))
 
-    d1 = sign(point, vertex1, vertex2)
-    d2 = sign(point, vertex2, vertex3)
-    d3 = sign(point, vertex3, vertex1)
+  def path_length(self, position, direction):
+      """
+      Calculate the path length of a ray inside the pyramid.
 
-    has_neg = (d1 < 0) or (d2 < 0) or (d3 < 0)
-    has_pos = (d1 > 0) or (d2 > 0) or (d3 > 0)
+      Parameters:
+      position (np.array): The starting position of the ray.
+      direction (np.array): The direction of the ray.
 
-    return not (has_neg and has_pos)
-# do not use this class
-# its too complicated
-class Chamber:
+      Returns:
+      float: The path length of the ray inside the pyramid, counted from the starting position if it is inside. 0 if the ray misses the pyramid.
+      """
+      t_enter, t_exit = self.entry_exit_distances_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))
+      return np.nan_to_num(t_exit - t_enter)[0] * np.linalg.norm(direction)
+
+  def entry_exit_distances_many(self, origins, directions):
+      """
+      Calculate where rays enter and leave the pyramid.
+
+      Parameters:
+      origins (np.array): The (N, 3) starting positions of the rays.
+      directions (np.array): The (N, 3) directions of the rays.
+
+      Returns:
+      tuple: (t_enter, t_exit) arrays of shape (N,), the ray parameters of the entry and exit points,
+      distances only for unit directions. They are clipped to the part of each ray in front of its
+      origin, and both are NaN for rays that miss the pyramid.
+      """
+      t_enter, t_exit = self.intersection_distances_many(origins, directions)
+      t_enter = np.maximum(t_enter, 0)
+      behind = t_exit < t_enter
+      t_enter[behind] = np.nan
+      t_exit[behind] = np.nan
+      return t_enter, t_exit
+
+  def exit_distance(self, position, direction):
+      """
+      Calculate the distance from a point inside the pyramid to the surface along a ray.
+
+      Parameters:
+      position (np.array): The starting position of the ray, inside the pyramid.
+      direction (np.array): The unit direction of the ray.
+
+      Returns:
+      float: The distance to the surface, 0 if the ray does not go through the pyramid.
+      """
+      _, t_exit = self.entry_exit_distances_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))
+      return np.nan_to_num(t_exit)[0]
+
+class Chamber(ConvexPolyhedron):
     def __init__(self, center, dimensions):
+        """
+        Initialize the Chamber class, an axis-aligned box.
+
+        Parameters:
+        center (list): The coordinates of the chamber center.
+        dimensions (list): The [width, depth, height] of the chamber along x, y and z.
+
+        Returns:
+        None
+        """
         self.center = np.array(center)
         self.dimensions = dimensions  # dimensions = [width, depth, height]
+        half = np.asarray(dimensions, dtype=float) / 2
+        corners = self.center + half * np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+        normals = np.vstack([np.eye(3), -np.eye(3)])
+        self._set_faces(normals, self.center + normals * np.tile(half, 2).reshape(2, 3).repeat(3, axis=0), corners)
 
     def does_ray_intersect(self, position, direction):
         # This method checks for intersection with an axis-aligned bounding box
@@ -221,107 +302,76 @@ class Chamber:
             return 0  # No intersection or intersection behind the ray
 
         return t_max - t_min
-# do not use this class
-# its too complicated
-class GrandGallery:
+class GrandGallery(ConvexPolyhedron):
     def __init__(self, base_center, height, length, width_bottom, width_top, incline_angle):
-        self.base_center = np.array(base_center)
+        """
+        Initialize the GrandGallery class.
+
+        The gallery starts at base_center (middle of its floor) and runs along +y for length metres,
+        its floor rising by tan(incline_angle) per metre. Its width goes linearly from width_bottom
+        to width_top along the gallery and its height is vertical, as drawn by visualize_pyramid.
+
+        Parameters:
+        base_center (list): The coordinates of the middle of the lower end of the floor.
+        height (float): The vertical height of the gallery.
+        length (float): The horizontal length of the gallery along y.
+        width_bottom (float): The width at the lower end.
+        width_top (float): The width at the upper end.
+        incline_angle (float): The incline of the floor in degrees, negative for a descending gallery.
+
+        Returns:
+        None
+        """
+        self.base_center = np.array(base_center, dtype=float)
         self.height = height
         self.length = length
         self.width_bottom = width_bottom
         self.width_top = width_top
         self.incline_angle = incline_angle
-        self.calculate_normals()
 
-    def calculate_normals(self):
-        self.incline_normal = np.array([0, np.cos(np.radians(self.incline_angle)), -np.sin(np.radians(self.incline_angle))])
-        self.bottom_normal = np.array([0, -1, 0])
-        self.top_normal = np.array([0, 1, 0])
-        self.side_normals = [
-            np.cross(self.incline_normal, [1, 0, 0]),  
-            np.cross([1, 0, 0], self.incline_normal)   
-        ]
+        x0, y0, z0 = self.base_center
+        slope = np.tan(np.radians(incline_angle))
+        taper = (width_top - width_bottom) / (2 * length)
+        start = np.array([x0, y0, z0])
+        end = np.array([x0, y0 + length, z0 + slope * length])
+        vertices = [corner + [side * width / 2, 0, lift]
+                    for corner, width in ((start, width_bottom), (end, width_top))
+                    for side in (-1, 1) for lift in (0, height)]
+        normals = [[0, -1, 0], [0, 1, 0],           # lower and upper ends
+                   [0, slope, -1], [0, -slope, 1],  # floor and ceiling
+                   [1, -taper, 0], [-1, -taper, 0]] # sides
+        face_points = [start, end, start, start + [0, 0, height],
+                       start + [width_bottom / 2, 0, 0], start - [width_bottom / 2, 0, 0]]
+        self._set_faces(normals, face_points, vertices)
 
     def does_ray_intersect(self, position, direction):
-        intersects = any(self.intersect_plane(position, direction, normal, point) for normal, point in self.get_planes())
-        return intersects
-
-    def get_planes(self):
-        yield self.incline_normal, self.base_center
-        yield self.bottom_normal, self.base_center - np.array([0, self.height / 2, 0])
-        yield self.top_normal, self.base_center + np.array([0, self.height / 2, 0])
-        for normal in self.side_normals:
-            yield normal, self.base_center
-
-    def intersect_plane(self, position, direction, plane_normal, plane_point):
-        denom = np.dot(plane_normal, direction)
-        if np.isclose(denom, 0):
-            return False  
-        t = np.dot(plane_normal, plane_point - position) / denom
-        if t < 0:
-            return False  
-        intersect_point = position + t * direction
-
-        return self.is_within_bounds(intersect_point, plane_normal)
-
-    def is_within_bounds(self, intersect_point, plane_normal):
-
-        z_rel = intersect_point[2] - self.base_center[2]
-        
-
-        if np.isclose(np.dot(plane_normal, self.incline_normal), 1):
-            if not (-self.length / 2 <= z_rel <= self.length / 2):
-                return False
-            width_at_z = self.width_bottom + (z_rel / self.length) * (self.width_top - self.width_bottom)
-
-            x_min = self.base_center[0] - width_at_z / 2
-            x_max = self.base_center[0] + width_at_z / 2
-            return x_min <= intersect_point[0] <= x_max
-        elif np.isclose(np.dot(plane_normal, self.top_normal), 1):
-
-            if not (-self.length / 2 <= z_rel <= self.length / 2):
-                return False
-            x_min = self.base_center[0] - self.width_top / 2
-            x_max = self.base_center[0] + self.width_top / 2
-            return x_min <= intersect_point[0] <= x_max
-        elif np.isclose(np.dot(plane_normal, self.bottom_normal), 1):
-            
-            if not (-self.length / 2 <= z_rel <= self.length / 2):
-                return False
-            x_min = self.base_center[0] - self.width_bottom / 2
-            x_max = self.base_center[0] + self.width_bottom / 2
-            return x_min <= intersect_point[0] <= x_max
-        elif any(np.isclose(np.dot(plane_normal, side_normal), 1) for side_normal in self.side_normals):
-            if not (-self.width_bottom / 2 <= intersect_point[0] - self.base_center[0] <= self.width_bottom / 2):
-                return False
-            z_min = self.base_center[2] - self.length / 2
-            z_max = self.base_center[2] + self.length / 2
-            return z_min <= intersect_point[2] <= z_max
-        else:
-            
-            return False
-
-
-    def path_length(self, position, direction):
-        incline_direction = np.array([0, np.cos(np.radians(self.incline_angle)), np.sin(np.radians(self.incline_angle))])
-        length_direction = np.array([0, 1, 0])  
-        plane_normal = np.cross(incline_direction, length_direction)
-
-        if not self.does_ray_intersect(position, direction):
-            return 0
-
-
-        t_front = np.dot(self.base_center - position + np.array([0, self.length / 2, 0]), plane_normal) / np.dot(direction, plane_normal)
-        t_back = np.dot(self.base_center - position - np.array([0, self.length / 2, 0]), plane_normal) / np.dot(direction, plane_normal)
-
+        """
+        Check if a ray intersects with the grand gallery.
 
-        intersect_front = position + [t_front * d for d in direction]  
-        intersect_back = position + [t_back * d for d in direction]
+        Parameters:
+        position (list): The starting position of the ray.
+        direction (list): The direction of the ray.
 
+        Returns:
+        bool: True if the ray meets the gallery in front of its starting position, False otherwise.
+        """
+        _, t_exit = self.intersection_distances_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))
+        return bool(t_exit[0] >= 0)
 
-        return np.linalg.norm(intersect_front - intersect_back)
+    def path_length(self, position, direction):
+        """
+        Calculate the path length of a ray inside the grand gallery.
 
+        Parameters:
+        position (list): The starting position of the ray.
+        direction (list): The direction of the ray.
 
+        Returns:
+        float: The length inside the gallery in front of the starting position, 0 if the ray misses it.
+        """
+        t_enter, t_exit = self.intersection_distances_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))
+        length = np.clip(t_exit[0], 0, None) - np.clip(t_enter[0], 0, None)
+        return np.nan_to_num(length) * np.linalg.norm(direction)
 
 
 class Cavity:
@@ -338,6 +388,16 @@ class Cavity:
     """
     self.cavity_center = cavity_center
     self.cavity_radius = cavity_radius
+    self.center = np.asarray(cavity_center, dtype=float)
+    self.radius_squared = float(cavity_radius) ** 2
+  def bounds(self):
+    """
+    Get the axis-aligned bounding box of the cavity.
+
+    Returns:
+    tuple: The (3,) lower and upper corners of the box.
+    """
+    return self.center - self.cavity_radius, self.center + self.cavity_radius
   def is_inside(self, position):
         """
         Check if a given point is inside the cavity.
@@ -348,9 +408,20 @@ class Cavity:
         Returns:
         bool: True if the point is inside the cavity, False otherwise.
         """
-        distance = np.linalg.norm(np.array(position) - np.array(self.cavity_center))
+        offset = np.asarray(position, dtype=float) - self.center
+        return bool(np.dot(offset, offset) < self.radius_squared)
+  def is_inside_many(self, points):
+        """
+        Check which of the given points are inside the cavity.
+
+        Parameters:
+        points (np.array): The (N, 3) coordinates of the points to check.
 
-        return distance < self.cavity_radius
+        Returns:
+        np.array: (N,) booleans, True for the points inside the cavity.
+        """
+        offsets = np.asarray(points, dtype=float) - self.center
+        return np.einsum('ij,ij->i', offsets, offsets) < self.radius_squared
   def does_ray_intersect(self, position, direction):
     """
     Check if a ray intersects with the cavity.
@@ -362,22 +433,78 @@ class Cavity:
     Returns:
     bool: True if the ray intersects with the cavity, False otherwise.
     """
-    # sphere equation: (x - x0)^2 + (y - y0)^2 + (z - z0)^2 = r^2
-    # ray equation: x = x0 + at, y = y0 + bt, z = z0 + ct
-    # solve for t: (a^2 + b^2 + c^2)t^2 + 2(a(x0 - x) + b(y0 - y) + c(z0 - z))t + (x0^2 + y0^2 + z0^2 - r^2) = 0
-    a, b, c = direction
-    x0, y0, z0 = position
-    A = a ** 2 + b ** 2 + c ** 2
-    B = 2 * (a * (x0 - self.cavity_center[0]) + b * (y0 - self.cavity_center[1]) + c * (z0 - self.cavity_center[2]))
-    C = (x0 - self.cavity_center[0]) ** 2 + (y0 - self.cavity_center[1]) ** 2 + (z0 - self.cavity_center[2]) ** 2 - self.cavity_radius ** 2
-    discriminant = B ** 2 - 4 * A * C
-    if discriminant < 0:
-      return False
-    t1 = (-B + np.sqrt(discriminant)) / (2 * A)
-    t2 = (-B - np.sqrt(discriminant)) / (2 * A)
-    if t1 < 0 and t2 < 0:
-      return False
-    return True
+    crossings = self.intersection_distances(position, direction)
+    return crossings is not None and crossings[1] >= 0
+
+  def intersection_distances(self, position, direction):
+    """
+    Calculate where a ray enters and leaves the cavity.
+
+    Parameters:
+    position (list): The starting position of the ray.
+    direction (list): The direction of the ray.
+
+    Returns:
+    tuple: The ray parameters (t_enter, t_exit) with t_enter <= t_exit, or None if the ray misses the cavity.
+    Parameters are negative for crossings behind the starting position.
+    """
+    t_enter, t_exit = self.intersection_distances_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))
+    if np.isnan(t_enter[0]):
+      return None
+    return t_enter[0], t_exit[0]
+
+  def intersection_distances_many(self, origins, directions):
+    """
+    Calculate where rays enter and leave the cavity.
+
+    Parameters:
+    origins (np.array): The (N, 3) starting positions of the rays.
+    directions (np.array): The (N, 3) directions of the rays.
+
+    Returns:
+    tuple: (t_enter, t_exit) arrays of shape (N,) with t_enter <= t_exit, NaN for rays that miss the cavity.
+    Parameters are negative for crossings behind the starting positions.
+    """
+    # sphere equation: |x - center|^2 = r^2, ray equation: x = origin + t * direction
+    # solve for t: |d|^2 t^2 + 2 (d . (origin - center)) t + |origin - center|^2 - r^2 = 0
+    offsets = np.asarray(origins, dtype=float) - self.center
+    directions = np.asarray(directions, dtype=float)
+    A = np.einsum('ij,ij->i', directions, directions)
+    half_B = np.einsum('ij,ij->i', directions, offsets)
+    C = np.einsum('ij,ij->i', offsets, offsets) - self.radius_squared
+    discriminant = half_B ** 2 - A * C
+    with np.errstate(invalid='ignore'):
+      root = np.sqrt(discriminant)
+    # NaN where the discriminant is negative
+    return (-half_B - root) / A, (-half_B + root) / A
+
+  def chord_length(self, position, direction):
+    """
+    Calculate the length of the part of a ray that lies inside the cavity.
+
+    Parameters:
+    position (list): The starting position of the ray.
+    direction (list): The direction of the ray.
+
+    Returns:
+    float: The length inside the cavity in front of the starting position, 0 if the ray misses it.
+    """
+    return self.chord_length_many(np.reshape(position, (1, 3)), np.reshape(direction, (1, 3)))[0]
+
+  def chord_length_many(self, origins, directions):
+    """
+    Calculate the length of the part of each ray that lies inside the cavity.
+
+    Parameters:
+    origins (np.array): The (N, 3) starting positions of the rays.
+    directions (np.array): The (N, 3) directions of the rays.
+
+    Returns:
+    np.array: (N,) lengths inside the cavity in front of each starting position, 0 for rays that miss it.
+    """
+    t_enter, t_exit = self.intersection_distances_many(origins, directions)
+    chords = np.nan_to_num(np.clip(t_exit, 0, None) - np.clip(t_enter, 0, None))
+    return chords * np.linalg.norm(np.asarray(directions, dtype=float), axis=1)
 
 def initialize_pyramid_and_cavity(settings, to_file=None):
   """
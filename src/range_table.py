@@ -0,0 +1,109 @@
+import numpy as np
+
+# Total radiative loss coefficient b of standard rock: bremsstrahlung, pair production and photonuclear, 1 / (g/cm^2)
+STANDARD_ROCK_RADIATIVE_LOSS = 4e-6
+
+class RangeTable:
+    def __init__(self, energies, ranges):
+        """
+        Initialize the RangeTable class: the continuous-slowing-down range of a muon as a function of its energy.
+
+        Both directions are log-log interpolations in the table, so deciding how far a muon
+        gets, or what energy is left after a given opacity, costs two lookups.
+
+        Parameters:
+        energies (np.array): The increasing energies of the table in GeV.
+        ranges (np.array): The matching ranges in g/cm^2.
+
+        Returns:
+        None
+        """
+        self.energies = energies
+        self.ranges = ranges
+        self.log_energies = np.log(energies)
+        self.log_ranges = np.log(ranges)
+
+    @classmethod
+    def build(cls, ionisation, radiative, energy_range=(1e-4, 1e6), n_energies=512):
+        """
+        Integrate the range of the loss dE/dX = ionisation + radiative * E.
+
+        Parameters:
+        ionisation (float): The ionisation loss in GeV per g/cm^2.
+        radiative (float): The radiative loss coefficient in 1 / (g/cm^2).
+        energy_range (tuple): The lowest and highest energy of the table in GeV.
+        n_energies (int): The number of logarithmically spaced energies.
+
+        Returns:
+        RangeTable: The table.
+        """
+        energies = np.geomspace(energy_range[0], energy_range[1], n_energies)
+        inverse_loss = 1 / (ionisation + radiative * energies)
+        # Below the table the loss is ionisation only
+        ranges = energies[0] / ionisation + np.r_[0, np.cumsum(np.diff(energies) * (inverse_loss[1:] + inverse_loss[:-1]) / 2)]
+        return cls(energies, ranges)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Build the table of the configured material.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'muon_energy_loss_per_g_cm2' (float): The ionisation loss in MeV per g/cm^2.
+            - 'muon_radiative_loss_coefficient' (float, optional): b in 1 / (g/cm^2), summed over
+              bremsstrahlung, pair production and photonuclear loss. Defaults to the value of standard
+              rock, STANDARD_ROCK_RADIATIVE_LOSS. The scaling (m_e / m_mu)^2 / X0 of the radiation length
+              only gives the bremsstrahlung part, about a fifth of it.
+
+        Returns:
+        RangeTable: The table.
+        """
+        radiative = settings.get('muon_radiative_loss_coefficient', STANDARD_ROCK_RADIATIVE_LOSS)
+        return cls.build(settings['muon_energy_loss_per_g_cm2'] * 0.001, radiative)
+
+    def range(self, energy):
+        """
+        Look up the range of muons.
+
+        Parameters:
+        energy (np.array): The energies in GeV.
+
+        Returns:
+        np.array: The ranges in g/cm^2, 0 for energies <= 0.
+        """
+        energy = np.asarray(energy, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ranges = np.exp(np.interp(np.log(energy), self.log_energies, self.log_ranges))
+        # Below the table the range is proportional to the energy
+        ranges = np.where(energy < self.energies[0], energy * (self.ranges[0] / self.energies[0]), ranges)
+        return np.where(energy > 0, ranges, 0.0)
+
+    def energy(self, remaining_range):
+        """
+        Look up the energy of muons from their remaining range.
+
+        Parameters:
+        remaining_range (np.array): The ranges in g/cm^2.
+
+        Returns:
+        np.array: The energies in GeV, 0 for ranges <= 0.
+        """
+        remaining_range = np.asarray(remaining_range, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            energies = np.exp(np.interp(np.log(remaining_range), self.log_ranges, self.log_energies))
+        energies = np.where(remaining_range < self.ranges[0], remaining_range * (self.energies[0] / self.ranges[0]), energies)
+        return np.where(remaining_range > 0, energies, 0.0)
+
+    def energy_after(self, energy, opacity):
+        """
+        Calculate the energy left after crossing an opacity.
+
+        Parameters:
+        energy (np.array): The energies in GeV.
+        opacity (np.array): The opacities crossed in g/cm^2.
+
+        Returns:
+        np.array: The energies left in GeV, 0 for muons that stop.
+        """
+        return self.energy(self.range(energy) - opacity)
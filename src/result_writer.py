@@ -0,0 +1,176 @@
+import json
+import os
+
+import numpy as np
+from cache import atomic_write
+
+# Column names of the 3-vector fields, other vector fields get _x, _y and _z suffixes
+VECTOR_COLUMNS = {
+    'position': ('x', 'y', 'z'),
+    'direction': ('dx', 'dy', 'dz'),
+}
+
+def to_columns(records):
+    """
+    Split a structured array into flat columns.
+
+    Parameters:
+    records (np.ndarray): A structured array, vector fields of shape (3,) allowed.
+
+    Returns:
+    dict: One 1-D array per column, vector fields split into one column per component.
+    """
+    columns = {}
+    for name in records.dtype.names:
+        values = records[name]
+        if values.ndim == 1:
+            columns[name] = values
+            continue
+        names = VECTOR_COLUMNS.get(name, tuple(f'{name}_{axis}' for axis in 'xyz'))
+        for component, column in enumerate(names):
+            columns[column] = values[:, component]
+    return columns
+
+def paths_to_records(results):
+    """
+    Stack the paths of simulated muons into one table.
+
+    Parameters:
+    results (list): (muon_id, path) pairs as returned by the transport, None entries are skipped.
+
+    Returns:
+    np.ndarray: A structured array with the muon_id and step number of every row followed by the path fields.
+    """
+    results = [result for result in results if result is not None]
+    if not results:
+        return np.zeros(0, dtype=[('muon_id', np.int64), ('step', np.int32)])
+    paths = [path for _, path in results]
+    lengths = np.array([len(path) for path in paths])
+    rows = np.concatenate(paths)
+
+    dtype = [('muon_id', np.int64), ('step', np.int32)] + [(name, rows.dtype[name]) for name in rows.dtype.names]
+    records = np.empty(len(rows), dtype=dtype)
+    records['muon_id'] = np.repeat([muon_id for muon_id, _ in results], lengths)
+    records['step'] = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    for name in rows.dtype.names:
+        records[name] = rows[name]
+    return records
+
+def segments_to_records(muon_ids, starts, ends):
+    """
+    Stack single segments of simulated paths into the table of paths_to_records.
+
+    Every segment becomes a two-row path, so code reading consecutive rows of a path, like
+    detect_hits, sees the segments and nothing between them.
+
+    Parameters:
+    muon_ids (np.array): The (N,) muon of each segment, segments of a muon in path order.
+    starts (np.ndarray): The N PATH_DTYPE rows the segments start from.
+    ends (np.ndarray): The N PATH_DTYPE rows the segments end at.
+
+    Returns:
+    np.ndarray: A structured array of 2N rows, each start row at step 0 followed by its end row at step 1.
+    """
+    rows = np.stack([starts, ends], axis=1).ravel()
+    dtype = [('muon_id', np.int64), ('step', np.int32)] + [(name, rows.dtype[name]) for name in rows.dtype.names]
+    records = np.empty(len(rows), dtype=dtype)
+    records['muon_id'] = np.repeat(muon_ids, 2)
+    records['step'] = np.tile([0, 1], len(starts))
+    for name in rows.dtype.names:
+        records[name] = rows[name]
+    return records
+
+class ColumnarWriter:
+    def __init__(self, output_path, name='trajectories'):
+        """
+        Initialize the ColumnarWriter class.
+
+        Each write stores one chunk as an .npz of flat float/int columns, and close writes
+        a <name>.json manifest listing the chunks. read_columns loads them back.
+
+        Parameters:
+        output_path (str): The directory of the output files.
+        name (str): The prefix of the chunk files and manifest.
+
+        Returns:
+        None
+        """
+        self.output_path = output_path
+        self.name = name
+        self.chunks = []
+        self.n_rows = 0
+        self.columns = None
+        os.makedirs(output_path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, records, chunk=None):
+        """
+        Write one chunk of records.
+
+        Parameters:
+        records (np.ndarray): A structured array, see to_columns.
+        chunk (int, optional): The number of the chunk, defaults to the next free one.
+
+        Returns:
+        str: The path of the chunk file.
+        """
+        if chunk is None:
+            chunk = len(self.chunks)
+        columns = to_columns(records)
+        file_name = f'{self.name}-{chunk:05d}.npz'
+        atomic_write(os.path.join(self.output_path, file_name), lambda file: np.savez(file, **columns))
+        self.chunks.append(file_name)
+        self.n_rows += len(records)
+        self.columns = list(columns)
+        return os.path.join(self.output_path, file_name)
+
+    def adopt(self, chunk):
+        """
+        Add a chunk written earlier, by a run being resumed, to the manifest.
+
+        Parameters:
+        chunk (int): The number of the chunk.
+
+        Returns:
+        bool: False if there is no such chunk file.
+        """
+        file_name = f'{self.name}-{chunk:05d}.npz'
+        path = os.path.join(self.output_path, file_name)
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as columns:
+            self.columns = list(columns.files)
+            self.n_rows += len(columns[self.columns[0]]) if self.columns else 0
+        self.chunks.append(file_name)
+        return True
+
+    def close(self):
+        """
+        Write the manifest of the chunks written so far.
+
+        Returns:
+        None
+        """
+        manifest = {'name': self.name, 'chunks': sorted(self.chunks), 'rows': self.n_rows, 'columns': self.columns}
+        atomic_write(os.path.join(self.output_path, f'{self.name}.json'), lambda file: file.write(json.dumps(manifest, indent=2).encode()))
+
+def read_columns(output_path, name='trajectories'):
+    """
+    Read back the columns written by a ColumnarWriter.
+
+    Parameters:
+    output_path (str): The directory of the output files.
+    name (str): The prefix of the chunk files and manifest.
+
+    Returns:
+    dict: One 1-D array per column, concatenated over the chunks.
+    """
+    with open(os.path.join(output_path, f'{name}.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+    chunks = [np.load(os.path.join(output_path, file_name)) for file_name in manifest['chunks']]
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in manifest['columns'] or []}
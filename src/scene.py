@@ -0,0 +1,204 @@
+import numpy as np
+from pyramid_model import Chamber, GrandGallery
+
+# Density used for the voids when the settings do not give one, g/cm3
+DEFAULT_VOID_DENSITY = [0.00001, 0.0001]
+AIR_DENSITY = [0.0012, 0.0012]
+
+# Material codes returned by Scene.locate, voids are numbered from 0
+ROCK = -1
+OUTSIDE = -2
+
+class Scene:
+    def __init__(self, pyramid, rock_density):
+        """
+        Initialize the Scene class: the outer pyramid and the voids inside it.
+
+        Every void is tested against its axis-aligned bounding box first, so points and rays
+        only pay the exact test for the few objects they can touch.
+
+        Parameters:
+        pyramid (Pyramid): The pyramid model.
+        rock_density (list): The density range of the pyramid material in g/cm^3.
+
+        Returns:
+        None
+        """
+        self.pyramid = pyramid
+        self.rock_density = rock_density
+        self.names = []
+        self.objects = []
+        self.lower_bounds = np.empty((0, 3))
+        self.upper_bounds = np.empty((0, 3))
+        # Row k is the density range of void k, the last two rows are the air (OUTSIDE) and the rock (ROCK)
+        self.density_ranges = np.array([AIR_DENSITY, rock_density], dtype=float)
+
+    def add_void(self, name, solid, density_range):
+        """
+        Add a void to the scene.
+
+        Parameters:
+        name (str): The name of the void.
+        solid: A Cavity, Chamber or GrandGallery, anything with bounds, is_inside, is_inside_many and intersection_distances_many.
+        density_range (list): The density range of the void in g/cm^3.
+
+        Returns:
+        int: The index of the void.
+        """
+        lower, upper = solid.bounds()
+        self.names.append(name)
+        self.objects.append(solid)
+        self.lower_bounds = np.vstack([self.lower_bounds, lower])
+        self.upper_bounds = np.vstack([self.upper_bounds, upper])
+        self.density_ranges = np.vstack([self.density_ranges[:-2], density_range, self.density_ranges[-2:]])
+        return len(self.objects) - 1
+
+    @property
+    def mean_densities(self):
+        """
+        np.array: The mean density of each void followed by the air and the rock, indexable by locate results.
+        """
+        return self.density_ranges.mean(axis=1)
+
+    def locate(self, point):
+        """
+        Find the material at a point.
+
+        Parameters:
+        point (np.array): The coordinates of the point.
+
+        Returns:
+        int: The index of the void containing the point, ROCK or OUTSIDE.
+        """
+        point = np.asarray(point, dtype=float)
+        if not self.pyramid.is_inside(point):
+            return OUTSIDE
+        candidates = np.flatnonzero(np.all((self.lower_bounds <= point) & (point <= self.upper_bounds), axis=1))
+        for index in candidates:
+            if self.objects[index].is_inside(point):
+                return int(index)
+        return ROCK
+
+    def locate_many(self, points):
+        """
+        Find the material at each point.
+
+        Parameters:
+        points (np.array): The (N, 3) coordinates of the points.
+
+        Returns:
+        np.array: (N,) indices of the voids containing the points, ROCK or OUTSIDE.
+        """
+        points = np.asarray(points, dtype=float)
+        material = np.where(self.pyramid.is_inside_many(points), ROCK, OUTSIDE)
+        for index, solid in enumerate(self.objects):
+            candidates = np.flatnonzero(np.all((self.lower_bounds[index] <= points) & (points <= self.upper_bounds[index]), axis=1))
+            if candidates.size:
+                inside = solid.is_inside_many(points[candidates]) & (material[candidates] == ROCK)
+                material[candidates[inside]] = index
+        return material
+
+    def _box_hits(self, origins, directions):
+        """
+        Slab test of rays against the bounding boxes of all voids.
+
+        Parameters:
+        origins (np.array): The (N, 3) starting positions of the rays.
+        directions (np.array): The (N, 3) directions of the rays.
+
+        Returns:
+        np.array: (N, K) booleans, True where the ray meets box k in front of its origin.
+        """
+        origins = np.asarray(origins, dtype=float)[:, np.newaxis, :]
+        directions = np.asarray(directions, dtype=float)[:, np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1 = (self.lower_bounds - origins) / directions
+            t2 = (self.upper_bounds - origins) / directions
+        # Axes the ray is parallel to: inside the slab for all t or never
+        parallel = directions == 0
+        in_slab = (self.lower_bounds <= origins) & (origins <= self.upper_bounds)
+        t_low = np.where(parallel, np.where(in_slab, -np.inf, np.inf), np.minimum(t1, t2))
+        t_high = np.where(parallel, np.where(in_slab, np.inf, -np.inf), np.maximum(t1, t2))
+        t_enter = t_low.max(axis=2)
+        t_exit = t_high.min(axis=2)
+        return (t_enter <= t_exit) & (t_exit >= 0)
+
+    def next_boundary(self, position, direction, min_distance=1e-9):
+        """
+        Calculate the distance to the next void surface along a ray.
+
+        Parameters:
+        position (np.array): The starting position of the ray.
+        direction (np.array): The direction of the ray.
+        min_distance (float): Crossings closer than this are ignored, so that a ray starting on a surface moves on.
+
+        Returns:
+        float: The ray parameter of the next crossing of a void surface, np.inf if there is none.
+        """
+        origin = np.reshape(position, (1, 3))
+        direction = np.reshape(direction, (1, 3))
+        boundary = np.inf
+        for index in np.flatnonzero(self._box_hits(origin, direction)[0]):
+            for t in self.objects[index].intersection_distances_many(origin, direction):
+                if t[0] > min_distance:
+                    boundary = min(boundary, t[0])
+        return boundary
+
+    def void_lengths_many(self, origins, directions, distances=None):
+        """
+        Calculate the length of each ray inside each void.
+
+        Parameters:
+        origins (np.array): The (N, 3) starting positions of the rays.
+        directions (np.array): The (N, 3) unit directions of the rays.
+        distances (np.array, optional): (N,) lengths the rays are cut at, unbounded by default.
+
+        Returns:
+        np.array: (N, K) lengths in front of each origin, 0 where the ray misses the void.
+        """
+        origins = np.asarray(origins, dtype=float)
+        directions = np.asarray(directions, dtype=float)
+        lengths = np.zeros((len(origins), len(self.objects)))
+        hits = self._box_hits(origins, directions)
+        for index, solid in enumerate(self.objects):
+            candidates = np.flatnonzero(hits[:, index])
+            if candidates.size:
+                t_enter, t_exit = solid.intersection_distances_many(origins[candidates], directions[candidates])
+                if distances is not None:
+                    t_exit = np.minimum(t_exit, distances[candidates])
+                lengths[candidates, index] = np.nan_to_num(np.clip(np.clip(t_exit, 0, None) - np.clip(t_enter, 0, None), 0, None))
+        return lengths
+
+    @classmethod
+    def from_settings(cls, settings, pyramid, cavity):
+        """
+        Build the scene described by the settings.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'scene_voids' (list): The voids to include, among 'cavity', 'queen_chamber', 'king_chamber'
+              and 'grand_gallery'. Defaults to ['cavity'].
+            - 'void_density_range' (list): The density range of the voids, g/cm^3.
+            - '<void>_density_range' (list, optional): Overrides the density range of one void.
+        pyramid (Pyramid): The pyramid model.
+        cavity (Cavity): The cavity model.
+
+        Returns:
+        Scene: The scene.
+        """
+        scene = cls(pyramid, settings['pyramid_material_density'])
+        default_density = settings.get('void_density_range', DEFAULT_VOID_DENSITY)
+        for name in settings.get('scene_voids', ['cavity']):
+            if name == 'cavity':
+                solid = cavity
+            elif name in ('queen_chamber', 'king_chamber'):
+                solid = Chamber(settings[f'{name}_center'],
+                                [settings[f'{name}_width'], settings[f'{name}_length'], settings[f'{name}_height']])
+            elif name == 'grand_gallery':
+                solid = GrandGallery(settings['grand_gallery_base_center'], settings['grand_gallery_height'],
+                                     settings['grand_gallery_length'], settings['grand_gallery_width_bottom'],
+                                     settings['grand_gallery_width_top'], settings['grand_gallery_incline'])
+            else:
+                raise ValueError(f'Unknown void: {name}')
+            scene.add_void(name, solid, settings.get(f'{name}_density_range', default_density))
+        return scene
@@ -0,0 +1,127 @@
+import numpy as np
+
+class RelativeErrorTarget:
+    def __init__(self, transmission_map, target, coverage=0.9):
+        """
+        Initialize the RelativeErrorTarget class: stop once the busiest bins of a transmission map are precise enough.
+
+        The bins are taken from the busiest down until they hold the coverage fraction of the
+        weighted hits, and the estimate is the largest relative error sqrt(sum w^2) / sum w among
+        them. Bins at the edge of the acceptance that only ever see a few muons are left out.
+
+        Parameters:
+        transmission_map (TransmissionMap): The map the run fills, it must be among its accumulators.
+        target (float): The relative error to reach.
+        coverage (float): The fraction of the weighted hits the bins must hold.
+
+        Returns:
+        None
+        """
+        self.transmission_map = transmission_map
+        self.target = target
+        self.coverage = coverage
+
+    def estimate(self):
+        """
+        Calculate the largest relative error of the busiest bins.
+
+        Returns:
+        float: The relative error, infinite before the first hit.
+        """
+        counts = self.transmission_map.measured.ravel()
+        if counts.sum() <= 0:
+            return np.inf
+        order = np.argsort(counts)[::-1]
+        n_bins = np.searchsorted(np.cumsum(counts[order]), self.coverage * counts.sum()) + 1
+        busiest = order[:n_bins]
+        return float(np.max(np.sqrt(self.transmission_map.measured_sumw2.ravel()[busiest]) / counts[busiest]))
+
+    def reached(self):
+        """
+        Check the target.
+
+        Returns:
+        bool: True once the relative error is at most the target.
+        """
+        return self.estimate() <= self.target
+
+    def describe(self):
+        """
+        Describe the running estimate.
+
+        Returns:
+        str: The estimate and the target.
+        """
+        return f'relative error {self.estimate():.4g} (target {self.target:.4g})'
+
+class SignificanceTarget:
+    def __init__(self, transmission_map, target):
+        """
+        Initialize the SignificanceTarget class: stop once the voids show up against the void-free reference.
+
+        The estimate is the largest (measured - reference) / error over the bins, the excess of muons
+        let through by the voids. The error takes the common muons of both runs into account, see
+        TransmissionMap.difference, and the run needs 'transmission_reference'.
+
+        Parameters:
+        transmission_map (TransmissionMap): The map the run fills, it must be among its accumulators.
+        target (float): The significance to reach, in standard deviations.
+
+        Returns:
+        None
+        """
+        self.transmission_map = transmission_map
+        self.target = target
+
+    def estimate(self):
+        """
+        Calculate the significance of the most significant bin.
+
+        Returns:
+        float: The significance, 0 before any bin differs.
+        """
+        difference, error = self.transmission_map.difference()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            significance = np.where(error > 0, difference / error, 0)
+        return float(significance.max(initial=0))
+
+    def reached(self):
+        """
+        Check the target.
+
+        Returns:
+        bool: True once the significance is at least the target.
+        """
+        return self.estimate() >= self.target
+
+    def describe(self):
+        """
+        Describe the running estimate.
+
+        Returns:
+        str: The estimate and the target.
+        """
+        return f'significance {self.estimate():.3g} sigma (target {self.target:.3g})'
+
+def stopping_criterion(settings, transmission_map):
+    """
+    Create the configured stopping criterion.
+
+    Parameters:
+    settings (dict): The simulation settings.
+        - 'stopping_criterion' (str): None, 'relative_error' or 'significance'. Defaults to None.
+        - 'stopping_target' (float): The relative error or significance to reach.
+        - 'stopping_coverage' (float): The coverage of 'relative_error'. Defaults to 0.9.
+    transmission_map (TransmissionMap): The map the run fills.
+
+    Returns:
+    RelativeErrorTarget or SignificanceTarget: The criterion, None to simulate every muon.
+    """
+    criterion = settings.get('stopping_criterion')
+    if criterion is None:
+        return None
+    if criterion == 'relative_error':
+        return RelativeErrorTarget(transmission_map, settings['stopping_target'], settings.get('stopping_coverage', 0.9))
+    if criterion == 'significance':
+        return SignificanceTarget(transmission_map, settings['stopping_target'])
+    raise ValueError(f'Unknown stopping criterion: {criterion}')
@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import json
+import os
+
+import json5
+from cache import atomic_write, cache_directory, settings_digest
+from muon_simulation import GENERATION_STREAM, TrajectoryStatistics, batch_rng
+from transmission_map import TransmissionMap
+from worker_pool import build_simulator
+
+# Settings the shared muon sample is generated from, a sweep cannot vary them
+GENERATION_SETTINGS = ('pyramid_base_length', 'pyramid_height', 'muon_energy_range', 'muon_altitude', 'muon_sampling',
+                       'muon_spectrum', 'muon_spectral_index', 'muon_zenith_max', 'importance_grid_divisions',
+                       'importance_biased_fraction', 'random_seed', 'muon_batch_size')
+
+def expand_grid(grid):
+    """
+    List every combination of the values of a grid of settings.
+
+    Parameters:
+    grid (dict): The values to try for each setting.
+
+    Returns:
+    list: One dictionary of overrides per point, the last setting varying fastest.
+    """
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def point_path(settings, n_muons, batch_size):
+    """
+    Get the cache path of a sweep point.
+
+    Parameters:
+    settings (dict): The effective settings of the point, with its seed.
+    n_muons (int): The number of muons of the point.
+    batch_size (int): The number of muons per batch.
+
+    Returns:
+    str: The path without extension, keyed by a hash of the arguments.
+    """
+    digest = settings_digest(settings, n_muons, batch_size)
+    return os.path.join(cache_directory(settings), 'sweep', f'point-{digest}')
+
+def load_point(path):
+    """
+    Load a cached sweep point.
+
+    Parameters:
+    path (str): The path returned by point_path.
+
+    Returns:
+    dict: The 'overrides', 'n_muons' and 'statistics' of the point and its 'transmission_map'.
+    """
+    with open(path + '.json') as file:
+        point = json.load(file)
+    point['transmission_map'] = TransmissionMap.load(path + '.npz')
+    return point
+
+def run_sweep(settings, grid, n_muons, n_processes=8, batch_size=None, seed=None, pool=None):
+    """
+    Simulate every point of a grid of setting overrides with common random numbers.
+
+    The muons are generated once from the base settings and every point transports the same
+    batches with the same seed, so differences between points are not blurred by sampling noise.
+    The points share one worker pool. They run one after the other, so the workers build the
+    simulator of a point when it starts and only keep the most recent ones, see
+    worker_pool.SIMULATOR_CACHE_SIZE, however long the grid. The statistics and
+    transmission map of each point are cached on disk under a hash of its effective settings, so
+    running a sweep again only simulates the points not seen before.
+
+    Parameters:
+    settings (dict): The base simulation settings.
+    grid (dict): The values to try for each setting, see expand_grid. GENERATION_SETTINGS cannot vary.
+    n_muons (int): The number of muons of every point.
+    n_processes (int): The number of worker processes of a new pool.
+    batch_size (int, optional): The number of muons per batch, defaults to the 'muon_batch_size' setting.
+    seed (int, optional): The entropy of the sweep, defaults to the 'random_seed' setting, or 0 so that
+        the cache is reused between runs.
+    pool (SimulationPool, optional): A pool to reuse.
+
+    Returns:
+    list: The points in the order of expand_grid, see load_point.
+    """
+    fixed = [key for key in grid if key in GENERATION_SETTINGS]
+    if fixed:
+        raise ValueError(f'A sweep cannot vary the settings of the shared muon sample: {fixed}')
+    if seed is None:
+        seed = settings.get('random_seed')
+    settings = dict(settings, random_seed=0 if seed is None else seed)
+    batch_size = batch_size or settings.get('muon_batch_size', 1000)
+    overrides = expand_grid(grid)
+    points = [dict(settings, **override) for override in overrides]
+    paths = [point_path(point, n_muons, batch_size) for point in points]
+    missing = [index for index, path in enumerate(paths) if not os.path.exists(path + '.json')]
+
+    if missing:
+        simulator = build_simulator(settings)
+        detector_numbers = [detector.number for detector in simulator.detectors]
+        # The sample is kept in memory for the whole sweep
+        batches = [(start // batch_size, simulator.generate_muon_batch(min(batch_size, n_muons - start), start_id=start,
+                                                                       rng=batch_rng(simulator.seed, start // batch_size, GENERATION_STREAM)))
+                   for start in range(0, n_muons, batch_size)]
+        with simulator.simulation_pool(pool, n_processes) as pool:
+            for index in missing:
+                statistics = TrajectoryStatistics()
+                transmission_map = TransmissionMap.from_settings(points[index], detector_numbers)
+                for batch in pool.map_batches(batches, points[index], simulator.seed):
+                    statistics.update(batch)
+                    transmission_map.update(batch)
+                transmission_map.save(paths[index] + '.npz')
+                point = {'overrides': overrides[index], 'n_muons': n_muons, 'statistics': vars(statistics)}
+                atomic_write(paths[index] + '.json', lambda file: file.write(json.dumps(point, indent=2).encode()))
+    return [load_point(path) for path in paths]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a grid of setting overrides with common random numbers.')
+    parser.add_argument('grid', help='JSON object of the values to try per setting, or the path of a file holding it')
+    parser.add_argument('--n-muons', type=int, default=None, help="muons per point, defaults to the 'n_muons' setting")
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--settings', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'settings.json'))
+    arguments = parser.parse_args()
+
+    with open(arguments.settings, 'r') as settings_file:
+        settings = json5.load(settings_file)
+    if os.path.exists(arguments.grid):
+        with open(arguments.grid, 'r') as grid_file:
+            grid = json5.load(grid_file)
+    else:
+        grid = json5.loads(arguments.grid)
+    for point in run_sweep(settings, grid, arguments.n_muons or settings['n_muons'], arguments.processes, seed=arguments.seed):
+        statistics = point['statistics']
+        hits = ', '.join(f'detector {detector}: {weight:.1f}' for detector, weight in sorted(statistics['weighted_hits'].items()))
+        print(json.dumps(point['overrides']), f"absorbed {statistics['n_absorbed']}, stopped {statistics['n_stopped']}, hits {hits}")
@@ -0,0 +1,177 @@
+import numpy as np
+from cache import atomic_write
+
+class TransmissionMap:
+    def __init__(self, detector_numbers, n_theta=36, n_phi=72):
+        """
+        Initialize the TransmissionMap class: weighted (theta, phi) histograms of the detector hits.
+
+        theta is the zenith angle and phi the azimuth of the direction the muons come from, seen
+        from the detector. Each batch is binned with np.bincount and dropped, so memory does not
+        depend on the number of hits. The reference histograms hold the hits of the same muons in
+        the pyramid without voids, their ratio is the relative transmission. Both runs hand every
+        muon the same random numbers (see MuonSimulator.reference_hits), so the weights of the muons
+        seen in the same bin by both are summed too, for the covariance of the two histograms.
+
+        Parameters:
+        detector_numbers (list): The numbers of the detectors, as in the 'detector' column of the hits.
+        n_theta (int): The number of zenith bins over [0, pi].
+        n_phi (int): The number of azimuth bins over [-pi, pi].
+
+        Returns:
+        None
+        """
+        self.detector_numbers = list(detector_numbers)
+        self.n_theta = n_theta
+        self.n_phi = n_phi
+        shape = (len(self.detector_numbers), n_theta, n_phi)
+        self.measured = np.zeros(shape)
+        self.measured_sumw2 = np.zeros(shape)
+        self.reference = np.zeros(shape)
+        self.reference_sumw2 = np.zeros(shape)
+        self.common_sumw2 = np.zeros(shape)
+
+    @classmethod
+    def from_settings(cls, settings, detector_numbers=(1, 2)):
+        """
+        Create an empty map with the configured binning.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'transmission_theta_bins' (int): Defaults to 36.
+            - 'transmission_phi_bins' (int): Defaults to 72.
+        detector_numbers (list): The numbers of the detectors.
+
+        Returns:
+        TransmissionMap: The map.
+        """
+        return cls(detector_numbers, settings.get('transmission_theta_bins', 36), settings.get('transmission_phi_bins', 72))
+
+    def bin_indices(self, hits):
+        """
+        Find the flat bin of each hit.
+
+        Parameters:
+        hits (np.ndarray): A HIT_DTYPE array.
+
+        Returns:
+        np.array: The indices into the flattened (detector, theta, phi) histograms, -1 for unknown detectors.
+        """
+        arrival = -hits['direction']
+        theta = np.arccos(np.clip(arrival[:, 2], -1, 1))
+        phi = np.arctan2(arrival[:, 1], arrival[:, 0])
+        theta_bin = np.minimum((theta / np.pi * self.n_theta).astype(int), self.n_theta - 1)
+        phi_bin = np.minimum(((phi + np.pi) / (2 * np.pi) * self.n_phi).astype(int), self.n_phi - 1)
+        detector = np.searchsorted(self.detector_numbers, hits['detector'])
+        known = np.isin(hits['detector'], self.detector_numbers)
+        return np.where(known, (detector * self.n_theta + theta_bin) * self.n_phi + phi_bin, -1)
+
+    def _fill(self, counts, sumw2, hits):
+        index = self.bin_indices(hits)
+        known = index >= 0
+        index, weights = index[known], hits['weight'][known]
+        counts += np.bincount(index, weights, minlength=counts.size).reshape(counts.shape)
+        sumw2 += np.bincount(index, weights ** 2, minlength=counts.size).reshape(counts.shape)
+        # A muon hits a detector once, so (muon, bin) identifies a hit
+        return index, weights, hits['muon_id'][known] * counts.size + index
+
+    def update(self, batch):
+        """
+        Add the hits of one batch.
+
+        Parameters:
+        batch (BatchResult): The simulated batch, its reference_hits fill the reference histograms.
+
+        Returns:
+        None
+        """
+        index, weights, keys = self._fill(self.measured, self.measured_sumw2, batch.hits)
+        if batch.reference_hits is not None:
+            _, reference_weights, reference_keys = self._fill(self.reference, self.reference_sumw2, batch.reference_hits)
+            _, common, reference_common = np.intersect1d(keys, reference_keys, return_indices=True)
+            self.common_sumw2 += np.bincount(index[common], weights[common] * reference_weights[reference_common],
+                                             minlength=self.common_sumw2.size).reshape(self.common_sumw2.shape)
+
+    def merge(self, other):
+        """
+        Add the histograms of another map with the same binning, e.g. filled by another process.
+
+        Parameters:
+        other (TransmissionMap): The other map.
+
+        Returns:
+        TransmissionMap: This map.
+        """
+        if (other.detector_numbers, other.n_theta, other.n_phi) != (self.detector_numbers, self.n_theta, self.n_phi):
+            raise ValueError('Cannot merge transmission maps with different binnings')
+        for name in ('measured', 'measured_sumw2', 'reference', 'reference_sumw2', 'common_sumw2'):
+            getattr(self, name).__iadd__(getattr(other, name))
+        return self
+
+    def transmission(self):
+        """
+        Calculate the relative transmission and its statistical error.
+
+        Returns:
+        tuple: (ratio, error) arrays of shape (detectors, theta, phi), NaN where the reference is empty.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(self.reference > 0, self.measured / self.reference, np.nan)
+            relative_variance = (self.measured_sumw2 / self.measured ** 2 + self.reference_sumw2 / self.reference ** 2
+                                 - 2 * self.common_sumw2 / (self.measured * self.reference))
+            error = ratio * np.sqrt(np.maximum(np.nan_to_num(relative_variance, nan=np.inf, posinf=np.inf), 0))
+        return ratio, error
+
+    def difference(self):
+        """
+        Calculate the measured minus reference counts and their statistical error.
+
+        Returns:
+        tuple: (difference, error) arrays of shape (detectors, theta, phi).
+        """
+        variance = self.measured_sumw2 + self.reference_sumw2 - 2 * self.common_sumw2
+        return self.measured - self.reference, np.sqrt(np.maximum(variance, 0))
+
+    def excess(self):
+        """
+        Calculate the excess image, the relative transmission minus one.
+
+        Returns:
+        tuple: (excess, error) arrays of shape (detectors, theta, phi), NaN where the reference is empty.
+        """
+        ratio, error = self.transmission()
+        return ratio - 1, error
+
+    def save(self, path):
+        """
+        Save the histograms to an .npz file.
+
+        Parameters:
+        path (str): The path of the file.
+
+        Returns:
+        None
+        """
+        atomic_write(path, lambda file: np.savez(file, detector_numbers=self.detector_numbers, measured=self.measured,
+                                                 measured_sumw2=self.measured_sumw2, reference=self.reference,
+                                                 reference_sumw2=self.reference_sumw2, common_sumw2=self.common_sumw2))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load histograms saved by save.
+
+        Parameters:
+        path (str): The path of the file.
+
+        Returns:
+        TransmissionMap: The map.
+        """
+        with np.load(path) as arrays:
+            _, n_theta, n_phi = arrays['measured'].shape
+            transmission_map = cls(arrays['detector_numbers'].tolist(), n_theta, n_phi)
+            for name in ('measured', 'measured_sumw2', 'reference', 'reference_sumw2', 'common_sumw2'):
+                # Maps saved before the covariance was kept have none
+                if name in arrays:
+                    setattr(transmission_map, name, arrays[name].copy())
+        return transmission_map
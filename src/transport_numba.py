@@ -0,0 +1,321 @@
+import numpy as np
+from pyramid_model import Cavity
+from scene import OUTSIDE, ROCK
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# Kinds of void in the packed scene
+SPHERE = 0
+CONVEX = 1
+
+def _jit(function):
+    # Without numba the kernels stay plain Python, slow but usable to check the logic
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+def pack_scene(scene):
+    """
+    Flatten a scene into plain arrays for the compiled kernel.
+
+    Parameters:
+    scene (Scene): The scene, whose voids are Cavity or ConvexPolyhedron objects.
+
+    Returns:
+    tuple: The pyramid planes and tolerance, then per void its kind, bounding box, sphere center and
+    squared radius, the range of its planes in the concatenated plane arrays, and its tolerance.
+    """
+    n_voids = len(scene.objects)
+    kinds = np.empty(n_voids, dtype=np.int64)
+    centers = np.zeros((n_voids, 3))
+    radii_squared = np.zeros(n_voids)
+    tolerances = np.zeros(n_voids)
+    face_starts = np.zeros(n_voids + 1, dtype=np.int64)
+    normals, offsets = [np.empty((0, 3))], [np.empty(0)]
+    for index, solid in enumerate(scene.objects):
+        if isinstance(solid, Cavity):
+            kinds[index] = SPHERE
+            centers[index] = solid.center
+            radii_squared[index] = solid.radius_squared
+        else:
+            kinds[index] = CONVEX
+            normals.append(solid.face_normals)
+            offsets.append(solid.face_offsets)
+            tolerances[index] = solid.tolerance
+        face_starts[index + 1] = face_starts[index] + (0 if kinds[index] == SPHERE else len(solid.face_offsets))
+    pyramid = scene.pyramid
+    return (np.ascontiguousarray(pyramid.face_normals), np.ascontiguousarray(pyramid.face_offsets), float(pyramid.tolerance),
+            kinds, np.ascontiguousarray(scene.lower_bounds, dtype=float), np.ascontiguousarray(scene.upper_bounds, dtype=float),
+            centers, radii_squared, face_starts, np.concatenate(normals), np.concatenate(offsets), tolerances)
+
+def pack_detectors(detector_boxes):
+    """
+    Flatten the detectors into plain arrays for the compiled kernel.
+
+    Parameters:
+    detector_boxes (list): (detector, lower, upper) for each detector, as MuonSimulator.detector_boxes.
+
+    Returns:
+    tuple: The (D, 2, 3) bounding boxes, the range of the planes of each detector in the concatenated
+    plane arrays, and the tolerance of each detector.
+    """
+    boxes = np.array([(lower, upper) for _, lower, upper in detector_boxes], dtype=float).reshape(-1, 2, 3)
+    face_starts = np.zeros(len(detector_boxes) + 1, dtype=np.int64)
+    normals, offsets = [np.empty((0, 3))], [np.empty(0)]
+    for index, (detector, _, _) in enumerate(detector_boxes):
+        normals.append(detector.face_normals)
+        offsets.append(detector.face_offsets)
+        face_starts[index + 1] = face_starts[index] + len(detector.face_offsets)
+    tolerances = np.array([detector.tolerance for detector, _, _ in detector_boxes], dtype=float)
+    return boxes, face_starts, np.concatenate(normals), np.concatenate(offsets), tolerances
+
+@_jit
+def _inside_planes(point, normals, offsets, start, stop, tolerance):
+    for face in range(start, stop):
+        distance = normals[face, 0] * point[0] + normals[face, 1] * point[1] + normals[face, 2] * point[2] - offsets[face]
+        if distance > tolerance:
+            return False
+    return True
+
+@_jit
+def _locate(point, geometry):
+    (pyramid_normals, pyramid_offsets, pyramid_tolerance, kinds, lower, upper,
+     centers, radii_squared, face_starts, face_normals, face_offsets, tolerances) = geometry
+    if not _inside_planes(point, pyramid_normals, pyramid_offsets, 0, pyramid_offsets.shape[0], pyramid_tolerance):
+        return OUTSIDE
+    for index in range(kinds.shape[0]):
+        in_box = True
+        for axis in range(3):
+            if point[axis] < lower[index, axis] or point[axis] > upper[index, axis]:
+                in_box = False
+        if not in_box:
+            continue
+        if kinds[index] == SPHERE:
+            distance_squared = 0.0
+            for axis in range(3):
+                distance_squared += (point[axis] - centers[index, axis]) ** 2
+            if distance_squared < radii_squared[index]:
+                return index
+        elif _inside_planes(point, face_normals, face_offsets, face_starts[index], face_starts[index + 1], tolerances[index]):
+            return index
+    return ROCK
+
+@_jit
+def _write_row(rows, row, position, direction, energy, energy_loss, is_absorbed):
+    for axis in range(3):
+        rows[row, axis] = position[axis]
+        rows[row, 3 + axis] = direction[axis]
+    rows[row, 6] = energy
+    rows[row, 7] = energy_loss
+    rows[row, 8] = is_absorbed
+
+@_jit
+def _segment_enters(start, end, detectors, index):
+    # The segment test of detect_hits, on one detector: the box first, then the planes
+    boxes, face_starts, face_normals, face_offsets, tolerances = detectors
+    for axis in range(3):
+        if min(start[axis], end[axis]) > boxes[index, 1, axis] or max(start[axis], end[axis]) < boxes[index, 0, axis]:
+            return False
+    t_enter = -np.inf
+    t_exit = np.inf
+    for face in range(face_starts[index], face_starts[index + 1]):
+        denominator = 0.0
+        distance = face_offsets[face]
+        for axis in range(3):
+            denominator += (end[axis] - start[axis]) * face_normals[face, axis]
+            distance -= start[axis] * face_normals[face, axis]
+        if denominator < 0:
+            t_enter = max(t_enter, distance / denominator)
+        elif denominator > 0:
+            t_exit = min(t_exit, distance / denominator)
+        elif distance < -tolerances[index]:
+            return False
+    return t_enter <= t_exit and t_enter <= 1 and t_exit >= 0
+
+@_jit
+def _transport_batch(positions, directions, energies, keep, seeds, geometry, density_ranges, mean_densities, detectors, max_steps, step_size,
+                     absorption_probability, loss_factor, thickness_range, scattering_in_void, scattering_in_rock):
+    n_muons = positions.shape[0]
+    # Rows of the kept paths, offsets[i]:offsets[i + 1] for muon i
+    offsets = np.zeros(n_muons + 1, dtype=np.int64)
+    rows = np.empty((max_steps, 9))
+    count = 0
+    # Entry and exit position, exit direction, initial and final energy, absorbed, opacity, void length and steps per muon
+    summaries = np.zeros((n_muons, 15))
+    started = np.zeros(n_muons, dtype=np.bool_)
+    # Start and end rows of the segments where a muon first enters a detector
+    pending = np.empty(detectors[0].shape[0], dtype=np.bool_)
+    segments = np.empty((64, 2, 9))
+    segment_owners = np.empty(64, dtype=np.int64)
+    n_segments = 0
+    state = np.empty((2, 9))
+    position = np.empty(3)
+    direction = np.empty(3)
+    for muon in range(n_muons):
+        offsets[muon] = count
+        position[:] = positions[muon]
+        direction[:] = directions[muon]
+        energy = energies[muon]
+        material = _locate(position, geometry)
+        if material == OUTSIDE:
+            continue
+        started[muon] = True
+        # One stream per muon, see MuonSimulator.transport
+        np.random.seed(seeds[muon])
+        if keep[muon] and count + max_steps > rows.shape[0]:
+            grown = np.empty((2 * rows.shape[0] + max_steps, 9))
+            grown[:count] = rows[:count]
+            rows = grown
+
+        _write_row(state, 0, position, direction, energy, 0.0, 0.0)
+        if keep[muon]:
+            rows[count] = state[0]
+            count += 1
+        summaries[muon, 0:3] = position
+        summaries[muon, 9] = energy
+        pending[:] = True
+        step = 1
+        while material != OUTSIDE and step < max_steps:
+            for axis in range(3):
+                position[axis] += direction[axis] * step_size
+            # Absorbed and stopped muons end without a row for this step
+            if np.random.random() < absorption_probability:
+                summaries[muon, 11] = 1.0
+                break
+            material = _locate(position, geometry)
+            # The step leaving the pyramid still goes through rock
+            loss_material = max(material, ROCK)
+            density = (density_ranges[loss_material, 0]
+                       + np.random.random() * (density_ranges[loss_material, 1] - density_ranges[loss_material, 0]))
+            thickness = thickness_range[0] + np.random.random() * (thickness_range[1] - thickness_range[0])
+            energy_loss = loss_factor * density * thickness
+            energy = max(energy - energy_loss, 0.0)
+
+            strength = scattering_in_void if material >= 0 else scattering_in_rock
+            norm = 0.0
+            for axis in range(3):
+                direction[axis] += strength * (2 * np.random.random() - 1)
+                norm += direction[axis] ** 2
+            for axis in range(3):
+                direction[axis] /= np.sqrt(norm)
+            if energy <= 0:
+                break
+
+            _write_row(state, 1, position, direction, energy, energy_loss, 0.0)
+            entering = False
+            for index in range(pending.shape[0]):
+                if pending[index] and _segment_enters(state[0], state[1], detectors, index):
+                    pending[index] = False
+                    entering = True
+            if entering:
+                if n_segments == segments.shape[0]:
+                    grown_segments = np.empty((2 * n_segments, 2, 9))
+                    grown_segments[:n_segments] = segments[:n_segments]
+                    segments = grown_segments
+                    grown_owners = np.empty(2 * n_segments, dtype=np.int64)
+                    grown_owners[:n_segments] = segment_owners[:n_segments]
+                    segment_owners = grown_owners
+                segments[n_segments] = state
+                segment_owners[n_segments] = muon
+                n_segments += 1
+            if keep[muon]:
+                rows[count] = state[1]
+                count += 1
+            # m -> cm
+            summaries[muon, 12] += step_size * mean_densities[material] * 100
+            if material >= 0:
+                summaries[muon, 13] += step_size
+            summaries[muon, 14] += 1
+            state[0] = state[1]
+            step += 1
+        summaries[muon, 3:9] = state[0, 0:6]
+        summaries[muon, 10] = energy
+    offsets[n_muons] = count
+    return rows[:count], offsets, summaries, started, segments[:n_segments], segment_owners[:n_segments]
+
+class NumbaTransport:
+    def __init__(self, simulator):
+        """
+        Initialize the NumbaTransport class: the fixed-step model of MuonSimulator.track_muon_steps
+        as one compiled loop over a batch.
+
+        The geometry is packed once, the step parameters are read from the simulator on every call.
+        Materials come from the exact solids, the voxel grid is not used.
+
+        Parameters:
+        simulator (MuonSimulator): The simulator whose scene and step parameters are used.
+
+        Returns:
+        None
+        """
+        self.simulator = simulator
+        self.geometry = pack_scene(simulator.scene)
+        self.detectors = pack_detectors(simulator.detector_boxes)
+
+    def simulate(self, muons, rng):
+        """
+        Simulate the trajectories of a batch of muons.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        rng (np.random.Generator): The generator the seeds of the muons are drawn from.
+
+        Returns:
+        list: (muon_id, path) for each muon in input order, None for muons starting outside the pyramid.
+        """
+        _, results, _ = self.transport(muons, rng)
+        paths = dict(results)
+        return [(int(muon_id), paths[int(muon_id)]) if int(muon_id) in paths else None for muon_id in muons['id']]
+
+    def transport(self, muons, rng, keep=None):
+        """
+        Transport a batch of muons, accumulating the summaries in the compiled loop.
+
+        Parameters:
+        muons (np.ndarray): A structured array of dtype MUON_DTYPE.
+        rng (np.random.Generator): The generator the seeds of the muons are drawn from, one per muon in input order.
+        keep (np.array, optional): (N,) booleans, the muons whose path is recorded. Defaults to all of them.
+
+        Returns:
+        tuple: As muon_simulation.collect_tracks, the summaries and paths in input order.
+        """
+        # muon_simulation imports this module
+        from muon_simulation import SUMMARY_DTYPE, SPEED_OF_LIGHT
+        from result_writer import segments_to_records
+        simulator = self.simulator
+        keep = np.ones(len(muons), dtype=bool) if keep is None else np.asarray(keep, dtype=bool)
+        rows, offsets, state, started, segments, segment_owners = _transport_batch(
+            np.ascontiguousarray(muons['position'], dtype=float), np.ascontiguousarray(muons['direction'], dtype=float),
+            np.ascontiguousarray(muons['energy'], dtype=float), np.ascontiguousarray(keep), rng.integers(2 ** 32, size=len(muons)), self.geometry,
+            np.ascontiguousarray(simulator.scene.density_ranges, dtype=float), np.ascontiguousarray(simulator.scene.mean_densities),
+            self.detectors, simulator.max_steps, float(simulator.step_size), float(simulator.absorption_probability(simulator.step_size)),
+            simulator.energy_loss_per_g_cm2 * simulator.step_size * 100 * 0.001,
+            np.asarray(simulator.thickness_range, dtype=float),
+            float(simulator.scattering_strength_in_cavity), float(simulator.scattering_strength_in_other_material))
+
+        state = state[started]
+        summaries = np.zeros(len(state), dtype=SUMMARY_DTYPE)
+        summaries['id'] = muons['id'][started]
+        summaries['entry_position'] = state[:, 0:3]
+        summaries['exit_position'] = state[:, 3:6]
+        summaries['exit_direction'] = state[:, 6:9]
+        summaries['initial_energy'] = state[:, 9]
+        summaries['final_energy'] = state[:, 10]
+        summaries['is_absorbed'] = state[:, 11] > 0
+        summaries['is_stopped'] = (state[:, 10] <= 0) & (state[:, 11] == 0)
+        summaries['opacity'] = state[:, 12]
+        summaries['void_length'] = state[:, 13]
+        summaries['void_time'] = state[:, 13] / SPEED_OF_LIGHT
+        summaries['n_steps'] = state[:, 14]
+        summaries['weight'] = 1
+
+        path = simulator._path_rows(rows[:, 0:3], rows[:, 3:6], rows[:, 6], rows[:, 7], rows[:, 8] > 0)
+        results = [(int(muon_id), path[start:stop]) for muon_id, start, stop in zip(muons['id'], offsets[:-1], offsets[1:]) if stop > start]
+        starts, ends = (simulator._path_rows(side[:, 0:3], side[:, 3:6], side[:, 6], side[:, 7], side[:, 8] > 0)
+                        for side in (segments[:, 0], segments[:, 1]))
+        return summaries, results, segments_to_records(muons['id'][segment_owners], starts, ends)
@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+from cache import atomic_write, cache_directory, geometry_settings, settings_digest
+from scene import OUTSIDE
+
+class VoxelGrid:
+    def __init__(self, material, lower, resolution, path=None):
+        """
+        Initialize the VoxelGrid class: the material of the scene sampled on a regular grid.
+
+        Parameters:
+        material (np.array): The (nx, ny, nz) int8 material codes of the voxels, as returned by Scene.locate.
+        lower (np.array): The coordinates of the lower corner of the grid.
+        resolution (float): The edge length of the cubic voxels.
+        path (str, optional): The .npy file material is memory-mapped from, if any.
+
+        Returns:
+        None
+        """
+        self.material = material
+        self.lower = np.asarray(lower, dtype=float)
+        self.resolution = float(resolution)
+        self.shape = np.array(material.shape)
+        self.path = path
+
+    def __reduce__(self):
+        # Worker processes map the cached file again instead of receiving a pickled copy of the grid
+        if self.path is not None:
+            return VoxelGrid.load, (self.path, self.lower, self.resolution)
+        return VoxelGrid, (self.material, self.lower, self.resolution)
+
+    def locate(self, point):
+        """
+        Find the material at a point.
+
+        Parameters:
+        point (np.array): The coordinates of the point.
+
+        Returns:
+        int: The material code of the voxel containing the point, OUTSIDE if the point is off the grid.
+        """
+        i, j, k = ((np.asarray(point, dtype=float) - self.lower) // self.resolution).astype(int)
+        if 0 <= i < self.shape[0] and 0 <= j < self.shape[1] and 0 <= k < self.shape[2]:
+            return int(self.material[i, j, k])
+        return OUTSIDE
+
+    def locate_many(self, points):
+        """
+        Find the material at each point.
+
+        Parameters:
+        points (np.array): The (N, 3) coordinates of the points.
+
+        Returns:
+        np.array: (N,) material codes of the voxels containing the points, OUTSIDE for points off the grid.
+        """
+        indices = ((np.asarray(points, dtype=float) - self.lower) // self.resolution).astype(int)
+        on_grid = np.all((indices >= 0) & (indices < self.shape), axis=1)
+        material = np.full(len(indices), OUTSIDE, dtype=int)
+        i, j, k = indices[on_grid].T
+        material[on_grid] = self.material[i, j, k]
+        return material
+
+    @classmethod
+    def build(cls, scene, resolution):
+        """
+        Sample the material of a scene at the center of every voxel of its bounding box.
+
+        Parameters:
+        scene (Scene): The scene to sample.
+        resolution (float): The edge length of the cubic voxels.
+
+        Returns:
+        VoxelGrid: The grid, held in memory.
+        """
+        lower, upper = scene.pyramid.bounds()
+        shape = np.ceil((upper - lower) / resolution).astype(int)
+        centers = [lower[axis] + (np.arange(shape[axis]) + 0.5) * resolution for axis in range(3)]
+        x, y = np.meshgrid(centers[0], centers[1], indexing='ij')
+        material = np.empty(shape, dtype=np.int8)
+        # One z slice at a time keeps the temporary point arrays small
+        for k, z in enumerate(centers[2]):
+            points = np.column_stack([x.ravel(), y.ravel(), np.full(x.size, z)])
+            material[:, :, k] = scene.locate_many(points).reshape(x.shape)
+        return cls(material, lower, resolution)
+
+    @classmethod
+    def load(cls, path, lower, resolution):
+        """
+        Memory-map a cached grid.
+
+        Parameters:
+        path (str): The .npy file of the material codes.
+        lower (np.array): The coordinates of the lower corner of the grid.
+        resolution (float): The edge length of the cubic voxels.
+
+        Returns:
+        VoxelGrid: The grid, backed by the read-only mapped file.
+        """
+        return cls(np.load(path, mmap_mode='r'), lower, resolution, path)
+
+    @classmethod
+    def from_settings(cls, settings, scene):
+        """
+        Get the grid of a scene from the on-disk cache, building and caching it on first use.
+
+        The cache file is keyed by a hash of the geometry settings and the resolution, so every
+        run and worker process with the same geometry maps the same file.
+
+        Parameters:
+        settings (dict): The simulation settings.
+            - 'voxel_grid_resolution' (float): The edge length of the voxels in m. Defaults to 0.5.
+            - 'cache_dir' (str): The directory of the cache files. Defaults to 'cache'.
+        scene (Scene): The scene described by the settings.
+
+        Returns:
+        VoxelGrid: The grid, backed by the mapped cache file.
+        """
+        resolution = settings.get('voxel_grid_resolution', 0.5)
+        digest = settings_digest(geometry_settings(settings), resolution)
+        path = os.path.join(cache_directory(settings), f'voxels-{digest}.npy')
+        lower, _ = scene.pyramid.bounds()
+        if not os.path.exists(path):
+            grid = cls.build(scene, resolution)
+            atomic_write(path, lambda file: np.save(file, grid.material))
+        return cls.load(path, lower, resolution)
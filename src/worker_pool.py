@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from multiprocessing import Pool, resource_tracker, shared_memory
+import os
+import queue
+
+import numpy as np
+from cache import settings_digest
+from muon_detector import MuonDetector
+from muon_simulation import MUON_DTYPE, SUMMARY_DTYPE, BatchResult, MuonSimulator
+from pyramid_model import initialize_pyramid_and_cavity
+
+# Simulators a worker keeps for settings other than those of its pool, least recently used ones are dropped
+SIMULATOR_CACHE_SIZE = 2
+
+# State of a worker process, filled by _initialize_worker
+_default_key = None
+_simulators = OrderedDict()
+_blocks = {}
+
+def build_simulator(settings):
+    """
+    Build a simulator and its geometry from the settings alone.
+
+    Parameters:
+    settings (dict): The simulation settings.
+
+    Returns:
+    MuonSimulator: The simulator with the pyramid, cavity and both detectors of the settings.
+    """
+    pyramid, cavity = initialize_pyramid_and_cavity(settings)
+    detectors = [MuonDetector(settings, 1), MuonDetector(settings, 2)]
+    return MuonSimulator(settings, pyramid, cavity, detectors)
+
+def _initialize_worker(settings):
+    global _default_key
+    _default_key = settings_digest(settings)
+    _simulators[_default_key] = build_simulator(settings)
+
+def _worker_simulator(settings):
+    key = _default_key if settings is None else settings_digest(settings)
+    if key in _simulators:
+        _simulators.move_to_end(key)
+        return _simulators[key]
+    simulator = _simulators[key] = build_simulator(settings)
+    others = [other for other in _simulators if other != _default_key]
+    for other in others[:len(others) - SIMULATOR_CACHE_SIZE]:
+        del _simulators[other]
+    return simulator
+
+def _attach(key, name):
+    # Slots are reused across tasks, so each block is mapped once per worker. A slot that grew has a
+    # new block under the same key, the mapping of the unlinked one is closed to free its memory
+    block = _blocks.get(key)
+    if block is None or block.name != name:
+        if block is not None:
+            block.close()
+        block = _blocks[key] = shared_memory.SharedMemory(name=name)
+    return block
+
+def _simulate_slot(number, input_name, output_name, n_muons, batch_index, settings, seed):
+    muons = np.ndarray(n_muons, dtype=MUON_DTYPE, buffer=_attach((number, 'input'), input_name).buf)
+    batch = _worker_simulator(settings).simulate_batch(muons, batch_index, seed)
+    summaries = np.ndarray(n_muons, dtype=SUMMARY_DTYPE, buffer=_attach((number, 'output'), output_name).buf)
+    summaries[:len(batch.summaries)] = batch.summaries
+    return batch_index, n_muons, len(batch.summaries), batch.paths, batch.hits, batch.reference_hits, batch.metrics
+
+class _Slot:
+    def __init__(self, number, capacity):
+        self.number = number
+        self.capacity = capacity
+        self.input = shared_memory.SharedMemory(create=True, size=max(capacity * MUON_DTYPE.itemsize, 1))
+        self.output = shared_memory.SharedMemory(create=True, size=max(capacity * SUMMARY_DTYPE.itemsize, 1))
+
+    def release(self):
+        for block in (self.input, self.output):
+            block.close()
+            block.unlink()
+
+class SimulationPool:
+    def __init__(self, settings, n_processes=8):
+        """
+        Initialize the SimulationPool class: worker processes that keep their simulator between calls.
+
+        Every worker builds the geometry and simulator from the settings once, when it starts, with
+        build_simulator. The workers only ever see settings: a simulator whose geometry was built
+        otherwise, or whose attributes were changed after construction, is not what they simulate
+        with, and MuonSimulator.iter_muon_batches refuses a pool built for other settings.
+
+        A batch is then sent as the name of a shared memory block holding its MUON_DTYPE rows, and
+        the workers write the SUMMARY_DTYPE rows back into a second block. Only the compact hit table
+        and the recorded paths, if any, are pickled. The blocks are reused from batch to batch.
+
+        Parameters:
+        settings (dict): The simulation settings the workers build their simulator from.
+        n_processes (int): The number of worker processes.
+
+        Returns:
+        None
+        """
+        self.settings = settings
+        self.n_processes = n_processes
+        if os.name == 'posix':
+            # Workers started before the tracker would each start their own and report the blocks as leaked
+            resource_tracker.ensure_running()
+        self.pool = Pool(n_processes, initializer=_initialize_worker, initargs=(settings,))
+        self.free_slots = []
+        self.slots = []
+        # (slot, task) of the batches left running when a caller stopped iterating, see map_batches
+        self.abandoned = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Leaving early, e.g. by closing a generator at a stopping criterion, drops the running batches
+        self.close(terminate=exc_type is not None)
+
+    def close(self, terminate=False):
+        """
+        Stop the workers and free the shared memory blocks.
+
+        Parameters:
+        terminate (bool): Kill the workers at once, dropping the batches still running, instead of
+            letting them finish.
+
+        Returns:
+        None
+        """
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        for slot in self.slots:
+            slot.release()
+        self.slots = []
+        self.free_slots = []
+        self.abandoned = []
+
+    def _take_slot(self, n_muons):
+        # The slots of abandoned batches are reused once their task is done
+        done = [(slot, task) for slot, task in self.abandoned if task.ready()]
+        for slot, task in done:
+            self.abandoned.remove((slot, task))
+            self.free_slots.append(slot)
+        slot = self.free_slots.pop() if self.free_slots else None
+        if slot is None:
+            slot = _Slot(len(self.slots), n_muons)
+            self.slots.append(slot)
+        elif slot.capacity < n_muons:
+            # Grown geometrically so that slowly growing batches seldom remap the blocks of the workers
+            self.slots.remove(slot)
+            slot.release()
+            slot = _Slot(slot.number, max(n_muons, 2 * slot.capacity))
+            self.slots.append(slot)
+        return slot
+
+    def map_batches(self, batches, settings=None, seed=None):
+        """
+        Simulate batches of muons, keeping at most two batches per worker in flight.
+
+        Parameters:
+        batches (iterable): (batch_index, muons) pairs, muons a structured array of dtype MUON_DTYPE.
+            It is consumed lazily, only when a slot is free.
+        settings (dict, optional): Settings to simulate with instead of the ones of the pool. The
+            workers build a simulator per distinct settings and keep the SIMULATOR_CACHE_SIZE most
+            recently used ones.
+        seed (int, optional): The entropy of the run, see MuonSimulator.simulate_batch. Defaults to the
+            seed of the worker simulators, which is only shared when the settings give a 'random_seed'.
+
+        Yields:
+        BatchResult: The simulated batches in completion order.
+        """
+        batches = iter(batches)
+        done = queue.Queue()
+        busy = {}
+
+        def submit():
+            batch = next(batches, None)
+            if batch is None:
+                return False
+            batch_index, muons = batch
+            slot = self._take_slot(len(muons))
+            np.ndarray(len(muons), dtype=MUON_DTYPE, buffer=slot.input.buf)[:] = muons
+            busy[batch_index] = slot, self.pool.apply_async(
+                _simulate_slot, (slot.number, slot.input.name, slot.output.name, len(muons), batch_index, settings, seed),
+                callback=done.put, error_callback=done.put)
+            return True
+
+        in_flight = sum(submit() for _ in range(2 * self.n_processes))
+        try:
+            while in_flight:
+                finished = done.get()
+                if isinstance(finished, BaseException):
+                    raise finished
+                batch_index, n_muons, n_summaries, paths, hits, reference_hits, metrics = finished
+                slot, _ = busy.pop(batch_index)
+                summaries = np.ndarray(n_muons, dtype=SUMMARY_DTYPE, buffer=slot.output.buf)[:n_summaries].copy()
+                self.free_slots.append(slot)
+                in_flight += submit() - 1
+                yield BatchResult(batch_index, n_muons, summaries, paths, hits, reference_hits, metrics)
+        finally:
+            # The caller stopped iterating: workers may still write to the slots of the running tasks,
+            # which are freed by close, or reused once the tasks are done if the pool is kept
+            self.abandoned.extend(busy.values())
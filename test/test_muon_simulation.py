@@ -1,82 +1,841 @@
 import unittest
+import json
 import os
-from unittest.mock import Mock
+import tempfile
+from unittest.mock import Mock, patch
 import sys
 from BeautifulReport import BeautifulReport
-sys.path.append('/Users/gregyoungforever/Documents/ISEP2023-2024/Simulation/src')
-from muon_simulation import MuonSimulator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from muon_simulation import GENERATION_STREAM, MUON_DTYPE, PATH_DTYPE, SUMMARY_DTYPE, BatchResult, MuonSimulator, TrajectoryStatistics, batch_rng
 import numpy as np
 from unittest.mock import Mock
 from pyramid_model import Pyramid, Cavity
+from muon_detector import HIT_DTYPE, MuonDetector, detect_hits
+from checkpoint import RunCheckpoint
+from data_processing import MuonDataAnalysis
+from instrumentation import Instrumentation
+from importance_sampling import subdivide_triangles
+from muon_flux import MuonFlux
+from range_table import STANDARD_ROCK_RADIATIVE_LOSS, RangeTable
+from result_writer import paths_to_records, read_columns
+from stopping import RelativeErrorTarget, SignificanceTarget
+from sweep import expand_grid, run_sweep
+from transmission_map import TransmissionMap
+from transport_numba import NUMBA_AVAILABLE, NumbaTransport
+import worker_pool
+from worker_pool import SIMULATOR_CACHE_SIZE, SimulationPool
+
+# Same values as config/settings.json
+SETTINGS = {
+  'cavity_center': [115, 115, 85],
+  'cavity_radius': 20,
+  'pyramid_base_length': 230,
+  'pyramid_height': 139,
+  'pyramid_material_density': [2.2, 2.4],
+  'pyramid_material_thickness_range': [65, 115],
+  'muon_altitude': 300000,
+  'muon_energy_range': [20, 1000],
+  'n_muons': 10000,
+  'muon_energy_loss_per_g_cm2': 1.7,
+  'muon_radiation_length': 26.5,
+  'muon_step_size': 0.1,
+  'muon_mean_free_path': 100,
+  'muon_scattering_strength_in_cavity': 0.01,
+  'muon_scattering_strength_in_other_material': 0.05,
+  'detector_position_1': [115, 247, 0],
+  'detector_position_2': [112, 115, 32],
+  'detector_base_vectors_1': [[175, 175, 0], [55, 175, 0], [55, 175, 125], [175, 175, 125]],
+  'detector_base_vectors_2': [[175, 55, 125], [55, 55, 125], [55, 175, 125], [175, 175, 125]],
+}
+
+def make_simulator(settings=SETTINGS):
+  pyramid = Pyramid(settings['pyramid_base_length'], settings['pyramid_height'])
+  cavity = Cavity(settings['cavity_center'], settings['cavity_radius'])
+  detectors = [MuonDetector(settings, 1), MuonDetector(settings, 2)]
+  return MuonSimulator(settings, pyramid, cavity, detectors)
+
 class TestMuonSimulator(unittest.TestCase):
   """
   Unit tests for the MuonSimulator class.
   """
-  @classmethod
   def setUp(self):
-    self.altitude = 10000  
-    self.energy_range = (10, 1000)  
-    self.mean_free_path = 1000  
-
-    self.pyramid = Pyramid(200, 140)
-    self.cavity = Cavity([100,100,65], 20)
-    self.simulator = MuonSimulator(
-      altitude=self.altitude,
-      energy_range=self.energy_range,
-      pyramid=self.pyramid,
-      cavity=self.cavity,
-      mean_free_path=self.mean_free_path
-    )
+    self.simulator = make_simulator()
+    self.muon = (0, (np.array([115., 115., 130.]), np.array([0., 0., -1.]), 500.))
 
   def test_generate_muons(self):
     n_muons = 100
     muons = self.simulator.generate_muons(n_muons)
     self.assertEqual(len(muons), n_muons)
-    for position, direction, energy in muons:
-      self.assertEqual(position[2], self.altitude)
-      self.assertTrue(self.energy_range[0] <= energy <= self.energy_range[1])
+    for muon_id, (position, direction, energy) in muons:
+      self.assertTrue(self.simulator.pyramid.is_inside(position))
+      self.assertAlmostEqual(np.linalg.norm(direction), 1)
+      self.assertTrue(SETTINGS['muon_energy_range'][0] <= energy <= SETTINGS['muon_energy_range'][1])
+    self.assertEqual([muon_id for muon_id, _ in muons], list(range(n_muons)))
 
   def test_simulate_muons_trajectory(self):
-    self.pyramid.is_inside = Mock(return_value = True)
-    self.pyramid.path_length = Mock(return_value = 100)
-    self.cavity.is_inside = Mock(return_value = True)
-
-    muon = (np.array([self.pyramid.base_length/2, self.pyramid.base_length/2, self.altitude]), np.array([0, 0, -1]), 500)
-    result = self.simulator.simulate_muons_trajectory(muon)
+    result = self.simulator.simulate_muon_trajectory(self.muon)
     self.assertIsNotNone(result)
 
-    intersects, position, energy = result
-    
-    self.assertTrue(intersects) 
-    self.assertGreater(energy, 0)  
-    
-    self.pyramid.is_inside.assert_called()
-    self.pyramid.path_length.assert_called_with(muon[0], muon[1])
+    muon_id, path = result
+    self.assertEqual(muon_id, 0)
+    np.testing.assert_allclose(path['position'][0], [115, 115, 130])
+    self.assertTrue(np.all(path['energy'] > 0))
+    self.assertTrue(np.all(np.diff(path['energy']) <= 0))
 
   def test_simulate_muons_trajectory_outside(self):
-    self.pyramid.is_inside = Mock(return_value = False)
-    muon = (np.array([self.pyramid.base_length/2, self.pyramid.base_length/2, self.altitude]), np.array([0, 0, -1]), 500)
-    result = self.simulator.simulate_muons_trajectory(muon)
-    self.assertIsNone(result)
+    muon = (0, (np.array([300., 300., 300.]), np.array([0., 0., -1.]), 500.))
+    self.assertIsNone(self.simulator.simulate_muon_trajectory(muon))
 
-    self.pyramid.is_inside.assert_called()
-  
   def test_simulate_muons_trajectory_absorbed(self):
-    self.pyramid.is_inside = Mock(return_value = True)
-    self.pyramid.path_length = Mock(return_value = 1000000)
-    self.cavity.is_inside = Mock(return_value = False)
-    muon = (np.array([self.pyramid.base_length/2, self.pyramid.base_length/2, self.altitude]), np.array([0, 0, -1]), 500)
-    result = self.simulator.simulate_muons_trajectory(muon)
-    intersects, _, energy = result
-    self.assertIsNotNone(result)
-    self.assertFalse(intersects)
-    self.assertEqual(energy, 0)
-    self.pyramid.is_inside.assert_called()
-    self.pyramid.path_length.assert_called_with(muon[0], muon[1])
+    self.simulator.mean_free_path = 1e-9
+    track = self.simulator.track_muon_steps(self.muon, keep_path=True)
+    self.assertTrue(track.is_absorbed)
+    self.assertEqual(track.final_energy, 500)
+    # The absorbing step has no row
+    self.assertEqual(len(track.path()), 1)
+
+class TestMuonBatchGeneration(unittest.TestCase):
+  def setUp(self):
+    self.simulator = make_simulator()
+
+  def test_generate_muon_batch(self):
+    muons = self.simulator.generate_muon_batch(1000, start_id=10)
+    self.assertEqual(len(muons), 1000)
+    np.testing.assert_array_equal(muons['id'], np.arange(10, 1010))
+    np.testing.assert_allclose(np.linalg.norm(muons['direction'], axis=1), 1)
+    self.assertTrue(np.all((muons['energy'] >= 20) & (muons['energy'] <= 1000)))
+    for position in muons['position']:
+      self.assertTrue(self.simulator.pyramid.is_inside(position))
+
+  def test_generate_muons_keeps_tuple_format(self):
+    muons = self.simulator.generate_muons(5)
+    self.assertEqual([muon_id for muon_id, _ in muons], list(range(5)))
+    position, direction, energy = muons[0][1]
+    self.assertEqual(position.shape, (3,))
+    self.assertEqual(direction.shape, (3,))
+
+  def test_simulate_batch_from_structured_array(self):
+    muons = self.simulator.generate_muon_batch(3)
+    positions = muons['position'].copy()
+    results = self.simulator.simulate_muon_trajectories_batch(muons)
+    self.assertEqual([result[0] for result in results], [0, 1, 2])
+    np.testing.assert_array_equal(muons['position'], positions)
+
+class TestEventTransport(unittest.TestCase):
+  def setUp(self):
+    self.simulator = make_simulator()
+    self.simulator.transport_mode = 'event'
+
+  def test_event_path_ends_on_terminal_event(self):
+    muons = self.simulator.generate_muon_batch(50, rng=np.random.default_rng(1))
+    for muon, (muon_id, path) in zip(muons, self.simulator.simulate_muon_trajectories_batch(muons)):
+      self.assertEqual(muon_id, muon['id'])
+      np.testing.assert_allclose(path[0]['position'], muon['position'])
+      self.assertLess(len(path), 10)
+      last = path[-1]
+      exited = not self.simulator.pyramid.is_inside(last['position'] + last['direction'] * 1e-3)
+      self.assertTrue(last['is_absorbed'] or last['energy'] <= 0 or exited)
+
+  def test_event_path_stops_at_cavity_boundary(self):
+    self.simulator.mean_free_path = np.inf
+    self.simulator.scattering_strength_in_cavity = 0
+    self.simulator.scattering_strength_in_other_material = 0
+    position = np.array([115.0, 115.0, 115.0])
+    _, path = self.simulator.simulate_muon_trajectory_event((0, (position, np.array([0.0, 0.0, -1.0]), 1e6)))
+    # rock, cavity, rock down to the base
+    self.assertAlmostEqual(path[1]['position'][2], 105)
+    self.assertAlmostEqual(path[2]['position'][2], 65, delta=1)
+    self.assertGreater(path[1]['energy_loss'], path[2]['energy_loss'])
+
+class TestLockstepTransport(unittest.TestCase):
+  def setUp(self):
+    # Without randomness the lock-step kernel must reproduce the scalar path exactly
+    settings = dict(SETTINGS,
+                    pyramid_material_density=[2.3, 2.3],
+                    pyramid_material_thickness_range=[90, 90],
+                    muon_mean_free_path=np.inf,
+                    muon_scattering_strength_in_cavity=0,
+                    muon_scattering_strength_in_other_material=0,
+                    void_density_range=[0.0001, 0.0001])
+    self.simulator = make_simulator(settings)
+
+  def test_lockstep_matches_scalar_path(self):
+    muons = self.simulator.generate_muon_batch(20, rng=np.random.default_rng(2))
+    muons['energy'] /= 10
+    muons['position'][0] = [-1, -1, -1]
+    expected = self.simulator.simulate_muon_trajectories_batch(muons)
+    results = self.simulator.simulate_muons_lockstep(muons)
+    self.assertIsNone(results[0])
+    self.assertIsNone(expected[0])
+    for (expected_id, expected_path), (muon_id, path) in zip(expected[1:], results[1:]):
+      self.assertEqual(muon_id, expected_id)
+      self.assertEqual(len(path), len(expected_path))
+      for field in expected_path.dtype.names:
+        np.testing.assert_allclose(path[field], expected_path[field])
+
+  def test_exit_step_loses_rock_energy(self):
+    muons = np.zeros(1, dtype=MUON_DTYPE)
+    muons['position'] = [115, 115, 0.05]
+    muons['direction'] = [0, 0, -1]
+    muons['energy'] = 100
+    for transport in (self.simulator.transport, self.simulator.transport_lockstep, NumbaTransport(self.simulator).transport):
+      _, [(_, path)], _ = transport(muons, np.random.default_rng(0))
+      self.assertEqual(len(path), 2)
+      self.assertFalse(self.simulator.pyramid.is_inside(path[-1]['position']))
+      self.assertAlmostEqual(path[-1]['energy_loss'], 1.7 * 2.3 * 90 * 0.1 * 100 * 0.001)
+
+  def test_ending_step_has_no_row(self):
+    muons = self.simulator.generate_muon_batch(5, rng=np.random.default_rng(2))
+    muons['energy'] = 1e-6
+    transports = [self.simulator.transport, self.simulator.transport_lockstep, NumbaTransport(self.simulator).transport]
+    for is_absorbed in (False, True):
+      self.simulator.mean_free_path = 1e-9 if is_absorbed else np.inf
+      for transport in transports:
+        summaries, results, _ = transport(muons, np.random.default_rng(0))
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(len(path) == 1 for _, path in results))
+        np.testing.assert_array_equal(summaries['is_absorbed'], is_absorbed)
+        np.testing.assert_array_equal(summaries['is_stopped'], not is_absorbed)
+        np.testing.assert_array_equal(summaries['final_energy'], 1e-6 if is_absorbed else 0)
+        np.testing.assert_array_equal(summaries['n_steps'], 0)
+
+class TestNumbaTransport(unittest.TestCase):
+  def setUp(self):
+    self.settings = dict(SETTINGS, muon_transport_mode='step', random_seed=5)
+
+  def test_kernel_matches_step_model_without_randomness(self):
+    # Runs as plain Python when numba is missing, so keep the paths short
+    settings = dict(self.settings,
+                    pyramid_material_density=[2.3, 2.3],
+                    pyramid_material_thickness_range=[90, 90],
+                    muon_mean_free_path=np.inf,
+                    muon_scattering_strength_in_cavity=0,
+                    muon_scattering_strength_in_other_material=0,
+                    void_density_range=[0.0001, 0.0001],
+                    scene_voids=['cavity', 'king_chamber'],
+                    king_chamber_center=[112, 105, 50],
+                    king_chamber_width=10,
+                    king_chamber_length=10,
+                    king_chamber_height=14)
+    simulator = make_simulator(settings)
+    muons = simulator.generate_muon_batch(6, rng=np.random.default_rng(6))
+    muons['energy'] = 2500
+    muons['position'][0] = [-1, -1, -1]
+    expected = simulator.simulate_muon_trajectories_batch(muons)
+    results = NumbaTransport(simulator).simulate(muons, np.random.default_rng(0))
+    self.assertIsNone(results[0])
+    self.assertGreater(simulator.summarize_paths(results)['void_length'].max(), 0)
+    for (expected_id, expected_path), (muon_id, path) in zip(expected[1:], results[1:]):
+      self.assertEqual(muon_id, expected_id)
+      self.assertEqual(len(path), len(expected_path))
+      for field in expected_path.dtype.names:
+        np.testing.assert_allclose(path[field], expected_path[field])
+
+  @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+  def test_backends_are_statistically_equivalent(self):
+    numpy_simulator = make_simulator(self.settings)
+    numba_simulator = make_simulator(dict(self.settings, transport_backend='numba'))
+    muons = numpy_simulator.generate_muon_batch(400, rng=np.random.default_rng(7))
+    muons['energy'] /= 20
+    summaries = [simulator.transport(muons, np.random.default_rng(8))[0] for simulator in (numpy_simulator, numba_simulator)]
+    for field in ('final_energy', 'n_steps', 'void_length'):
+      expected, observed = (summary[field].astype(float) for summary in summaries)
+      standard_error = np.sqrt((expected.var() + observed.var()) / len(expected))
+      self.assertLess(abs(expected.mean() - observed.mean()), 4 * standard_error + 1e-9)
+    self.assertEqual(summaries[0]['is_absorbed'].sum() > 0, summaries[1]['is_absorbed'].sum() > 0)
+
+class TestDetectorHits(unittest.TestCase):
+  def setUp(self):
+    self.detector = MuonDetector(dict(SETTINGS, detector_efficiency=1), 2)
+
+  def test_acceptance_volume(self):
+    points = np.array([[115, 115, 100], [112, 115, 32.5], [115, 115, 130], [10, 10, 100], [112, 115, 20]])
+    np.testing.assert_array_equal(self.detector.is_inside_many(points), [True, True, False, False, False])
+    self.assertTrue(self.detector.is_inside([60, 60, 124]))
+
+  def test_event_segment_entry_point(self):
+    rows = np.zeros(2, dtype=PATH_DTYPE)
+    rows['position'] = [[112, 115, 0], [112, 115, 100]]
+    rows['direction'] = [0, 0, 1]
+    rows['energy'] = [100, 0]
+    hits = detect_hits([self.detector], paths_to_records([(3, rows)]), np.random.default_rng(0))
+    self.assertEqual(len(hits), 1)
+    self.assertEqual((hits[0]['detector'], hits[0]['muon_id']), (2, 3))
+    np.testing.assert_allclose(hits[0]['position'], [112, 115, 32])
+    self.assertAlmostEqual(hits[0]['energy'], 68)
+
+  def test_efficiency(self):
+    settings = dict(SETTINGS, muon_transport_mode='event', random_seed=3, detector_efficiency=0.5)
+    simulator = make_simulator(settings)
+    batch = simulator.simulate_batch(simulator.generate_muon_batch(400, rng=np.random.default_rng(8)))
+    self.assertTrue(set(batch.hits['muon_id']) <= set(batch.summaries['id']))
+    full = make_simulator(dict(settings, detector_efficiency=1))
+    all_hits = full.simulate_batch(full.generate_muon_batch(400, rng=np.random.default_rng(8))).hits
+    self.assertGreater(len(all_hits), 50)
+    self.assertAlmostEqual(len(batch.hits) / len(all_hits), 0.5, delta=0.15)
+
+class TestImportanceSampling(unittest.TestCase):
+  def test_cells_cover_the_triangle(self):
+    triangle = np.array([[[0, 0, 0], [4, 0, 0], [0, 2, 0]]], dtype=float)
+    cells = subdivide_triangles(triangle, 5)
+    self.assertEqual(len(cells), 25)
+    areas = np.linalg.norm(np.cross(cells[:, 1] - cells[:, 0], cells[:, 2] - cells[:, 0]), axis=1) / 2
+    np.testing.assert_allclose(areas, 4 / 25)
+
+  def test_weights_average_to_one(self):
+    simulator = make_simulator(dict(SETTINGS, muon_sampling='detector', random_seed=2))
+    muons = simulator.generate_muon_batch(20000, rng=np.random.default_rng(9))
+    self.assertAlmostEqual(muons['weight'].mean(), 1, delta=0.05)
+    self.assertLessEqual(muons['weight'].max(), 1 / (1 - 0.9) + 1e-9)
+    self.assertTrue(simulator.pyramid.is_inside_many(muons['position']).all())
+
+  def test_weighted_hits_are_unbiased(self):
+    rates = {}
+    for sampling in ('nominal', 'detector'):
+      simulator = make_simulator(dict(SETTINGS, muon_transport_mode='event', detector_efficiency=1, muon_sampling=sampling, random_seed=4))
+      hits = simulator.simulate_batch(simulator.generate_muon_batch(3000, rng=np.random.default_rng(10))).hits
+      rates[sampling] = (hits['weight'].sum() / 3000, np.sqrt((hits['weight'] ** 2).sum()) / 3000, len(hits))
+    (nominal, nominal_error, nominal_hits), (biased, biased_error, biased_hits) = rates['nominal'], rates['detector']
+    self.assertLess(abs(nominal - biased), 4 * np.hypot(nominal_error, biased_error))
+    self.assertGreater(biased_hits, 2 * nominal_hits)
+
+class TestMuonFlux(unittest.TestCase):
+  def setUp(self):
+    self.cache = tempfile.TemporaryDirectory()
+    self.settings = dict(SETTINGS, cache_dir=self.cache.name, muon_sampling='flux', muon_spectrum='power_law',
+                         muon_spectral_index=2.7, muon_zenith_max=60, random_seed=11)
+
+  def tearDown(self):
+    self.cache.cleanup()
+
+  def test_power_law_marginals(self):
+    flux = MuonFlux.from_settings(self.settings)
+    energy, directions = flux.sample(200000, np.random.default_rng(12))
+    # Through a horizontal plane the zenith cosine follows c^3 on [cos 60, 1]
+    np.testing.assert_allclose(np.mean(-directions[:, 2]), 4 / 5 * (1 - 0.5 ** 5) / (1 - 0.5 ** 4), atol=2e-3)
+    # E^-2.7 on [20, 1000], that is weight exp(-1.7 x) on a uniform grid of x = log E
+    log_energy = np.linspace(np.log(20), np.log(1000), 100001)
+    np.testing.assert_allclose(np.mean(np.log(energy)), np.average(log_energy, weights=np.exp(-1.7 * log_energy)), atol=5e-3)
+    np.testing.assert_allclose(np.linalg.norm(directions, axis=1), 1)
+
+  def test_tables_are_cached(self):
+    MuonFlux.from_settings(self.settings)
+    files = [name for name in os.listdir(self.cache.name) if name.startswith('flux-')]
+    self.assertEqual(len(files), 1)
+    flux = MuonFlux.from_settings(self.settings)
+    self.assertEqual(os.listdir(self.cache.name).count(files[0]), 1)
+    self.assertEqual(flux.inverse_log_energy.shape, (128, 1024))
+
+  def test_flux_muons_start_on_the_pyramid(self):
+    simulator = make_simulator(dict(self.settings, muon_spectrum='gaisser'))
+    muons = simulator.generate_muon_batch(2000, rng=np.random.default_rng(13))
+    self.assertTrue(np.all(muons['direction'][:, 2] < 0))
+    self.assertTrue(np.all((muons['energy'] >= 20) & (muons['energy'] <= 1000)))
+    self.assertTrue(np.all(muons['weight'] >= 1))
+    inside = simulator.pyramid.is_inside_many(muons['position'])
+    self.assertGreater(inside.mean(), 0.3)
+    # Entry points lie on the surface, just outside along the reversed direction
+    entry = muons[inside]
+    self.assertFalse(simulator.pyramid.is_inside_many(entry['position'] - entry['direction'] * 1e-3).any())
+
+class TestRangeTable(unittest.TestCase):
+  def test_matches_analytic_range(self):
+    ionisation, radiative = 0.0017, 4e-6
+    table = RangeTable.build(ionisation, radiative)
+    energy = np.array([0.01, 1, 20, 1000, 1e5])
+    np.testing.assert_allclose(table.range(energy), np.log1p(radiative * energy / ionisation) / radiative, rtol=1e-3)
+    opacity = np.array([10, 1000, 5000, 1e5])
+    expected = np.maximum((1000 + ionisation / radiative) * np.exp(-radiative * opacity) - ionisation / radiative, 0)
+    np.testing.assert_allclose(table.energy_after(1000, opacity), expected, rtol=1e-3)
+    np.testing.assert_array_equal(table.energy_after(np.array([0, 1]), 1e4), [0, 0])
+
+  def test_default_radiative_loss_is_the_total_of_standard_rock(self):
+    table = RangeTable.from_settings(SETTINGS)
+    ionisation, radiative = 0.0017, STANDARD_ROCK_RADIATIVE_LOSS
+    np.testing.assert_allclose(table.range(1000), np.log1p(radiative * 1000 / ionisation) / radiative, rtol=1e-3)
+    other = RangeTable.from_settings(dict(SETTINGS, muon_radiative_loss_coefficient=1e-6))
+    self.assertGreater(other.range(1000), table.range(1000))
+
+  def test_event_transport_stops_at_range(self):
+    settings = dict(SETTINGS, energy_loss_model='csda', muon_transport_mode='event', muon_mean_free_path=np.inf, muon_scattering_strength_in_cavity=0,
+                    muon_scattering_strength_in_other_material=0, pyramid_material_density=[2.3, 2.3])
+    simulator = make_simulator(settings)
+    # Straight down from 10 m below the apex, away from the cavity
+    position = np.array([60.0, 115.0, 10.0])
+    energy = float(simulator.range_table.energy(5 * 230))
+    _, path = simulator.simulate_muon_trajectory_event((0, (position, np.array([0.0, 0.0, -1.0]), energy)))
+    self.assertEqual(path[-1]['energy'], 0)
+    self.assertAlmostEqual(path[-1]['position'][2], 5, places=6)
+
+  def test_straight_line_fate(self):
+    simulator = make_simulator(dict(SETTINGS, pyramid_material_density=[2.3, 2.3]))
+    muons = np.zeros(2, dtype=MUON_DTYPE)
+    muons['position'] = [[60, 115, 10], [115, 115, 125]]
+    muons['direction'] = [0, 0, -1]
+    muons['energy'] = 1000
+    opacity, energy, survived = simulator.straight_line_fate(muons)
+    np.testing.assert_allclose(opacity, [10 * 230, 85 * 230 + 40 * 0.000055 * 100])
+    np.testing.assert_allclose(energy, simulator.range_table.energy_after(1000, opacity))
+    np.testing.assert_array_equal(survived, energy > 0)
+    opacity, _, _ = simulator.straight_line_fate(muons, np.array([4, 50]))
+    np.testing.assert_allclose(opacity, [4 * 230, 20 * 230 + 30 * 0.000055 * 100])
+
+  def test_csda_needs_event_transport(self):
+    with self.assertWarns(UserWarning):
+      make_simulator(dict(SETTINGS, energy_loss_model='csda', muon_transport_mode='lockstep'))
+
+  def test_csda_importance_uses_the_range_table(self):
+    settings = dict(SETTINGS, muon_sampling='detector', importance_grid_divisions=8, muon_transport_mode='event')
+    step = make_simulator(settings).start_sampler
+    csda = make_simulator(dict(settings, energy_loss_model='csda')).start_sampler
+    self.assertGreater(np.abs(csda.probabilities - step.probabilities).max(), 0)
+    self.assertAlmostEqual(csda.probabilities.sum(), 1)
+
+class TestResultWriter(unittest.TestCase):
+  def setUp(self):
+    self.output = tempfile.TemporaryDirectory()
+    self.simulator = make_simulator(dict(SETTINGS, output_path=self.output.name))
+    self.simulator.transport_mode = 'event'
+    self.results = self.simulator.simulate_muon_trajectories_batch(self.simulator.generate_muon_batch(20, rng=np.random.default_rng(3))) + [None]
+
+  def tearDown(self):
+    self.output.cleanup()
+
+  def test_columnar_round_trip(self):
+    self.simulator.write_results(self.results)
+    columns = read_columns(self.output.name)
+    paths = [path for _, path in self.results[:-1]]
+    self.assertEqual(len(columns['x']), sum(len(path) for path in paths))
+    np.testing.assert_array_equal(columns['muon_id'][:len(paths[0])], 0)
+    np.testing.assert_array_equal(columns['step'][:len(paths[0])], np.arange(len(paths[0])))
+    np.testing.assert_array_equal(columns['dz'][:len(paths[0])], paths[0]['direction'][:, 2])
+    np.testing.assert_array_equal(columns['is_absorbed'][-len(paths[-1]):], paths[-1]['is_absorbed'])
+
+  def test_csv_has_one_column_per_coordinate(self):
+    path = os.path.join(self.output.name, 'trajectories.csv')
+    self.simulator.write_results_to_csv(self.results, path)
+    with open(path) as csv_file:
+      self.assertEqual(csv_file.readline().strip(), 'muon_id,step,x,y,z,dx,dy,dz,energy,energy_loss,is_absorbed')
+
+class TestStreamingSimulation(unittest.TestCase):
+  def setUp(self):
+    self.output = tempfile.TemporaryDirectory()
+    self.simulator = make_simulator(dict(SETTINGS, muon_transport_mode='event', muon_batch_size=30))
+
+  def tearDown(self):
+    self.output.cleanup()
+
+  def test_streaming_writes_every_batch(self):
+    statistics = TrajectoryStatistics()
+    n_batches = self.simulator.simulate_muons_streaming(100, 2, self.output.name, [statistics])
+    self.assertEqual(n_batches, 4)
+    self.assertEqual(statistics.n_muons, 100)
+    # Four chunks and a manifest per table, then the run manifest and the accumulator state
+    self.assertEqual(len(os.listdir(self.output.name)), 17)
+    np.testing.assert_array_equal(np.unique(read_columns(self.output.name)['muon_id']), np.arange(100))
+    np.testing.assert_array_equal(np.sort(read_columns(self.output.name, 'summaries')['id']), np.arange(100))
+
+  def test_resume_after_interruption(self):
+    settings = dict(SETTINGS, muon_transport_mode='event', muon_batch_size=30, random_seed=21)
+    full, interrupted = TrajectoryStatistics(), TrajectoryStatistics()
+    with tempfile.TemporaryDirectory() as directory:
+      make_simulator(settings).simulate_muons_streaming(100, 2, directory, [full])
+    save = RunCheckpoint.save
+    def fail_third_batch(checkpoint, batch_index, accumulators=()):
+      if len(checkpoint.completed) == 2:
+        raise RuntimeError('worker lost')
+      save(checkpoint, batch_index, accumulators)
+    with patch.object(RunCheckpoint, 'save', autospec=True, side_effect=fail_third_batch):
+      with self.assertRaises(RuntimeError):
+        make_simulator(settings).simulate_muons_streaming(100, 2, self.output.name, [interrupted])
+    resumed = TrajectoryStatistics()
+    n_batches = make_simulator(settings).simulate_muons_streaming(100, 2, self.output.name, [resumed], resume=True)
+    self.assertEqual(n_batches, 2)
+    self.assertEqual(vars(resumed), vars(full))
+    np.testing.assert_array_equal(np.sort(read_columns(self.output.name, 'summaries')['id']), np.arange(100))
+    with self.assertRaises(ValueError):
+      make_simulator(settings).simulate_muons_streaming(120, 2, self.output.name, resume=True)
+
+  def test_iter_muon_batches_covers_all_muons(self):
+    batches = {batch.batch_index: batch for batch in self.simulator.iter_muon_batches(70, 2)}
+    self.assertEqual(sorted(batches), [0, 1, 2])
+    self.assertEqual([len(batches[index].summaries) for index in range(3)], [30, 30, 10])
+    self.assertEqual(batches[2].summaries['id'][0], 60)
+
+  def test_default_batch_size_keeps_workers_busy(self):
+    self.assertEqual(self.simulator.default_batch_size(100, 8), 13)
+    self.assertEqual(self.simulator.default_batch_size(1000, 8), 30)
+    self.assertEqual(self.simulator.default_batch_size(3, 8), 1)
+
+class TestRandomStreams(unittest.TestCase):
+  def setUp(self):
+    self.settings = dict(SETTINGS, muon_transport_mode='lockstep', muon_batch_size=20, random_seed=12345)
+
+  def simulate(self, n_processes):
+    with SimulationPool(self.settings, n_processes) as pool:
+      batches = make_simulator(self.settings).iter_muon_batches(70, pool=pool)
+      return np.sort(np.concatenate([batch.summaries for batch in batches]), order='id')
+
+  def test_results_do_not_depend_on_process_count(self):
+    one, three = self.simulate(1), self.simulate(3)
+    for field in one.dtype.names:
+      np.testing.assert_array_equal(one[field], three[field])
+
+  def test_batches_draw_independent_streams(self):
+    simulator = make_simulator(self.settings)
+    first, second = (simulator.generate_muon_batch(5, rng=batch_rng(simulator.seed, index, GENERATION_STREAM)) for index in (0, 1))
+    self.assertFalse(np.allclose(first['energy'], second['energy']))
+    other = make_simulator(dict(self.settings, random_seed=1))
+    self.assertFalse(np.allclose(first['energy'], other.generate_muon_batch(5, rng=batch_rng(other.seed, 0, GENERATION_STREAM))['energy']))
+
+class TestSimulationPool(unittest.TestCase):
+  def setUp(self):
+    self.settings = dict(SETTINGS, muon_transport_mode='event', muon_batch_size=25)
+    self.simulator = make_simulator(self.settings)
+
+  def test_pool_is_reused_across_calls(self):
+    with SimulationPool(self.settings, 2) as pool:
+      first = {batch.batch_index: batch for batch in self.simulator.iter_muon_batches(60, pool=pool)}
+      second = {batch.batch_index: batch for batch in self.simulator.iter_muon_batches(110, pool=pool)}
+      self.assertEqual(pool.pool._state, 'RUN')
+    self.assertEqual(sorted(first), [0, 1, 2])
+    self.assertEqual(sorted(second), [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(np.sort(np.concatenate([batch.summaries['id'] for batch in second.values()])), np.arange(110))
+
+  def test_summaries_match_local_simulation(self):
+    muons = self.simulator.generate_muon_batch(20, rng=np.random.default_rng(2))
+    settings = dict(self.settings, muon_transport_mode='lockstep', muon_mean_free_path=1e9,
+                    muon_scattering_strength_in_cavity=0, muon_scattering_strength_in_other_material=0,
+                    pyramid_material_density=[2.3, 2.3], pyramid_material_thickness_range=[90, 90],
+                    void_density_range=[0.0001, 0.0001])
+    local = make_simulator(settings).simulate_batch(muons)
+    with SimulationPool(self.settings, 2) as pool:
+      [remote] = pool.map_batches([(0, muons)], settings=settings)
+    np.testing.assert_allclose(remote.summaries['final_energy'], local.summaries['final_energy'])
+    np.testing.assert_array_equal(remote.summaries['id'], local.summaries['id'])
+
+  def test_early_stop_terminates_own_pool(self):
+    close = SimulationPool.close
+    with patch.object(SimulationPool, 'close', autospec=True, side_effect=close) as closed:
+      batches = self.simulator.iter_muon_batches(200, 2)
+      next(batches)
+      batches.close()
+    self.assertEqual(closed.call_args.kwargs, {'terminate': True})
+
+  def test_abandoned_slots_are_reused(self):
+    with SimulationPool(self.settings, 1) as pool:
+      batches = self.simulator.iter_muon_batches(200, pool=pool)
+      next(batches)
+      batches.close()
+      self.assertEqual(len(pool.abandoned), 2)
+      for _, task in pool.abandoned:
+        task.wait()
+      self.assertEqual(len(list(self.simulator.iter_muon_batches(200, pool=pool))), 8)
+      self.assertEqual(len(pool.slots), 2)
+      self.assertEqual(pool.abandoned, [])
+
+  def test_grown_slots_replace_worker_mappings(self):
+    with SimulationPool(self.settings, 1) as pool:
+      small = pool._take_slot(10)
+      pool.free_slots.append(small)
+      large = pool._take_slot(15)
+      self.assertEqual((large.number, large.capacity), (small.number, 20))
+      self.assertEqual(pool.slots, [large])
+      with patch.dict(worker_pool._blocks, clear=True):
+        other = worker_pool._Slot(small.number, 10)
+        stale = worker_pool._attach((small.number, 'input'), other.input.name)
+        current = worker_pool._attach((small.number, 'input'), large.input.name)
+        self.assertIsNone(stale.buf)
+        self.assertEqual(list(worker_pool._blocks.values()), [current])
+        current.close()
+        other.release()
+
+  def test_pool_of_other_settings_is_refused(self):
+    with SimulationPool(dict(self.settings, muon_mean_free_path=1), 1) as pool:
+      with self.assertRaises(ValueError):
+        next(self.simulator.iter_muon_batches(10, pool=pool))
+
+  def test_worker_cache_is_bounded(self):
+    with patch.dict(worker_pool._simulators, clear=True), patch.object(worker_pool, '_default_key', None):
+      worker_pool._initialize_worker(self.settings)
+      default = worker_pool._worker_simulator(None)
+      points = [dict(self.settings, muon_mean_free_path=mean_free_path) for mean_free_path in (10, 20, 30, 40)]
+      for point in points:
+        worker_pool._worker_simulator(point)
+      self.assertEqual(len(worker_pool._simulators), SIMULATOR_CACHE_SIZE + 1)
+      self.assertIs(worker_pool._worker_simulator(None), default)
+      self.assertEqual(worker_pool._worker_simulator(points[-1]).mean_free_path, 40)
+
+class TestSummaryMode(unittest.TestCase):
+  def setUp(self):
+    self.simulator = make_simulator(dict(SETTINGS, record_mode='summary', path_sample_every=5))
+    self.simulator.transport_mode = 'lockstep'
+
+  def test_summary_matches_paths(self):
+    muons = self.simulator.generate_muon_batch(40, rng=np.random.default_rng(4))
+    batch = self.simulator.simulate_batch(muons, batch_index=3)
+    self.assertEqual(batch.batch_index, 3)
+    self.assertEqual(len(batch.summaries), 40)
+    self.assertEqual([muon_id for muon_id, _ in batch.paths], list(range(0, 40, 5)))
+    for muon_id, path in batch.paths:
+      summary = batch.summaries[muon_id]
+      np.testing.assert_allclose(summary['entry_position'], path[0]['position'])
+      np.testing.assert_allclose(summary['exit_position'], path[-1]['position'])
+      # The step absorbing or stopping a muon has no row
+      self.assertEqual(summary['final_energy'], 0 if summary['is_stopped'] else path[-1]['energy'])
+      self.assertEqual(summary['n_steps'], len(path) - 1)
+      self.assertFalse(path['is_absorbed'].any())
+
+  def test_summary_mode_matches_full_mode(self):
+    muons = self.simulator.generate_muon_batch(40, rng=np.random.default_rng(4))
+    muons['energy'] *= 5
+    full = make_simulator(dict(SETTINGS, muon_transport_mode='lockstep', random_seed=self.simulator.seed)).simulate_batch(muons)
+    summary = self.simulator.simulate_batch(muons)
+    self.assertEqual(len(full.paths), 40)
+    self.assertEqual(len(summary.paths), 8)
+    for field in SUMMARY_DTYPE.names:
+      np.testing.assert_array_equal(summary.summaries[field], full.summaries[field])
+    self.assertGreater(len(full.hits), 0)
+    for field in HIT_DTYPE.names:
+      np.testing.assert_array_equal(summary.hits[field], full.hits[field])
+
+  def test_opacity_and_void_time(self):
+    rows = np.zeros(3, dtype=PATH_DTYPE)
+    # 20 m of rock then 40 m through the cavity center
+    rows['position'] = [[115, 115, 125], [115, 115, 105], [115, 115, 65]]
+    rows['energy'] = [100, 50, 50]
+    summary = self.simulator.summarize_paths([(7, rows)])[0]
+    self.assertAlmostEqual(summary['opacity'], 2000 * 2.3 + 4000 * 0.000055)
+    self.assertAlmostEqual(summary['void_length'], 40)
+    self.assertAlmostEqual(summary['void_time'], 40 / 0.299792458)
+    self.assertFalse(summary['is_stopped'])
+
+class TestTransmissionMap(unittest.TestCase):
+  def make_hits(self, detectors, directions, weights):
+    hits = np.zeros(len(detectors), dtype=HIT_DTYPE)
+    hits['detector'] = detectors
+    hits['direction'] = directions
+    hits['weight'] = weights
+    return hits
+
+  def test_bins_arrival_directions(self):
+    transmission_map = TransmissionMap([1, 2], n_theta=4, n_phi=4)
+    # Straight down, then coming from +x at 60 degrees from the zenith
+    directions = [[0, 0, -1], [0, 0, -1], [-np.sqrt(3) / 2, 0, -0.5]]
+    hits = self.make_hits([1, 1, 2], directions, [1, 2, 0.5])
+    transmission_map.update(BatchResult(0, 3, None, [], hits, hits[:1]))
+    self.assertEqual(transmission_map.measured.sum(), 3.5)
+    self.assertEqual(transmission_map.measured[0, 0].sum(), 3)
+    self.assertEqual(transmission_map.measured_sumw2[0, 0].sum(), 5)
+    self.assertEqual(transmission_map.measured[1, 1, 2], 0.5)
+    self.assertEqual(transmission_map.reference.sum(), 1)
+
+  def test_merge_equals_single_pass(self):
+    rng = np.random.default_rng(12)
+    directions = -np.abs(rng.normal(size=(200, 3)))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    hits = self.make_hits(rng.integers(1, 3, 200), directions, rng.random(200))
+    whole, first, second = (TransmissionMap([1, 2], 6, 8) for _ in range(3))
+    whole.update(BatchResult(0, 200, None, [], hits, hits))
+    first.update(BatchResult(0, 100, None, [], hits[:100], hits[:100]))
+    second.update(BatchResult(1, 100, None, [], hits[100:], hits[100:]))
+    merged = first.merge(second)
+    np.testing.assert_allclose(merged.measured, whole.measured)
+    np.testing.assert_allclose(merged.reference_sumw2, whole.reference_sumw2)
+    with tempfile.TemporaryDirectory() as directory:
+      merged.save(os.path.join(directory, 'map.npz'))
+      np.testing.assert_array_equal(TransmissionMap.load(os.path.join(directory, 'map.npz')).measured, merged.measured)
+
+  def test_reference_without_voids_is_transparent(self):
+    settings = dict(SETTINGS, muon_transport_mode='event', detector_efficiency=1, transmission_reference=True, random_seed=6)
+    for voids in ([], ['cavity']):
+      simulator = make_simulator(dict(settings, scene_voids=voids))
+      transmission_map = TransmissionMap([1, 2], 6, 12)
+      transmission_map.update(simulator.simulate_batch(simulator.generate_muon_batch(2000, rng=np.random.default_rng(13))))
+      if not voids:
+        ratio, _ = transmission_map.transmission()
+        np.testing.assert_allclose(ratio[transmission_map.reference > 0], 1)
+    # Same numbers in both runs, a void only ever spares muons
+    self.assertGreaterEqual(transmission_map.measured.sum(), transmission_map.reference.sum())
+
+  def test_reference_shares_the_numbers_of_each_muon(self):
+    settings = dict(SETTINGS, detector_efficiency=0.5, transmission_reference=True, random_seed=6)
+    for mode, backend in (('step', 'numpy'), ('event', 'numpy'), ('lockstep', 'numpy'), ('step', 'numba')):
+      simulator = make_simulator(dict(settings, muon_transport_mode=mode, transport_backend=backend))
+      batch = simulator.simulate_batch(simulator.generate_muon_batch(100, rng=np.random.default_rng(13)), batch_index=2)
+      # Muons that never meet a void take the same steps and detector draws in both runs
+      clear = batch.summaries['id'][batch.summaries['void_length'] == 0]
+      hits, reference_hits = (hits[np.isin(hits['muon_id'], clear)] for hits in (batch.hits, batch.reference_hits))
+      self.assertGreater(len(hits), 0)
+      for field in HIT_DTYPE.names:
+        np.testing.assert_array_equal(hits[field], reference_hits[field])
+
+class TestReconstruction(unittest.TestCase):
+  def setUp(self):
+    self.cache = tempfile.TemporaryDirectory()
+    self.settings = dict(SETTINGS, cache_dir=self.cache.name, reconstruction_resolution=10,
+                         transmission_theta_bins=18, transmission_phi_bins=36)
+    self.simulator = make_simulator(self.settings)
+    self.analysis = MuonDataAnalysis(self.settings, self.simulator.pyramid, self.simulator.detectors)
+
+  def tearDown(self):
+    self.cache.cleanup()
+
+  def test_ray_lengths_match_the_pyramid(self):
+    matrix = self.analysis.system_matrix
+    self.assertEqual(matrix.shape, (2 * 18 * 36, 23 * 23 * 14))
+    directions = np.tile(self.analysis.ray_directions(), (2, 1))
+    origins = np.repeat(self.analysis.origins, 18 * 36, axis=0)
+    t_enter, t_exit = self.simulator.pyramid.intersection_distances_many(origins, directions)
+    lengths = np.nan_to_num(np.maximum(t_exit - np.maximum(t_enter, 0), 0))
+    np.testing.assert_allclose(np.asarray(matrix.sum(axis=1)).ravel(), lengths, atol=1e-6)
+    # The second analysis loads the cached matrix
+    cached = MuonDataAnalysis(self.settings, self.simulator.pyramid, self.simulator.detectors)
+    self.assertEqual(len(os.listdir(self.cache.name)), 1)
+    self.assertEqual((cached.system_matrix != matrix).nnz, 0)
+
+  def test_opacity_of_full_transmission(self):
+    matrix = self.analysis.system_matrix
+    opacity = self.analysis.opacity_from_transmission(np.ones(matrix.shape[0]))
+    np.testing.assert_allclose(opacity, 100 * 2.3 * np.asarray(matrix.sum(axis=1)).ravel(), rtol=1e-3, atol=1e-6)
+    self.assertTrue((self.analysis.opacity_from_transmission(np.full(matrix.shape[0], 2.0)) <= opacity).all())
+
+  def test_solvers_reduce_the_residual(self):
+    matrix = self.analysis.system_matrix
+    truth = np.full(matrix.shape[1], 2.3)
+    truth[np.ravel_multi_index((11, 11, 8), self.analysis.shape)] = 0
+    opacity = 100 * matrix @ truth
+    start = np.linalg.norm(opacity / 100 - matrix @ np.full(matrix.shape[1], 2.3))
+    for method in ('sirt', 'art', 'cgls'):
+      density = self.analysis.solve(opacity, method, 20).ravel()
+      crossed = np.isfinite(density)
+      self.assertLess(np.linalg.norm(opacity / 100 - matrix[:, crossed] @ density[crossed]), start / 2, method)
+      self.assertLess(density[np.ravel_multi_index((11, 11, 8), self.analysis.shape)], 2.3, method)
+
+class TestParameterSweep(unittest.TestCase):
+  def setUp(self):
+    self.cache = tempfile.TemporaryDirectory()
+    self.settings = dict(SETTINGS, cache_dir=self.cache.name, muon_transport_mode='event', detector_efficiency=1, muon_batch_size=100)
+
+  def tearDown(self):
+    self.cache.cleanup()
+
+  def test_expand_grid(self):
+    points = expand_grid({'cavity_radius': [10, 20], 'void_density_range': [[0, 0.1], [1, 2], [2, 3]]})
+    self.assertEqual(len(points), 6)
+    self.assertEqual(points[1], {'cavity_radius': 10, 'void_density_range': [1, 2]})
+    with self.assertRaises(ValueError):
+      run_sweep(self.settings, {'muon_energy_range': [[1, 10]]}, 100)
+
+  def test_common_random_numbers_and_cache(self):
+    grid = {'cavity_radius': [10, 30]}
+    points = run_sweep(self.settings, grid, 300, n_processes=2, seed=5)
+    first, second = (point['statistics'] for point in points)
+    self.assertEqual(points[1]['overrides'], {'cavity_radius': 30})
+    # Same muons at every point
+    self.assertEqual((first['n_muons'], first['n_outside']), (300, second['n_outside']))
+    self.assertGreater(points[0]['transmission_map'].measured.sum(), 0)
+    with patch('sweep.build_simulator', side_effect=AssertionError('cached points are not simulated again')):
+      again = run_sweep(self.settings, grid, 300, n_processes=2, seed=5)
+    self.assertEqual(again[1]['statistics'], second)
+
+class TestStopping(unittest.TestCase):
+  def test_relative_error_of_busiest_bins(self):
+    transmission_map = TransmissionMap([1], n_theta=1, n_phi=4)
+    transmission_map.measured[0, 0] = [100, 25, 1, 0]
+    transmission_map.measured_sumw2[0, 0] = [100, 25, 1, 0]
+    self.assertAlmostEqual(RelativeErrorTarget(transmission_map, 0.1, coverage=0.75).estimate(), 0.1)
+    self.assertAlmostEqual(RelativeErrorTarget(transmission_map, 0.1, coverage=0.9).estimate(), 0.2)
+    self.assertTrue(RelativeErrorTarget(transmission_map, 0.1, coverage=0.75).reached())
+    self.assertEqual(RelativeErrorTarget(TransmissionMap([1], 1, 4), 0.1).estimate(), np.inf)
+
+  def test_common_muons_cancel_in_the_significance(self):
+    hits = np.zeros(3, dtype=HIT_DTYPE)
+    hits['detector'] = 1
+    hits['muon_id'] = [0, 1, 2]
+    hits['direction'] = [0, 0, -1]
+    hits['weight'] = 1
+    transmission_map = TransmissionMap([1], 2, 2)
+    transmission_map.update(BatchResult(0, 3, None, [], hits, hits[:2]))
+    np.testing.assert_array_equal(transmission_map.common_sumw2, transmission_map.reference_sumw2)
+    difference, error = transmission_map.difference()
+    self.assertEqual((difference.max(), error.max()), (1, 1))
+    self.assertEqual(SignificanceTarget(transmission_map, 3).estimate(), 1)
+
+  def test_run_stops_at_the_target(self):
+    settings = dict(SETTINGS, muon_transport_mode='event', detector_efficiency=1, muon_batch_size=50, random_seed=8)
+    with tempfile.TemporaryDirectory() as directory:
+      transmission_map = TransmissionMap([1, 2], 1, 1)
+      lines = []
+      stop = RelativeErrorTarget(transmission_map, 0.15)
+      n_batches = make_simulator(settings).simulate_muons_streaming(5000, 2, directory, [transmission_map], stop=stop, report=lines.append)
+    self.assertTrue(stop.reached())
+    self.assertLess(n_batches, 100)
+    self.assertEqual(len(lines), n_batches)
+    self.assertTrue(lines[-1].startswith(f'{50 * n_batches} muons: relative error'))
+
+class TestInstrumentation(unittest.TestCase):
+  def test_disabled_does_nothing(self):
+    instrumentation = Instrumentation(False, os.path.join(tempfile.gettempdir(), 'never-written.log'))
+    self.assertIs(instrumentation.stage('transport'), instrumentation.stage('output'))
+    with instrumentation.stage('transport'):
+      pass
+    instrumentation.emit('batch', n_muons=1)
+    self.assertEqual(instrumentation.take_timings(), {})
+    self.assertFalse(os.path.exists(instrumentation.log_path))
+    self.assertIsNone(make_simulator().simulate_batch(make_simulator().generate_muon_batch(5)).metrics)
+
+  def test_run_events(self):
+    with tempfile.TemporaryDirectory() as directory:
+      log_path = os.path.join(directory, 'logs', 'simulation.log')
+      settings = dict(SETTINGS, muon_transport_mode='event', muon_batch_size=40, instrumentation=True, log_path=log_path)
+      statistics = TrajectoryStatistics()
+      make_simulator(settings).simulate_muons_streaming(100, 2, os.path.join(directory, 'output'), [statistics])
+      with open(log_path) as log_file:
+        events = [json.loads(line) for line in log_file]
+    batches, run = events[:-1], events[-1]
+    self.assertEqual([event['event'] for event in events], ['batch'] * 3 + ['run'])
+    self.assertEqual(sorted(event['batch_index'] for event in batches), [0, 1, 2])
+    self.assertTrue({'transport', 'detection', 'generation', 'output'} <= set(run['stages']))
+    self.assertEqual((run['n_muons'], run['n_outside'], run['n_steps']), (100, statistics.n_outside, statistics.n_steps))
+    self.assertEqual(run['n_detected'], sum(event['n_detected'] for event in batches))
+    self.assertEqual(sum(worker['muons'] for worker in run['workers'].values()), 100)
+
+  def test_parallel_run_events(self):
+    with tempfile.TemporaryDirectory() as directory:
+      log_path = os.path.join(directory, 'simulation.log')
+      settings = dict(SETTINGS, muon_transport_mode='event', muon_batch_size=40, instrumentation=True, log_path=log_path,
+                      output_path=os.path.join(directory, 'output'))
+      results = make_simulator(settings).simulate_muons_parallel(100, 2)
+      with open(log_path) as log_file:
+        events = [json.loads(line) for line in log_file]
+    self.assertEqual([event['event'] for event in events], ['batch'] * 3 + ['run'])
+    run = events[-1]
+    self.assertEqual((run['n_muons'], run['n_batches']), (100, 3))
+    self.assertEqual(run['n_muons'] - run['n_outside'], len(results))
+    self.assertTrue({'transport', 'detection', 'generation', 'output'} <= set(run['stages']))
 
 if __name__ == '__main__':
     suit = unittest.TestSuite()
     suit.addTest(unittest.makeSuite(TestMuonSimulator))
+    suit.addTest(unittest.makeSuite(TestMuonBatchGeneration))
+    suit.addTest(unittest.makeSuite(TestEventTransport))
+    suit.addTest(unittest.makeSuite(TestLockstepTransport))
+    suit.addTest(unittest.makeSuite(TestNumbaTransport))
+    suit.addTest(unittest.makeSuite(TestDetectorHits))
+    suit.addTest(unittest.makeSuite(TestImportanceSampling))
+    suit.addTest(unittest.makeSuite(TestMuonFlux))
+    suit.addTest(unittest.makeSuite(TestRangeTable))
+    suit.addTest(unittest.makeSuite(TestTransmissionMap))
+    suit.addTest(unittest.makeSuite(TestReconstruction))
+    suit.addTest(unittest.makeSuite(TestParameterSweep))
+    suit.addTest(unittest.makeSuite(TestStopping))
+    suit.addTest(unittest.makeSuite(TestInstrumentation))
+    suit.addTest(unittest.makeSuite(TestResultWriter))
+    suit.addTest(unittest.makeSuite(TestStreamingSimulation))
+    suit.addTest(unittest.makeSuite(TestRandomStreams))
+    suit.addTest(unittest.makeSuite(TestSimulationPool))
+    suit.addTest(unittest.makeSuite(TestSummaryMode))
     report_path = os.getcwd() + '/testReport'
     run = BeautifulReport(suit)
     run.report(filename = "test of muon simulation", description = "test of muon simulation", report_dir = report_path)
\ No newline at end of file
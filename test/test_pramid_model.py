@@ -1,10 +1,15 @@
 import os
+import pickle
+import tempfile
 import unittest
 import sys
+import numpy as np
 
 from BeautifulReport import BeautifulReport
-sys.path.append('/Users/gregyoungforever/Documents/ISEP2023-2024/Simulation/src')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
 from pyramid_model import Pyramid, Cavity , Chamber , GrandGallery
+from scene import Scene, OUTSIDE
+from voxel_grid import VoxelGrid
 
 class TestPyramid(unittest.TestCase):
     @classmethod
@@ -27,11 +32,46 @@ class TestPyramid(unittest.TestCase):
         # Test points outside the pyramid
         self.assertFalse(self.pyramid.is_inside([300, 300, 300]), "Point should be outside the pyramid")
 
+    def test_is_inside_many_matches_is_inside(self):
+        points = np.array([[50, 50, 50], [100, 100, 100], [300, 300, 300], [0, 0, 0], [100, 100, 140.001], [-0.001, 100, 0]])
+        expected = [True, True, False, True, False, False]
+        self.assertEqual(list(self.pyramid.is_inside_many(points)), expected)
+        self.assertEqual([self.pyramid.is_inside(point) for point in points], expected)
+
+    def test_is_inside_is_tight_at_the_faces(self):
+        # Point on the side face x = z * (base_length / 2) / height, nudged in and out along the normal
+        point = np.array([50.0, 100, 70])
+        normal = self.pyramid.face_normals[3]
+        self.assertTrue(self.pyramid.is_inside(point - 1e-4 * normal))
+        self.assertFalse(self.pyramid.is_inside(point + 1e-4 * normal))
+
+    def test_segment_intersects_matches_intersection_distances(self):
+        rng = np.random.default_rng(0)
+        starts = rng.uniform(-50, 250, (500, 3))
+        ends = starts + rng.normal(0, 40, (500, 3))
+        t_enter, t_exit = self.pyramid.intersection_distances_many(starts, ends - starts)
+        expected = (t_enter <= 1) & (t_exit >= 0)
+        self.assertTrue(0 < expected.sum() < 500)
+        self.assertEqual([self.pyramid.segment_intersects(start, end) for start, end in zip(starts.tolist(), ends.tolist())], list(expected))
+        self.assertTrue(self.pyramid.segment_intersects([50, 50, 50], [50, 50, 50]))
+        self.assertFalse(self.pyramid.segment_intersects([300, 300, 300], [300, 300, 300]))
+
     def test_path_length_with_ray_entering_from_top(self):
         # Test path length for a ray entering from the top of the pyramid
         expected_length = self.height
         actual_length = self.pyramid.path_length([100, 100, self.height + 10], [0, 0, -1])
         self.assertAlmostEqual(actual_length, expected_length, msg="Path length should match pyramid height")
+        # Lengths do not depend on the norm of the direction
+        self.assertAlmostEqual(self.pyramid.path_length([100, 100, self.height + 10], [0, 0, -2]), expected_length)
+
+    def test_entry_exit_distances_many(self):
+        origins = np.array([[100, 100, 150], [50, 100, 10], [100, 100, 70], [300, 300, 10], [100, 100, 150]])
+        directions = np.array([[0, 0, -1], [1, 0, 0], [0, 0, -1], [1, 0, 0], [0, 0, 1]])
+        entry, exit = self.pyramid.entry_exit_distances_many(origins, directions)
+        np.testing.assert_allclose(entry[:3], [10, 0, 0])
+        # At z = 10 the square cross-section spans x in [100 / 14, 200 - 100 / 14]
+        np.testing.assert_allclose(exit[:3], [150, 200 - 100 / 14 - 50, 70])
+        self.assertTrue(np.all(np.isnan(entry[3:])) and np.all(np.isnan(exit[3:])))
 
 
 class TestCavity(unittest.TestCase):
@@ -47,19 +87,36 @@ class TestCavity(unittest.TestCase):
         # Test a ray intersecting the cavity
         position = [80, 80, 65]  # A point outside the cavity
         direction = [1, 1, 0]  # Direction vector towards the cavity center
-        self.assertTrue(self.cavity.is_inside(position, direction), "Ray should intersect the cavity")
+        self.assertTrue(self.cavity.does_ray_intersect(position, direction), "Ray should intersect the cavity")
+        self.assertFalse(self.cavity.is_inside(position))
 
     def test_ray_on_cavity_surface(self):
         # Test a ray on the surface of the cavity
         position = [100, 120, 65]  # A point on the surface of the cavity
-        direction = [0, -1, 0]  # Direction vector pointing away from the cavity center
-        self.assertTrue(self.cavity.is_inside(position, direction), "Ray on cavity surface should intersect the cavity")
+        direction = [0, -1, 0]  # Direction vector pointing towards the cavity center
+        self.assertTrue(self.cavity.does_ray_intersect(position, direction), "Ray on cavity surface should intersect the cavity")
+        t_enter, t_exit = self.cavity.intersection_distances(position, direction)
+        self.assertAlmostEqual(t_enter, 0)
+        self.assertAlmostEqual(t_exit, 40)
+        self.assertFalse(self.cavity.is_inside(position))
 
     def test_ray_outside_cavity(self):
         # Test a ray outside and not intersecting the cavity
         position = [150, 150, 65]  # A point outside the cavity
         direction = [1, 0, 0]  # Direction vector pointing away from the cavity
-        self.assertFalse(self.cavity.is_inside(position, direction), "Ray should not intersect the cavity")
+        self.assertFalse(self.cavity.does_ray_intersect(position, direction), "Ray should not intersect the cavity")
+        self.assertIsNone(self.cavity.intersection_distances(position, direction))
+
+    def test_chord_length_many(self):
+        origins = np.array([[60, 100, 65], [100, 100, 65], [100, 100, 65], [150, 150, 65], [130, 100, 65]])
+        directions = np.array([[1, 0, 0], [0, 0, 1], [0, 0, 2], [1, 0, 0], [1, 0, 0]])
+        np.testing.assert_allclose(self.cavity.chord_length_many(origins, directions), [40, 20, 20, 0, 0])
+        t_enter, t_exit = self.cavity.intersection_distances_many(origins, directions)
+        np.testing.assert_allclose(t_enter[:3], [20, -20, -10])
+        np.testing.assert_allclose(t_exit[:3], [60, 20, 10])
+        self.assertTrue(np.isnan(t_enter[3]))
+        self.assertEqual(list(self.cavity.is_inside_many(origins)), [False, True, True, False, False])
+        self.assertAlmostEqual(self.cavity.chord_length([60, 100, 65], [1, 0, 0]), 40)
     
 class TestChamber(unittest.TestCase):
     @classmethod
@@ -107,21 +164,99 @@ class TestGrandGallery(unittest.TestCase):
 
     def test_ray_intersects_grand_gallery(self):
         # Test a ray intersecting the inclined grand gallery
-        position = [115, 200, 120]  # A point in front of the gallery's base center
-        direction = [0, -1, -1]  # Direction vector pointing towards the gallery's incline
+        position = [100, 200, 120]  # Above the lower end of the gallery
+        direction = [0, 1, -1]  # Direction vector going down into the gallery's incline
         self.assertTrue(self.grand_gallery.does_ray_intersect(position, direction), "Ray should intersect the Grand Gallery")
 
     def test_ray_misses_grand_gallery(self):
         # Test a ray missing the grand gallery
-        position = [100, 300, 120]
-        direction = [0, -1, 0]  # Direction vector pointing away from the gallery
+        position = [100, 300, 150]  # Above the upper end of the ceiling
+        direction = [0, -1, 0]
         self.assertFalse(self.grand_gallery.does_ray_intersect(position, direction), "Ray should not intersect the Grand Gallery")
 
+    def test_is_inside_follows_the_incline(self):
+        rise = np.tan(np.radians(self.incline_angle)) * 40
+        self.assertTrue(self.grand_gallery.is_inside([100, 240, 100 + rise + 1]))
+        self.assertFalse(self.grand_gallery.is_inside([100, 240, 101]))
+        # 15 m wide at the upper end, 10 m at the lower end
+        self.assertTrue(self.grand_gallery.is_inside([107, 249, 100 + rise * 49 / 40 + 1]))
+        self.assertFalse(self.grand_gallery.is_inside([107, 201, 101]))
+
     
 
 
+class TestScene(unittest.TestCase):
+    def setUp(self):
+        settings = {
+            'pyramid_material_density': [2.2, 2.4],
+            'scene_voids': ['cavity', 'queen_chamber', 'grand_gallery'],
+            'queen_chamber_center': [112, 115, 32],
+            'queen_chamber_width': 8,
+            'queen_chamber_length': 8,
+            'queen_chamber_height': 8,
+            'queen_chamber_density_range': [0.001, 0.001],
+            'grand_gallery_height': 6,
+            'grand_gallery_length': 47,
+            'grand_gallery_width_bottom': 4,
+            'grand_gallery_width_top': 4,
+            'grand_gallery_base_center': [115, 115, 47],
+            'grand_gallery_incline': -19,
+        }
+        self.scene = Scene.from_settings(settings, Pyramid(230, 139), Cavity([115, 115, 85], 20))
+
+    def test_locate(self):
+        points = np.array([[115, 115, 85], [112, 115, 33], [115, 116, 50], [50, 50, 10]])
+        np.testing.assert_array_equal(self.scene.locate_many(points), [0, 1, 2, -1])
+        self.assertEqual([self.scene.locate(point) for point in points], [0, 1, 2, -1])
+        np.testing.assert_allclose(self.scene.density_ranges[self.scene.locate_many(points)][:, 0], [0.00001, 0.001, 0.00001, 2.2])
+
+    def test_next_boundary(self):
+        self.assertAlmostEqual(self.scene.next_boundary([115, 115, 130], [0, 0, -1]), 25)
+        self.assertAlmostEqual(self.scene.next_boundary([115, 115, 105], [0, 0, -1]), 40)
+        self.assertEqual(self.scene.next_boundary([20, 20, 5], [1, 0, 0]), np.inf)
+
+    def test_void_lengths_many(self):
+        lengths = self.scene.void_lengths_many(np.array([[115, 115, 130], [20, 20, 5]]), np.array([[0, 0, -1], [1, 0, 0]]))
+        np.testing.assert_allclose(lengths[0, :2], [40, 8])
+        self.assertGreater(lengths[0, 2], 0)
+        np.testing.assert_array_equal(lengths[1], 0)
+
+class TestVoxelGrid(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.settings = {
+            'pyramid_base_length': 230,
+            'pyramid_height': 139,
+            'pyramid_material_density': [2.2, 2.4],
+            'voxel_grid_resolution': 2,
+            'cache_dir': self.cache_dir.name,
+        }
+        self.scene = Scene.from_settings(self.settings, Pyramid(230, 139), Cavity([115, 115, 85], 20))
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_grid_matches_scene_away_from_surfaces(self):
+        grid = VoxelGrid.from_settings(self.settings, self.scene)
+        # Voxel centers are sampled exactly
+        points = grid.lower + (np.array([[57, 57, 42], [57, 57, 2], [10, 10, 60], [57, 57, 52]]) + 0.5) * 2
+        np.testing.assert_array_equal(grid.locate_many(points), self.scene.locate_many(points))
+        self.assertEqual(grid.locate(points[0]), 0)
+        self.assertEqual(grid.locate([-1, 0, 0]), OUTSIDE)
+
+    def test_grid_is_cached_and_mapped(self):
+        grid = VoxelGrid.from_settings(self.settings, self.scene)
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+        self.assertIsInstance(grid.material, np.memmap)
+        # Pickling sends the path, not the voxels
+        restored = pickle.loads(pickle.dumps(grid))
+        self.assertEqual(restored.path, grid.path)
+        self.assertLess(len(pickle.dumps(grid)), 1000)
+        VoxelGrid.from_settings(dict(self.settings, cavity_radius=10), self.scene)
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 2)
+
 if __name__ == '__main__':
-  testClass = [TestPyramid, TestCavity, TestChamber, TestGrandGallery]
+  testClass = [TestPyramid, TestCavity, TestChamber, TestGrandGallery, TestScene, TestVoxelGrid]
   for i in range(testClass.__len__()):
     suit = unittest.TestSuite()
     suit.addTest(unittest.makeSuite(testClass[i]))
@@ -136,4 +271,8 @@ if __name__ == '__main__':
       run.report(filename = "test of chamber model", description = "test of chamber model", report_dir = report_path)
     if i == 3:
       run.report(filename = "test of grand gallery model", description = "test of grand gallery model", report_dir = report_path)
+    if i == 4:
+      run.report(filename = "test of scene model", description = "test of scene model", report_dir = report_path)
+    if i == 5:
+      run.report(filename = "test of voxel grid", description = "test of voxel grid", report_dir = report_path)
     
\ No newline at end of file